@@ -11,14 +11,80 @@ int threshLow[4] = {0}; // Analog low threshold value (0-1023)
 unsigned long threshTime; // Time threshold for discrete level crossing detection (microseconds)
 unsigned long triggerDuration; // Duration of 3.3V output when event is logged (microseconds)
 
-// Temp variables to convert incoming serial bytes to integers
+// Temp variables to convert incoming serial bytes to integers. These must be unsigned: a signed char
+// byte of 0x80 or more would be sign-extended and corrupt the value it is part of.
 char configRead[1];
-char thresholdRead[2];
-char threshTimeRead[4];
-char triggerDurationRead[4];
+byte thresholdRead[2];
+byte threshTimeRead[4];
+byte triggerDurationRead[4];
+char versionRead[5];
+
+// Serial protocol variables
+// Version 1: the 68-byte outputs array is written every 100 ms
+// Version 2: compact packets with a sync header and CRC16 (see protocol.py on the PC side)
+//   Sample packet: sync, type, sequence, length, time (low 16 bits), counter change mask,
+//                  one byte per changed counter, 4x10-bit analog values, CRC16
+//   Keyframe: sync, type, sequence, length, time, all 12 counters, 4x10-bit analog values, CRC16
+// Version 3: version 2 plus waveform capture
+//   Waveform packet: sync, type, sequence, length, time of first sample, sample interval (microseconds),
+//                    channel, WAVEFORM_BLOCK_SAMPLES 16-bit samples, CRC16
+// Version 4: version 3 plus command packets from the PC, in the same format, which change a channel's config
+//            and thresholds or the time threshold while the test runs. Each one is applied straight after the
+//            next sample or keyframe is sent and acknowledged with that packet's time.
+//   Command packet: sync, type, sequence, length, command, arguments, CRC16
+//     COMMAND_CHANNEL: channel (0-7: discrete, 8-11: analog), config, low threshold, high threshold
+//     COMMAND_GATE: time threshold (microseconds)
+//   Acknowledgement packet: sync, type, sequence, length, command sequence, status, time, CRC16
+// Version 5: version 4 plus loop statistics, sent straight after each periodic keyframe
+//   Loop statistics packet: sync, type, sequence, length, time, number of scans, minimum, mean and maximum
+//                           scan time (16-bit microseconds) since the last one, CRC16
+int protocolVersion = 1;
+const byte SYNC0 = 0xA5;
+const byte SYNC1 = 0x5A;
+const byte PACKET_SAMPLE = 1;
+const byte PACKET_KEYFRAME = 2;
+const byte PACKET_WAVEFORM = 3;
+const byte PACKET_COMMAND = 4;
+const byte PACKET_ACK = 5;
+const byte PACKET_LOOP_STATS = 6;
+const byte COMMAND_CHANNEL = 1;
+const byte COMMAND_GATE = 2;
+const byte ACK_APPLIED = 0;
+const byte ACK_REJECTED = 1;
+byte packet[64]; // Largest sample or keyframe packet (a keyframe) is 64 bytes
+byte packetSequence = 0;
+unsigned long sentCounters[12] = {0}; // Counter values as of the last packet sent
+unsigned long lastKeyframeTime = 0;
+unsigned long sampleInterval = 5; // Time in milliseconds between v2 sample packets
+unsigned long keyframeInterval = 1000; // Time in milliseconds between v2 keyframes
+
+// Command variables (protocol v4). Incoming bytes are collected in the command buffer until a whole packet
+// has arrived, which is kept there until it has been applied.
+const int COMMAND_MAX_PAYLOAD = 8;
+byte command[7 + COMMAND_MAX_PAYLOAD];
+int commandLength = 0;
+boolean commandReady = false;
+
+// Waveform capture variables (protocol v3)
+// Every waveformInterval microseconds the latest value of each analog channel is stored in a block. When the blocks
+// are full they are swapped with the second set, which is then sent a few bytes at a time so the loop never waits
+// for the serial port.
+const int WAVEFORM_BLOCK_SAMPLES = 32;
+const int SERIAL_RESERVE = 16; // Serial transmit buffer space left free for sample packets
+unsigned long waveformInterval = 0; // Time in microseconds between waveform samples (0: capture off)
+unsigned long nextWaveformSample;
+uint16_t waveformBlocks[2][4][WAVEFORM_BLOCK_SAMPLES];
+unsigned long waveformTimes[2]; // Time in milliseconds of the first sample in each set of blocks
+int waveformFilling = 0; // Set of blocks being filled
+int waveformCount = 0; // Number of samples in the set of blocks being filled
+int waveformSendChannel = 4; // Next channel to send from the full set of blocks (4: none)
+byte waveformPacket[7 + 7 + 2*WAVEFORM_BLOCK_SAMPLES];
+int waveformPacketLength = 0;
+int waveformPacketSent = 0; // Bytes of waveformPacket written to serial so far
 
 // Time-related variables
 unsigned long currentTime;
+unsigned long scanMicros; // micros() at the start of the current scan, used for every timing in it
 unsigned long lastReadTime = 0;
 unsigned long serialUpdateInterval = 100; // Time in milliseconds between serial writes
                                           // This must be longer than the interval between serial queue reads on the PC side
@@ -29,8 +95,23 @@ unsigned long triggerTimer = 0;
 int triggerState = 0; // 0: trigger is off
                       // 1: trigger is on
 
+// Loop statistics variables (protocol v5). Scan times are measured from the start of one scan to the start
+// of the next and collected until the next keyframe.
+unsigned long lastScanMicros;
+unsigned long loopScans = 0;
+unsigned long loopTotal = 0;
+unsigned long loopMin = 0xFFFFFFFF;
+unsigned long loopMax = 0;
+
 // Discrete-related variables
+// The discrete inputs are read straight from the input register of each port they are on, once per scan,
+// so all eight are sampled together in a few cycles. dPortOf[i] is the index in dPorts of D_PINS[i]'s port.
 unsigned long currentDiscrete;
+volatile uint8_t* dPorts[8];
+int dPortCount = 0;
+byte dPortOf[8];
+byte dMask[8];
+byte dPortValues[8];
 int discreteState[8] = {0}; // 0: failing side of HIGH/LOW (time threshold already reached)
                             // 1: passing side of HIGH/LOW
                             // 2: failing side of HIGH/LOW (waiting for time threshold or transition back to passing side)
@@ -38,8 +119,12 @@ int discreteState[8] = {0}; // 0: failing side of HIGH/LOW (time threshold alrea
 
 
 // Analog-related variables
+// Conversions run in the background: each scan that finds the ADC idle takes the result for adcChannel
+// and starts the next enabled channel, so the loop never waits the ~110 microseconds of analogRead().
 unsigned long currentAnalog;
 int currentPin;
+int adcChannel = -1; // Analog channel being converted (-1: none)
+int adcPin; // Input pin of that conversion
 int analogState[4] = {0}; // 0 = outside threshold window (time threshold already reached)
                           // 1 = inside threshold window
                           // 2 = outside threshold window (waiting for time threshold or transition back to passing side)
@@ -69,6 +154,20 @@ void setup() {
   for(int i = 0; i < (sizeof(D_PINS)/sizeof(int)); i++) {
     pinMode(D_PINS[i], INPUT);
   }
+
+  // Find the input register and bit of each discrete pin
+  for(int i = 0; i < 8; i++) {
+    volatile uint8_t* port = portInputRegister(digitalPinToPort(D_PINS[i]));
+    int p = 0;
+    while(p < dPortCount && dPorts[p] != port) {
+      p++;
+    }
+    if(p == dPortCount) {
+      dPorts[dPortCount++] = port;
+    }
+    dPortOf[i] = p;
+    dMask[i] = digitalPinToBitMask(D_PINS[i]);
+  }
   
   // Establish serial connection
   Serial.begin(115200);
@@ -99,13 +198,31 @@ void setup() {
   // Read incoming serial time threshold value
   Serial.readBytes(threshTimeRead, 4);
   for (int i = 0; i<4; i++) {
-    threshTime += threshTimeRead[i] << i*8;
+    threshTime += (unsigned long)threshTimeRead[i] << i*8;
   }
 
   // Read incoming trigger duration value
   Serial.readBytes(triggerDurationRead, 4);
   for (int i = 0; i<4; i++) {
-    triggerDuration += triggerDurationRead[i] << i*8;
+    triggerDuration += (unsigned long)triggerDurationRead[i] << i*8;
+  }
+
+  // Protocol version negotiation. PC software that supports protocol v2 follows the configuration
+  // with 'S', 'V', 'B', <version>, which is echoed back as an acknowledgement. From version 3 one more
+  // byte, the waveform sample interval in units of 100 microseconds, follows and is echoed too. Older
+  // PC software sends nothing more, so after the timeout the original v1 frames are used.
+  Serial.setTimeout(100);
+  if(Serial.readBytes(versionRead, 4) == 4 && versionRead[0] == 'S' && versionRead[1] == 'V' &&
+     versionRead[2] == 'B' && versionRead[3] >= 2) {
+    protocolVersion = 2;
+    int requestLength = 4;
+    if(versionRead[3] >= 3 && Serial.readBytes(versionRead + 4, 1) == 1) {
+      protocolVersion = versionRead[3] >= 5 ? 5 : (versionRead[3] >= 4 ? 4 : 3);
+      waveformInterval = (byte)versionRead[4] * 100UL;
+      requestLength = 5;
+    }
+    versionRead[3] = protocolVersion;
+    Serial.write((byte*)versionRead, requestLength);
   }
 
   // Initial analog pin read
@@ -132,16 +249,40 @@ void setup() {
   }
 
   outputs[0] = lastReadTime;
-  Serial.write((byte*)outputs, 68); // Write data to serial buffer for output
+  nextWaveformSample = micros();
+  lastScanMicros = micros();
+  if(protocolVersion >= 2) {
+    sendKeyframe();
+    lastKeyframeTime = lastReadTime;
+  }
+  else {
+    Serial.write((byte*)outputs, 68); // Write data to serial buffer for output
+  }
 }
 
 
 void loop() {
-  
-  // Read discrete pins
+  // Time the scan, and read every discrete input port at once
+  scanMicros = micros();
+  currentTime = millis();
+  unsigned long scanTime = scanMicros - lastScanMicros;
+  lastScanMicros = scanMicros;
+  loopScans++;
+  loopTotal += scanTime;
+  if(scanTime < loopMin) {
+    loopMin = scanTime;
+  }
+  if(scanTime > loopMax) {
+    loopMax = scanTime;
+  }
+  for(int p = 0; p < dPortCount; p++) {
+    dPortValues[p] = *dPorts[p];
+  }
+
+  // Check discrete pins
   for(int i = 0; i < 8; i++) {
     if(dConfig[i] == 1) { // Looking for sensor rising edges == looking for Arduino falling edges
-      currentDiscrete = digitalRead(D_PINS[i]);
+      currentDiscrete = (dPortValues[dPortOf[i]] & dMask[i]) ? HIGH : LOW;
       if(discreteState[i] == 0) {
         if(currentDiscrete == HIGH) {
           discreteState[i] = 1;
@@ -149,7 +290,7 @@ void loop() {
       }
       else if(discreteState[i] == 1) {
         if(currentDiscrete == LOW) {
-          eventTimer[i] = micros();
+          eventTimer[i] = scanMicros;
           discreteState[i] = 2;
         }
       }
@@ -167,7 +308,7 @@ void loop() {
       }
     }
     else if(dConfig[i] == 2) { // Looking for sensor falling edges == looking for Arduino rising edges
-      currentDiscrete = digitalRead(D_PINS[i]);
+      currentDiscrete = (dPortValues[dPortOf[i]] & dMask[i]) ? HIGH : LOW;
       if(discreteState[i] == 0) {
         if(currentDiscrete == LOW) {
           discreteState[i] = 1;
@@ -175,7 +316,7 @@ void loop() {
       }
       else if(discreteState[i] == 1) {
         if(currentDiscrete == HIGH) {
-          eventTimer[i] = micros();
+          eventTimer[i] = scanMicros;
           discreteState[i] = 2;
         }
       }
@@ -194,45 +335,16 @@ void loop() {
     } 
   }
 
-  // Read analog pins, store read values, compare to last read values, increment counters accordingly
-  for(int i = 0; i < 4; i++) {
-    if(aConfig[i] == 0) { // Channel is turned 'off' by user. No further action needed on this channel.
-      currentAnalog = 0;
-    }
-    else {
-      if(aConfig[i] == 1) { // Channel is analog current
-        currentPin = i*2;
-      }
-      else { // Channel is analog voltage
-        currentPin = i*2 + 1;
-      }
-      currentAnalog = analogRead(currentPin); // Read value from input pin
-      
-      if(analogState[i] == 0) { // Channel is confirmed fail, looking for first reading inside threshold window
-        if((currentAnalog > (threshLow[i] + hysteresis)) && currentAnalog < (threshHigh[i] - hysteresis)) {
-          analogState[i] = 1;
-        }
-      }
-      else if(analogState[i] == 1) { // Channel is passing, lookign for first reading outside threshold window
-        if(currentAnalog > threshHigh[i] || currentAnalog < threshLow[i]) {
-          eventTimer[i+8] = micros();
-          analogState[i] = 2;
-        }
-      }
-      else if(analogState[i] == 2) { // Channel is outside threshold window, but not yet for the duration required to fail
-        if(checkTimeThresh(eventTimer[i+8], threshTime)) { // Check time since first out of window reading, if over threshold, flag as fail
-          outputs[i*2 + 9]++;
-          analogState[i] = 0;
-          activateTrigger();
-        }
-        else { // If time threshold is not yet met, check if reading is inside window. If so, reset state to 1
-          if((currentAnalog > (threshLow[i] + hysteresis)) && currentAnalog < (threshHigh[i] - hysteresis)) {
-            analogState[i] = 1;
-          }
-        }
-      }
+  // Take the result of the last analog conversion once it has finished and start the next one
+  if(!(ADCSRA & (1 << ADSC))) {
+    if(adcChannel >= 0) {
+      checkAnalog(adcChannel, ADC);
     }
-    outputs[(i*2)+10] = currentAnalog; // Store current values (0-1023) for each channel
+    startConversion();
+  }
+
+  if(waveformInterval > 0) {
+    captureWaveform();
   }
 
   // if trigger output is on, check time and turn off if trigger duration is exceeded
@@ -242,9 +354,37 @@ void loop() {
       triggerState = 0;
     }
   }
-  
-  currentTime = millis();
-  if (currentTime - lastReadTime >= 100) { // Write outputs to serial if 100 or more ms elaspsed since last write
+
+  if(protocolVersion >= 2) {
+    if(protocolVersion >= 4) {
+      readCommand();
+    }
+
+    // Send a packet every sampleInterval ms, but never in the middle of a waveform packet
+    if(currentTime - lastReadTime >= sampleInterval && waveformPacketSent == waveformPacketLength) {
+      outputs[0] = currentTime;
+      if(currentTime - lastKeyframeTime >= keyframeInterval) {
+        sendKeyframe();
+        lastKeyframeTime = currentTime;
+        if(protocolVersion >= 5) {
+          sendLoopStats();
+        }
+      }
+      else {
+        sendSample();
+      }
+      lastReadTime = currentTime;
+
+      // Every packet after this one is measured with the new configuration
+      if(commandReady) {
+        applyCommand();
+      }
+    }
+    if(waveformInterval > 0) {
+      sendWaveform();
+    }
+  }
+  else if (currentTime - lastReadTime >= 100) { // Write outputs to serial if 100 or more ms elaspsed since last write
     outputs[0] = currentTime;
     Serial.write((byte*)outputs, 68);
     lastReadTime = currentTime;
@@ -252,34 +392,314 @@ void loop() {
 }
 
 
-// This function checks if an event duration has surpassed the threshold time, returns true or false
-// This solves the problem of the micros() function rolling over after 4294967295 microseconds,
-// or 01:11:34.967 in HH:MM:SS
+// This function checks if an event duration has surpassed the threshold time at the start of the current
+// scan, returns true or false. Unsigned subtraction gives the elapsed time even if micros() rolled over
+// (after 4294967295 microseconds, or 01:11:34.967 in HH:MM:SS) since the event started.
 boolean checkTimeThresh(unsigned long eventStart, unsigned long eventDuration) {
-  unsigned long timeToRollover = 4294967295 - eventStart; // microseconds until next rollover
-  if(timeToRollover >= eventDuration) { // threshold time would be reached prior to rollover
-    if(micros() - eventStart >= eventDuration) {
-      return true;
+  return scanMicros - eventStart >= eventDuration;
+}
+
+// Starts a background conversion of the next enabled analog channel after adcChannel. Channels that are
+// turned 'off' by the user read 0.
+void startConversion() {
+  for(int n = 0; n < 4; n++) {
+    adcChannel = (adcChannel + 1) % 4;
+    if(aConfig[adcChannel] != 0) {
+      adcPin = A_PINS[aConfig[adcChannel] == 1 ? adcChannel*2 : adcChannel*2 + 1]; // Current or voltage
+#ifdef MUX5
+      ADCSRB &= ~(1 << MUX5); // Pins 0-7
+#endif
+      ADMUX = (1 << REFS0) | (adcPin & 0x07); // AVcc reference, as analogRead() uses
+      ADCSRA |= (1 << ADSC);
+      return;
     }
-    else {
-      return false;
+    outputs[(adcChannel*2)+10] = 0;
+  }
+  adcChannel = -1;
+}
+
+// Stores a finished conversion of analog channel i, compares it to the thresholds and increments the
+// counter accordingly. The result is dropped if the channel was turned off or switched between current
+// and voltage while it was converted.
+void checkAnalog(int i, unsigned long value) {
+  if(aConfig[i] == 0) {
+    return;
+  }
+  currentPin = A_PINS[aConfig[i] == 1 ? i*2 : i*2 + 1];
+  if(currentPin != adcPin) {
+    return;
+  }
+  currentAnalog = value;
+
+  if(analogState[i] == 0) { // Channel is confirmed fail, looking for first reading inside threshold window
+    if((currentAnalog > (threshLow[i] + hysteresis)) && currentAnalog < (threshHigh[i] - hysteresis)) {
+      analogState[i] = 1;
     }
   }
-   else { // rollover prior to threshold time
-    if(micros() + timeToRollover >= eventDuration) {
-      return true;
+  else if(analogState[i] == 1) { // Channel is passing, lookign for first reading outside threshold window
+    if(currentAnalog > threshHigh[i] || currentAnalog < threshLow[i]) {
+      eventTimer[i+8] = scanMicros;
+      analogState[i] = 2;
     }
-    else {
-      return false;
+  }
+  else if(analogState[i] == 2) { // Channel is outside threshold window, but not yet for the duration required to fail
+    if(checkTimeThresh(eventTimer[i+8], threshTime)) { // Check time since first out of window reading, if over threshold, flag as fail
+      outputs[i*2 + 9]++;
+      analogState[i] = 0;
+      activateTrigger();
+    }
+    else { // If time threshold is not yet met, check if reading is inside window. If so, reset state to 1
+      if((currentAnalog > (threshLow[i] + hysteresis)) && currentAnalog < (threshHigh[i] - hysteresis)) {
+        analogState[i] = 1;
+      }
     }
-  }   
+  }
+  outputs[(i*2)+10] = currentAnalog; // Store current values (0-1023) for each channel
 }
 
 // This function activates the 3.3V external trigger
 void activateTrigger() {
   digitalWrite(outputPin, HIGH);
   triggerState = 1;
-  triggerTimer = micros();
+  triggerTimer = scanMicros;
+}
+
+
+
+
+// Returns the outputs array index of event counter i (0-7: discrete channels, 8-11: analog channels)
+int counterIndex(int i) {
+  if(i < 8) {
+    return i + 1;
+  }
+  return (i - 8)*2 + 9;
+}
+
+// Packs the four 10-bit analog values into 5 bytes of the packet buffer starting at pos
+void packAnalog(int pos) {
+  unsigned int v0 = outputs[10], v1 = outputs[12], v2 = outputs[14], v3 = outputs[16];
+  packet[pos] = v0 & 0xFF;
+  packet[pos+1] = (v0 >> 8) | ((v1 & 0x3F) << 2);
+  packet[pos+2] = (v1 >> 6) | ((v2 & 0x0F) << 4);
+  packet[pos+3] = (v2 >> 4) | ((v3 & 0x03) << 6);
+  packet[pos+4] = v3 >> 2;
+}
+
+// CRC16-CCITT (polynomial 0x1021, initial value 0xFFFF)
+unsigned int crc16(byte* data, int length) {
+  unsigned int crc = 0xFFFF;
+  for(int i = 0; i < length; i++) {
+    crc ^= (unsigned int)data[i] << 8;
+    for(int bit = 0; bit < 8; bit++) {
+      if(crc & 0x8000) {
+        crc = (crc << 1) ^ 0x1021;
+      }
+      else {
+        crc = crc << 1;
+      }
+    }
+  }
+  return crc;
+}
+
+// Adds the header and CRC to the payload already in buffer (starting at byte 5), returns the packet length
+int buildPacket(byte* buffer, byte type, int payloadLength) {
+  buffer[0] = SYNC0;
+  buffer[1] = SYNC1;
+  buffer[2] = type;
+  buffer[3] = packetSequence++;
+  buffer[4] = payloadLength;
+  unsigned int crc = crc16(buffer + 2, payloadLength + 3);
+  buffer[payloadLength + 5] = crc & 0xFF;
+  buffer[payloadLength + 6] = crc >> 8;
+  return payloadLength + 7;
+}
+
+// Adds the header and CRC to the payload already in the packet buffer and writes it to serial
+void sendPacket(byte type, int payloadLength) {
+  Serial.write(packet, buildPacket(packet, type, payloadLength));
+}
+
+// Sends the time, all 12 counters and the analog values
+void sendKeyframe() {
+  int pos = 5;
+  memcpy(packet + pos, &outputs[0], 4); // AVR is little-endian, like the protocol
+  pos += 4;
+  for(int i = 0; i < 12; i++) {
+    sentCounters[i] = outputs[counterIndex(i)];
+    memcpy(packet + pos, &sentCounters[i], 4);
+    pos += 4;
+  }
+  packAnalog(pos);
+  sendPacket(PACKET_KEYFRAME, pos); // Payload runs from byte 5 to pos+4
+}
+
+// Sends the low 16 bits of time, the increase of each changed counter and the analog values.
+// Falls back to a keyframe if a counter increased by more than fits in one byte.
+void sendSample() {
+  unsigned int mask = 0;
+  int pos = 9;
+  for(int i = 0; i < 12; i++) {
+    unsigned long delta = outputs[counterIndex(i)] - sentCounters[i];
+    if(delta > 255) {
+      sendKeyframe();
+      return;
+    }
+    if(delta > 0) {
+      mask |= 1 << i;
+      packet[pos++] = delta;
+    }
+  }
+  for(int i = 0; i < 12; i++) {
+    sentCounters[i] = outputs[counterIndex(i)];
+  }
+  packet[5] = outputs[0] & 0xFF;
+  packet[6] = (outputs[0] >> 8) & 0xFF;
+  packet[7] = mask & 0xFF;
+  packet[8] = mask >> 8;
+  packAnalog(pos);
+  sendPacket(PACKET_SAMPLE, pos); // Payload runs from byte 5 to pos+4
+}
+
+// Sends the number of scans and the minimum, mean and maximum scan time since the last loop statistics
+// packet, and starts collecting them again. Scan times over 65535 microseconds are sent as 65535.
+void sendLoopStats() {
+  uint16_t stats[3] = {0, 0, 0};
+  if(loopScans > 0) {
+    unsigned long values[3] = {loopMin, loopTotal / loopScans, loopMax};
+    for(int i = 0; i < 3; i++) {
+      stats[i] = values[i] > 0xFFFF ? 0xFFFF : values[i];
+    }
+  }
+  memcpy(packet + 5, &currentTime, 4);
+  memcpy(packet + 9, &loopScans, 4);
+  memcpy(packet + 13, stats, 6);
+  sendPacket(PACKET_LOOP_STATS, 14);
+  loopScans = 0;
+  loopTotal = 0;
+  loopMin = 0xFFFFFFFF;
+  loopMax = 0;
+}
+
+// Stores the latest analog values in the waveform blocks if a sample is due. If the loop was held up
+// past several sample times, the same values are stored for each of them so the blocks keep a fixed
+// sample interval.
+void captureWaveform() {
+  if((long)(scanMicros - nextWaveformSample) < 0) { // Rollover-safe comparison
+    return;
+  }
+  if(waveformCount == 0) {
+    waveformTimes[waveformFilling] = currentTime;
+  }
+  for(int i = 0; i < 4; i++) {
+    waveformBlocks[waveformFilling][i][waveformCount] = outputs[(i*2)+10];
+  }
+  nextWaveformSample += waveformInterval;
+  waveformCount++;
+
+  // Blocks full: start sending them and fill the other set. If the previous set has not all been
+  // sent yet, its remaining channels are dropped.
+  if(waveformCount == WAVEFORM_BLOCK_SAMPLES) {
+    waveformSendChannel = 0;
+    waveformFilling = 1 - waveformFilling;
+    waveformCount = 0;
+  }
+}
+
+// Writes as much of the current waveform packet as fits in the serial transmit buffer without
+// waiting, and builds the packet for the next enabled channel once it has all been written
+void sendWaveform() {
+  if(waveformPacketSent == waveformPacketLength) {
+    while(waveformSendChannel < 4 && aConfig[waveformSendChannel] == 0) {
+      waveformSendChannel++;
+    }
+    if(waveformSendChannel >= 4) {
+      return;
+    }
+    int sending = 1 - waveformFilling;
+    uint16_t interval = waveformInterval;
+    memcpy(waveformPacket + 5, &waveformTimes[sending], 4);
+    memcpy(waveformPacket + 9, &interval, 2);
+    waveformPacket[11] = waveformSendChannel;
+    memcpy(waveformPacket + 12, waveformBlocks[sending][waveformSendChannel], 2*WAVEFORM_BLOCK_SAMPLES);
+    waveformPacketLength = buildPacket(waveformPacket, PACKET_WAVEFORM, 7 + 2*WAVEFORM_BLOCK_SAMPLES);
+    waveformPacketSent = 0;
+    waveformSendChannel++;
+  }
+
+  int count = Serial.availableForWrite() - SERIAL_RESERVE;
+  if(count > waveformPacketLength - waveformPacketSent) {
+    count = waveformPacketLength - waveformPacketSent;
+  }
+  if(count > 0) {
+    Serial.write(waveformPacket + waveformPacketSent, count);
+    waveformPacketSent += count;
+  }
+}
+
+
+// Reads command packets from the PC (protocol v4) a byte at a time, without waiting. Bytes outside a packet,
+// packets too long to be commands and packets with a bad CRC are dropped.
+void readCommand() {
+  while(!commandReady && Serial.available() > 0) {
+    byte b = Serial.read();
+    if((commandLength == 0 && b != SYNC0) || (commandLength == 1 && b != SYNC1)) {
+      commandLength = (b == SYNC0) ? 1 : 0;
+      continue;
+    }
+    command[commandLength++] = b;
+    if(commandLength == 5 && command[4] > COMMAND_MAX_PAYLOAD) {
+      commandLength = 0;
+    }
+    else if(commandLength > 5 && commandLength == command[4] + 7) {
+      unsigned int crc = crc16(command + 2, command[4] + 3);
+      commandReady = command[2] == PACKET_COMMAND && command[commandLength - 2] == (byte)crc &&
+                     command[commandLength - 1] == (byte)(crc >> 8);
+      if(!commandReady) {
+        commandLength = 0;
+      }
+    }
+  }
 }
 
+// Applies the command in the command buffer and acknowledges it with the time of the packet just sent.
+// A channel whose config changes starts again from state 0 (waiting for a passing reading), so the change
+// itself never counts an event. New thresholds or time threshold apply from the channel's current state.
+void applyCommand() {
+  byte* payload = command + 5;
+  int length = command[4];
+  byte status = ACK_REJECTED;
+  if(length == 7 && payload[0] == COMMAND_CHANNEL && payload[1] < 12 && payload[2] <= 2) {
+    int i = payload[1];
+    unsigned int low = payload[3] | ((unsigned int)payload[4] << 8);
+    unsigned int high = payload[5] | ((unsigned int)payload[6] << 8);
+    if(i < 8) {
+      if(dConfig[i] != payload[2]) {
+        dConfig[i] = payload[2];
+        discreteState[i] = 0;
+      }
+      status = ACK_APPLIED;
+    }
+    else if(low <= 1023 && high <= 1023) {
+      i -= 8;
+      if(aConfig[i] != payload[2]) {
+        aConfig[i] = payload[2];
+        analogState[i] = 0;
+      }
+      threshLow[i] = low;
+      threshHigh[i] = high;
+      status = ACK_APPLIED;
+    }
+  }
+  else if(length == 5 && payload[0] == COMMAND_GATE) {
+    memcpy(&threshTime, payload + 1, 4);
+    status = ACK_APPLIED;
+  }
 
+  packet[5] = command[3];
+  packet[6] = status;
+  memcpy(packet + 7, &outputs[0], 4);
+  sendPacket(PACKET_ACK, 6);
+  commandReady = false;
+  commandLength = 0;
+}
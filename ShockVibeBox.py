@@ -11,31 +11,49 @@ os.environ['KIVY_HOME'] = kivy_dir
 # Kivy imports
 import kivy
 from kivy.app import App
-from kivy.core.window import Window
-from kivy.properties import NumericProperty, StringProperty
+from kivy.core.window import Keyboard, Window
+from kivy.properties import NumericProperty, ObjectProperty, StringProperty
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.button import Button
 from kivy.uix.checkbox import CheckBox
 from kivy.clock import Clock
+from kivy.config import Config
+from kivy.graphics import Color, Mesh
 from kivy.uix.floatlayout import FloatLayout
 from kivy.uix.image import Image
 from kivy.uix.label import Label
 from kivy.uix.popup import Popup
+from kivy.uix.tabbedpanel import TabbedPanel, TabbedPanelItem
 from kivy.uix.textinput import TextInput
 from kivy.uix.widget import Widget
 
 # Config imports
-from config import COM_PORT, DEV_MODE, SCREEN_RES, TRIGGER_DURATION
+from config import (DEV_MODE, DEVICES, HISTORY_PLOT_SECONDS,
+                    METRICS_ENABLED, METRICS_PORT, RECORDING_DIR, SCREEN_RES,
+                    TRIGGER_DURATION, WAVEFORM_INTERVAL_MICROS)
+
+# Serial protocol imports
+from devices import (CHANGE_DEFERRED, CHANGE_REJECTED, CHANGE_UNACKNOWLEDGED,
+                     GATE_SETTING, Device, DeviceManager)
+from events import EventLog
+from framebuffer import FrameRingBuffer
+from history import LevelHistory
+from metrics import (DEPTH_BUCKETS, INTERVAL_BUCKETS, LATENCY_BUCKETS,
+                     MetricsServer, Registry, summarize)
+from protocol import (BAUDRATE, FRAMESIZE, PROTOCOL_VERSION, SAMPLESIZE,
+                      applyChange)
+from recorder import SessionRecorder, exportCsv, sessionPath
+from rollingstats import RollingStats, formatEventStats
+from timebase import TimeUnwrapper
+from waveform import WaveformBuffer
 
 # Other imports
 import numpy as np
-import queue
-import serial
-import struct
-import threading
 
+from datetime import datetime
+from functools import partial
 from math import floor
-from time import sleep
+from time import perf_counter, time
 
 ################################################################################
 ###### Configuration variables #################################################
@@ -43,12 +61,12 @@ from time import sleep
 """ These should not be edited. User settable configuration values are in the
     file config.py
 """
-# Set serial com config for installation. For a windows computer you should
-# not need to change any value other than 'PORT'
-COM_CONFIG = { 'SAMPLESIZE': 17,
-               'FRAMESIZE': 68,
-               'PORT': COM_PORT,
-               'BAUDRATE': 115200 }
+# Set serial com config for installation. The serial port of each unit is set
+# in DEVICES in config.py
+COM_CONFIG = { 'SAMPLESIZE': SAMPLESIZE,
+               'FRAMESIZE': FRAMESIZE,
+               'BAUDRATE': BAUDRATE,
+               'PROTOCOL': PROTOCOL_VERSION }
 
 # This is the time interval in seconds between attempted USB reads. This value
 # needs to be set shorter than the corresponding write interval on the
@@ -56,6 +74,36 @@ COM_CONFIG = { 'SAMPLESIZE': 17,
 # will noticeably lag behind the sensor outputs.
 USB_READ_INTERVAL = 0.05
 
+# Interval in seconds between display updates. Updating more often than the
+# screen is redrawn would only waste CPU, so this is never shorter than one
+# frame at Kivy's maximum frame rate.
+DISPLAY_INTERVAL = max(USB_READ_INTERVAL,
+                       1.0 / max(1, Config.getint('graphics', 'maxfps')))
+
+# Number of frames held in the buffer between the serial reader thread and the
+# UI. Only the newest frame is displayed, so this only needs to cover a UI
+# stall; older frames are overwritten (and counted) rather than queued up.
+FRAME_BUFFER_SIZE = 64
+
+# Number of waveform samples per analog channel summarised in the min/max/RMS
+# display (about one second at the default capture interval)
+WAVEFORM_WINDOW_SAMPLES = 512
+
+# Test time in milliseconds between redraws of the level history plots, and the
+# shortest time span they show when showing the whole test
+HISTORY_PLOT_MILLIS = 250
+HISTORY_MIN_SECONDS = 60
+
+# Interval in seconds between updates of the metrics overlay (see
+# METRICS_ENABLED in config.py)
+METRICS_OVERLAY_INTERVAL = 1.0
+
+# Status shown for a setting changed during a test that the unit is not known
+# to be using (see devices.Device.unconfirmed), by outcome of the change
+UNCONFIRMED_TEXT = {CHANGE_REJECTED: 'change rejected by unit',
+                    CHANGE_DEFERRED: 'change waits for reconnect',
+                    CHANGE_UNACKNOWLEDGED: 'change not confirmed by unit'}
+
 DATAFRAME = np.zeros(COM_CONFIG['SAMPLESIZE'], dtype=np.uint32)
 """The DATAFRAME is a 1x<SAMPLESIZE> array of unsigned 32-bit integers.
    The contents are as follows:
@@ -95,6 +143,9 @@ class AnalogLayout(BoxLayout):
 class AnalogMeter(FloatLayout):
     channelID = NumericProperty()
 
+    # ChannelStripAnalog the meter belongs to
+    strip = ObjectProperty(None)
+
     # Cosmetic margin used in GUI layout
     margin = NumericProperty(4)
 
@@ -109,18 +160,25 @@ class AnalogMeter(FloatLayout):
     # Analog level sent back from Arduino (0 to 1023)
     level = NumericProperty(0)
 
+    # Min/max/RMS of the captured waveform for display
+    waveformDisp = StringProperty('')
+
+    # Running mean/SD/range of the level for display
+    levelStatsDisp = StringProperty('')
+
+    # True while a threshold marker moved during a test has not been released
+    dragged = False
+
     def on_touch_move(self, touch):
         '''Moves the threshold markers'''
 
-        # Do not move markers if test is running
-        if app.controlsLayout.testRunning == True:
-            return None
-
         # Only act on touches within AnalogMeter
         if self.collide_point(*touch.pos):
 
-            # Ignore touch if the channel is deactivated
-            if app.analogStrips[self.channelID-1].ids.channelLabel.state == 'normal':
+            # Ignore touch if the channel is deactivated, or its unit cannot
+            # change its configuration during the test
+            if self.strip.ids.channelLabel.state == 'normal' or \
+                    self.strip.fixture.configLocked():
                 return None
 
             # Only act further if the touch position is within one of the
@@ -148,16 +206,28 @@ class AnalogMeter(FloatLayout):
                         self.ids.markerLow.center_x = touch.x
                     self.lowThreshold = int((self.ids.markerLow.center_x-(xBase+self.margin))*1023/(xRight-xBase-2*self.margin))
 
-                # Update channel configuration
-                app.analogStrips[self.channelID-1].updateConfig()
+                # Update channel configuration. During a test the thresholds
+                # are only sent to the unit once the marker is released.
+                if app.controlsLayout.testRunning == True:
+                    self.updateLabels()
+                    self.dragged = True
+                else:
+                    self.strip.updateConfig()
+
+    def on_touch_up(self, touch):
+        '''Sends the thresholds to the unit when a marker moved during a
+           test is released'''
+        if self.dragged:
+            self.dragged = False
+            self.strip.updateConfig()
 
     def updateLabels(self):
         '''Updates the labels showing the threshold values'''
-        if app.analogStrips[self.channelID-1].ids.channelLabel.state == 'normal':
+        if self.strip.ids.channelLabel.state == 'normal':
             self.lowThresholdDisp = 'Low Thres.\r\n------------'
             self.highThresholdDisp = 'High Thres.\r\n----------'
 
-        elif app.analogStrips[self.channelID-1].ids.currentButton.state == 'down':
+        elif self.strip.ids.currentButton.state == 'down':
             mA = self.highThreshold * 20/1023.0
             mAdisp = '{:0.2f} mA'.format(mA)
             self.highThresholdDisp = 'High Thres.\r\n' + mAdisp
@@ -175,6 +245,38 @@ class AnalogMeter(FloatLayout):
             voltsDisp = '{:0.3f} V'.format(volts)
             self.lowThresholdDisp = 'High Thres.\r\n' + voltsDisp
 
+    def updateWaveform(self, minimum, maximum, rms):
+        '''Shows the min/max/RMS of the recent waveform samples (0 to 1023)
+           in the channel's units'''
+        if np.isnan(minimum):
+            self.waveformDisp = ''
+        elif self.strip.channelConfig == 1:
+            scale = 20/1023.0
+            self.waveformDisp = ('min {:0.2f}  max {:0.2f}  '
+                                 'rms {:0.2f} mA').format(
+                minimum*scale, maximum*scale, rms*scale)
+        else:
+            scale = 10/1023.0
+            self.waveformDisp = ('min {:0.3f}  max {:0.3f}  '
+                                 'rms {:0.3f} V').format(
+                minimum*scale, maximum*scale, rms*scale)
+
+    def updateLevelStats(self, minimum, maximum, mean, std):
+        '''Shows the mean, standard deviation and range of the level (0 to
+           1023) since the start of the test in the channel's units'''
+        if np.isnan(mean) or self.strip.channelConfig == 0:
+            self.levelStatsDisp = ''
+        elif self.strip.channelConfig == 1:
+            scale = 20/1023.0
+            self.levelStatsDisp = ('mean {:0.2f}  sd {:0.2f}  '
+                                   'range {:0.2f}-{:0.2f} mA').format(
+                mean*scale, std*scale, minimum*scale, maximum*scale)
+        else:
+            scale = 10/1023.0
+            self.levelStatsDisp = ('mean {:0.3f}  sd {:0.3f}  '
+                                   'range {:0.3f}-{:0.3f} V').format(
+                mean*scale, std*scale, minimum*scale, maximum*scale)
+
 
 class ChannelStripAnalog(BoxLayout):
     channelID = NumericProperty()
@@ -182,6 +284,12 @@ class ChannelStripAnalog(BoxLayout):
     # Running tally of threshold crossing events received from Arduino
     eventCounter = NumericProperty(0)
 
+    # Event rate and recent event counts for display
+    statsDisp = StringProperty('')
+
+    # Status of a configuration change the unit is not using, for display
+    configStatusDisp = StringProperty('')
+
     # Channel configuration value:
     #   0: Off
     #   1: Analog current (0-20mA)
@@ -189,35 +297,21 @@ class ChannelStripAnalog(BoxLayout):
     # High and low threshold values belong to the AnalogMeter class
     channelConfig = NumericProperty(0)
 
-    def updateConfig(self):
-        '''Updates the channel configuration'''
-
-        # If test is not running, update channel configuration according to
-        # GUI state
-        if app.controlsLayout.testRunning == False:
-            self.ids.analogMeter.updateLabels()
-            if self.ids.channelLabel.state == 'normal':
-                #print('Channel A{} is off'.format(str(self.channelID)))
-                self.channelConfig = 0
-            elif self.ids.currentButton.state == 'down':
-                #print('Channel A{} is analog current, low threshold {}, high threshold {}'.format(
-                #str(self.channelID), str(self.ids.analogMeter.lowThreshold),
-                #str(self.ids.analogMeter.highThreshold)))
-                self.channelConfig = 1
-            else:
-                #print('Channel A{} is analog voltage, low threshold {}, high threshold {}'.format(
-                #str(self.channelID), str(self.ids.analogMeter.lowThreshold),
-                #str(self.ids.analogMeter.highThreshold)))
-                self.channelConfig = 2
+    # FixturePanel the strip belongs to
+    fixture = None
 
-        # If test is running. Immediately return GUI to state in accordance with
-        # existing config values. This effectively freezes the GUI elements while
-        # a test is running (not sure if there's a more straightforward way
-        # of doing this).
-        else:
+    def updateConfig(self):
+        '''Updates the channel configuration according to GUI state. If a
+           test is running, the change is sent to the unit, which applies it
+           without restarting the test.'''
+
+        # If the unit's firmware cannot change its configuration during the
+        # test, immediately return the GUI to the existing config values.
+        # This effectively freezes the GUI elements.
+        if self.fixture.configLocked():
             if self.channelConfig == 0:
                 self.ids.channelLabel.state = 'normal'
-            if self.channelConfig == 1 or self.channelConfig == 2:
+            else:
                 self.ids.channelLabel.state = 'down'
                 if self.channelConfig == 1:
                     self.ids.currentButton.state = 'down'
@@ -225,6 +319,37 @@ class ChannelStripAnalog(BoxLayout):
                 else:
                     self.ids.currentButton.state = 'normal'
                     self.ids.voltageButton.state = 'down'
+            return None
+
+        self.ids.analogMeter.updateLabels()
+        if self.ids.channelLabel.state == 'normal':
+            #print('Channel A{} is off'.format(str(self.channelID)))
+            self.channelConfig = 0
+        elif self.ids.currentButton.state == 'down':
+            #print('Channel A{} is analog current, low threshold {}, high threshold {}'.format(
+            #str(self.channelID), str(self.ids.analogMeter.lowThreshold),
+            #str(self.ids.analogMeter.highThreshold)))
+            self.channelConfig = 1
+        else:
+            #print('Channel A{} is analog voltage, low threshold {}, high threshold {}'.format(
+            #str(self.channelID), str(self.ids.analogMeter.lowThreshold),
+            #str(self.ids.analogMeter.highThreshold)))
+            self.channelConfig = 2
+
+        if app.controlsLayout.testRunning == True:
+            self.fixture.changeConfig({
+                'channel': self.channelID + 7,
+                'config': self.channelConfig,
+                'lowThreshold': self.ids.analogMeter.lowThreshold,
+                'highThreshold': self.ids.analogMeter.highThreshold })
+
+    def updateStats(self, ratePerMinute, windowCounts):
+        '''Shows the event rate and the event counts over the recent
+           windows (see rollingstats.RollingStats)'''
+        if self.channelConfig == 0:
+            self.statsDisp = ''
+        else:
+            self.statsDisp = formatEventStats(ratePerMinute, windowCounts)
 
 
 class ChannelConfigButton(CheckBox):
@@ -237,36 +362,33 @@ class ChannelStripDiscrete(BoxLayout):
     # Running tally of threshold crossing events received from Arduin
     eventCounter = NumericProperty(0)
 
+    # Event rate and recent event counts for display
+    statsDisp = StringProperty('')
+
+    # Status of a configuration change the unit is not using, for display
+    configStatusDisp = StringProperty('')
+
     # Channel configuration value:
     #   0: Off
     #   1: PNP/NPN rising edge
     #   2: PNP/NPN falling edge
     channelConfig = NumericProperty(0)
 
-    def updateConfig(self):
-        """Updates the channel configuration."""
-
-        # If test is not running, update channel configuration according to
-        # GUI state
-        if app.controlsLayout.testRunning == False:
-            if self.ids.channelLabel.state == 'normal':
-                #print('Channel D{} is off'.format(str(self.channelID)))
-                self.channelConfig = 0
-            else:
-                if self.ids.risingEdgeButton.state == 'down':
-                    #print('Channel D{} is PNP/NPN rising edge'.format(str(self.channelID)))
-                    self.channelConfig = 1
-                else:
-                    #print('Channel D{} is PNP/NPN falling edge'.format(str(self.channelID)))
-                    self.channelConfig = 2
+    # FixturePanel the strip belongs to
+    fixture = None
 
-        # If test is running. Immediately return GUI to state in accordance with
-        # existing config values. This effectively freezes the GUI elements while
-        # a test is running.
-        else:
+    def updateConfig(self):
+        """Updates the channel configuration according to GUI state. If a
+           test is running, the change is sent to the unit, which applies it
+           without restarting the test."""
+
+        # If the unit's firmware cannot change its configuration during the
+        # test, immediately return the GUI to the existing config values.
+        # This effectively freezes the GUI elements.
+        if self.fixture.configLocked():
             if self.channelConfig == 0:
                 self.ids.channelLabel.state = 'normal'
-            if self.channelConfig == 1 or self.channelConfig == 2:
+            else:
                 self.ids.channelLabel.state = 'down'
                 if self.channelConfig == 1:
                     self.ids.risingEdgeButton.state = 'down'
@@ -274,6 +396,30 @@ class ChannelStripDiscrete(BoxLayout):
                 else:
                     self.ids.risingEdgeButton.state = 'normal'
                     self.ids.fallingEdgeButton.state = 'down'
+            return None
+
+        if self.ids.channelLabel.state == 'normal':
+            #print('Channel D{} is off'.format(str(self.channelID)))
+            self.channelConfig = 0
+        else:
+            if self.ids.risingEdgeButton.state == 'down':
+                #print('Channel D{} is PNP/NPN rising edge'.format(str(self.channelID)))
+                self.channelConfig = 1
+            else:
+                #print('Channel D{} is PNP/NPN falling edge'.format(str(self.channelID)))
+                self.channelConfig = 2
+
+        if app.controlsLayout.testRunning == True:
+            self.fixture.changeConfig({'channel': self.channelID - 1,
+                                       'config': self.channelConfig})
+
+    def updateStats(self, ratePerMinute, windowCounts):
+        """Shows the event rate and the event counts over the recent
+           windows (see rollingstats.RollingStats)."""
+        if self.channelConfig == 0:
+            self.statsDisp = ''
+        else:
+            self.statsDisp = formatEventStats(ratePerMinute, windowCounts)
 
 
 class CheckBoxLabel(Label):
@@ -283,89 +429,131 @@ class CheckBoxLabel(Label):
 class ControlsLayout(BoxLayout):
     testRunning = False
 
-    def readData(self, dt):
-        """Reads and processes data from serial queue.
+    # Connection state of each running fixture for display
+    connectionDisp = StringProperty('')
 
-           Queue is first in first out. In practice, since we are calling this
-           function at a higher frequency than we are sending serial packets
-           from the Arduino, the queue will have either 0 or 1 item in it."""
+    # Fixtures taking part in the current or most recent test
+    runningFixtures = []
 
-        # The queue is usually empty
-        if self.q.empty():
+    def readData(self, dt):
+        """Updates the display of every running fixture from its serial frame
+           buffer (see FixturePanel.readData). The elapsed time shown is that
+           of the fixture currently on screen."""
+
+        metrics = app.displayMetrics
+        if metrics is not None:
+            tickStart = perf_counter()
+
+        for fixture in self.runningFixtures:
+            fixture.readData()
+        self.ids.elapsedTime.updateClock(self.shownFixture().elapsedMillis)
+        self.connectionDisp = '\n'.join(fixture.connectionStatus()
+                                        for fixture in self.runningFixtures)
+
+        if metrics is not None:
+            metrics.interval.observe(dt)
+            metrics.jitter.observe(abs(dt - DISPLAY_INTERVAL))
+            metrics.duration.observe(perf_counter() - tickStart)
+
+    def resetDisplay(self):
+        """Prepares readData for a new test. Every widget is updated from the
+           first frame received."""
+
+        for fixture in self.runningFixtures:
+            fixture.resetDisplay()
+        self.ids.elapsedTime.displayedSeconds = -1
+
+    def configLocked(self):
+        """Returns True if a setting shared by every fixture (the gate
+           threshold) cannot be changed, as some unit in the running test
+           cannot change its configuration."""
+        return any(fixture.configLocked() for fixture in self.runningFixtures)
+
+    def shownFixture(self):
+        """Returns the FixturePanel currently on screen."""
+        if app.fixtureTabs is None:
+            return app.fixtures[0]
+        return app.fixtureTabs.current_tab.content
+
+    def exportSession(self):
+        """Exports the most recent session recordings to CSV."""
+        if self.testRunning:
             return None
 
-        # When the queue is not empty, get the first packet of data off of the
-        # queue and process.
-        dataframe = self.q.get()
-        self.ids.elapsedTime.updateClock(dataframe[0])
-
-        for strip in app.discreteStrips:
-            strip.eventCounter = int(dataframe[strip.channelID])
-
-        for strip in app.analogStrips:
-            strip.ids.analogMeter.level = int(dataframe[(strip.channelID*2)+8])
-            strip.eventCounter = int(dataframe[(strip.channelID*2)+7])
+        csvPaths = [os.path.abspath(exportCsv(fixture.recordingPath))
+                    for fixture in self.runningFixtures
+                    if fixture.recordingPath is not None]
+        if not csvPaths:
+            return None
+        popup = Popup(title = 'Export complete',
+                      content=Label(text='\n'.join(csvPaths)),
+                      size=(700, 120 + 30*len(csvPaths)),
+                      size_hint=(None, None))
+        popup.open()
 
     def startTest(self):
-        """Starts a test"""
+        """Starts a test on every fixture.
+
+           Fixtures are connected by the reader thread, which keeps trying
+           any that cannot be reached and reconnects any whose link fails, so
+           nothing here waits for the serial ports."""
         if self.testRunning:
             return None
 
-        try:
-            self.usb = serial.Serial(COM_CONFIG['PORT'], COM_CONFIG['BAUDRATE'],
-                                timeout = 10)
-            sleep(0.5)
-
-            # Send discrete channel configs to Arduino
-            for strip in app.discreteStrips:
-                self.usb.write(struct.pack('<B', strip.channelConfig))
-
-            # Send analog channel configs to Arduino
-            for strip in app.analogStrips:
-                self.usb.write(struct.pack('<B', strip.channelConfig))
-                self.usb.write(struct.pack('<H', strip.ids.analogMeter.lowThreshold))
-                self.usb.write(struct.pack('<H', strip.ids.analogMeter.highThreshold))
-
-            # Send gate threshold time to Arduino
-            self.usb.write(struct.pack('<L', self.ids.gateThreshold.gateThresholdMicros))
-
-            # Send trigger duration to Arduino
-            triggerDurationMicros = int(TRIGGER_DURATION*1000)
-            self.usb.write(struct.pack('<L', triggerDurationMicros))
-
-
-            self.ids.startButton.disabled = True
-            self.ids.stopButton.disabled = False
-
-        except serial.serialutil.SerialException:
-            print('\nCOM error.\nSerial connection could not be established.')
-            print('Check COM_PORT value in config.py file.\n')
-            raise SystemExit
-
-        sleep(0.25)
-        self.usb.reset_input_buffer()
-        self.q = queue.Queue()
-        self.reader = SerialReader(self.q, self.usb)
-        self.reader.start()
+        for fixture in app.fixtures:
+            fixture.startTest(self.ids.gateThreshold.gateThresholdMicros)
+        self.ids.startButton.disabled = True
+        self.ids.stopButton.disabled = False
+        self.ids.exportButton.disabled = True
+
+        # A single reader thread services every fixture's serial port
+        self.manager = DeviceManager()
+        for fixture in app.fixtures:
+            self.manager.add(fixture.device)
+        self.manager.start()
+        self.runningFixtures = list(app.fixtures)
         self.testRunning = True
 
+        self.resetDisplay()
+
         # The data read should always be scheduled for a shorter interval than
         # the arduino is sending updates. Otherwise the UI display will lag
         # behind what is happening in real time.
-        Clock.schedule_interval(self.readData, USB_READ_INTERVAL)
+        Clock.schedule_interval(self.readData, DISPLAY_INTERVAL)
 
     def stopTest(self):
         """Stops a running test."""
         Clock.unschedule(self.readData)
         if self.testRunning:
-            self.reader.stop()
+            self.manager.stop()
+            self.manager.join(1.0)
+            for fixture in self.runningFixtures:
+                fixture.stopTest()
             self.ids.startButton.disabled = False
             self.ids.stopButton.disabled = True
+            self.ids.exportButton.disabled = False
             self.testRunning = False
         else:
             pass
 
 
+class DisplayMetrics(object):
+    """Timing of the display update (ControlsLayout.readData) in a
+       metrics.Registry."""
+
+    def __init__(self, registry):
+        self.interval = registry.histogram(
+            'svb_display_tick_interval_seconds',
+            'Time between the starts of successive display updates',
+            buckets=INTERVAL_BUCKETS)
+        self.jitter = registry.histogram('svb_display_tick_jitter_seconds',
+            'Difference between the time since the last display update and '
+            'the display interval', buckets=LATENCY_BUCKETS)
+        self.duration = registry.histogram('svb_display_tick_seconds',
+            'Time taken by one display update of every fixture',
+            buckets=LATENCY_BUCKETS)
+
+
 class DiscreteLabels(BoxLayout):
     pass
 
@@ -378,22 +566,394 @@ class EventCounter(Label):
     pass
 
 
+class EventStats(Label):
+    pass
+
+
 class ElapsedTime(BoxLayout):
     timeDisplay = StringProperty('--:--:--')
 
+    # Whole seconds currently displayed
+    displayedSeconds = -1
+
     def updateClock(self, timeMillis):
         """Update the displayed clock value.
 
            Takes elapsed time in milliseconds, converts to HH:MM:SS format
-           and updates GUI display."""
+           and updates GUI display. The display is only reformatted when the
+           whole number of seconds changes."""
+
+        seconds = int(timeMillis) // 1000
+        if seconds == self.displayedSeconds:
+            return None
+        self.displayedSeconds = seconds
 
-        seconds = timeMillis/1000.0
         hours = floor(seconds/3600)
         minutes = floor(seconds/60 - hours*60)
         seconds = floor(seconds - hours*3600 - minutes*60)
         self.timeDisplay = '{:02d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
 
 
+class FixturePanel(BoxLayout):
+    """Channel strips, display state and recording of one ShockVibeBox unit.
+
+       <device> is one entry of DEVICES in config.py."""
+
+    # Session file of the current or most recent test
+    recordingPath = None
+
+    # Waveform samples of the current test
+    waveforms = None
+
+    # Rolling statistics of the current test
+    stats = None
+
+    # Level history of the current test
+    history = None
+
+    # devices.Device of the current or most recent test, and the test
+    # configuration it is running with
+    device = None
+    config = None
+
+    # FixtureMetrics, if instrumented (see METRICS_ENABLED in config.py)
+    metrics = None
+
+    # Elapsed time in milliseconds of the newest frame displayed, unwrapped
+    # from the frame's 32-bit time by timeUnwrapper
+    elapsedMillis = -1
+    timeUnwrapper = None
+
+    def __init__(self, device, **kwargs):
+        BoxLayout.__init__(self, **kwargs)
+        self.name = device['name']
+        self.port = device['port']
+
+        discreteLayout = DiscreteLayout(orientation='vertical')
+        analogLayout = AnalogLayout(orientation='vertical')
+
+        # Add labels for discrete and analog channels
+        discreteLayout.add_widget(DiscreteLabels())
+        analogLayout.add_widget(AnalogLabels())
+
+        # Add discrete channel strips discrete sublayout
+        self.discreteStrips = []
+        for i in range(8):
+            self.discreteStrips.append(ChannelStripDiscrete())
+        for i in range(len(self.discreteStrips)):
+            self.discreteStrips[i].channelID = i+1
+            self.discreteStrips[i].fixture = self
+            discreteLayout.add_widget(self.discreteStrips[i])
+
+        # Add analog channel strips to analog sublayout
+        self.analogStrips = []
+        for i in range(4):
+            self.analogStrips.append(ChannelStripAnalog())
+        for i in range(len(self.analogStrips)):
+            self.analogStrips[i].channelID = i+1
+            self.analogStrips[i].fixture = self
+            analogLayout.add_widget(self.analogStrips[i])
+
+        self.add_widget(discreteLayout)
+        self.add_widget(analogLayout)
+
+    def readData(self):
+        """Reads and processes data from the serial frame buffer.
+
+           Only the newest frame is displayed. If the UI has stalled and
+           several frames arrived since the last call, the older ones are
+           skipped so the display never lags behind real time.
+
+           The frame is compared with the last one displayed, and only the
+           widgets whose values changed are updated. Every property write
+           triggers Kivy dispatch and a redraw, so this keeps CPU use low
+           when nothing is happening."""
+
+        if self.waveforms is not None:
+            self.readWaveforms()
+        if self.history is not None:
+            self.readHistory()
+        self.readUnconfirmed()
+
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.backlog.observe(len(self.frames))
+
+        # The buffer is usually empty
+        dataframe = self.frames.latest()
+        if dataframe is None:
+            return None
+
+        if metrics is not None:
+            dispatchStart = perf_counter()
+        changed = np.flatnonzero(dataframe != self.displayedFrame)
+        self.displayedFrame[:] = dataframe
+        for column in changed:
+            self.displayTargets[column](int(dataframe[column]))
+        if metrics is not None:
+            metrics.dispatch.observe(perf_counter() - dispatchStart)
+
+        if self.stats is not None:
+            self.readStats()
+
+    def readWaveforms(self):
+        """Updates the waveform min/max/RMS display if new waveform blocks
+           have arrived since the last update."""
+
+        if self.waveforms.blocks == self.displayedWaveformBlocks:
+            return None
+        self.displayedWaveformBlocks = self.waveforms.blocks
+
+        stats = self.waveforms.stats()
+        for strip in self.analogStrips:
+            strip.ids.analogMeter.updateWaveform(*stats[strip.channelID-1])
+
+    def readHistory(self):
+        """Redraws the level history plots every HISTORY_PLOT_MILLIS of
+           test time, over the last HISTORY_PLOT_SECONDS or the whole test.
+           One query of the history serves every analog channel."""
+
+        if self.elapsedMillis < self.plottedMillis + HISTORY_PLOT_MILLIS:
+            return None
+        self.plottedMillis = self.elapsedMillis
+
+        stopMillis = self.history.stopMillis
+        if stopMillis is None:
+            return None
+        stopMillis += 1
+        if HISTORY_PLOT_SECONDS is None:
+            startMillis = self.history.startMillis
+            stopMillis = max(stopMillis,
+                             startMillis + HISTORY_MIN_SECONDS*1000)
+        else:
+            startMillis = stopMillis - int(HISTORY_PLOT_SECONDS*1000)
+
+        plots = [strip.ids.historyPlot for strip in self.analogStrips]
+        mins, maxs, events = self.history.plot(startMillis, stopMillis,
+                                               int(plots[0].width))
+        for strip, plot in zip(self.analogStrips, plots):
+            if strip.channelConfig == 0:
+                plot.clear()
+            else:
+                channel = strip.channelID - 1
+                plot.draw(mins[:, channel], maxs[:, channel],
+                          events[:, channel])
+
+    def readUnconfirmed(self):
+        """Shows in each channel strip whether the unit is not using the
+           configuration shown, after a change during the test that it
+           rejected, did not acknowledge, or will only get at the next
+           connection."""
+
+        for strip in self.discreteStrips:
+            strip.configStatusDisp = UNCONFIRMED_TEXT.get(
+                self.device.unconfirmed(strip.channelID - 1), '')
+        for strip in self.analogStrips:
+            strip.configStatusDisp = UNCONFIRMED_TEXT.get(
+                self.device.unconfirmed(strip.channelID + 7), '')
+
+    def readStats(self):
+        """Updates the rolling statistics display once per second of test
+           time. The statistics cover every frame received, not only those
+           displayed."""
+
+        second = self.elapsedMillis // 1000
+        if second == self.displayedStatsSecond:
+            return None
+        self.displayedStatsSecond = second
+
+        stats = self.stats.snapshot()
+        for strip in self.discreteStrips:
+            channel = strip.channelID - 1
+            strip.updateStats(stats['ratePerMinute'][channel],
+                              stats['windowCounts'][:, channel])
+        for strip in self.analogStrips:
+            channel = strip.channelID + 7
+            strip.updateStats(stats['ratePerMinute'][channel],
+                              stats['windowCounts'][:, channel])
+            channel = strip.channelID - 1
+            strip.ids.analogMeter.updateLevelStats(
+                stats['levelMin'][channel], stats['levelMax'][channel],
+                stats['levelMean'][channel], stats['levelStd'][channel])
+
+    def resetDisplay(self):
+        """Prepares readData for a new test."""
+
+        self.displayTargets = self.buildDisplayTargets()
+        self.displayedFrame = np.full(COM_CONFIG['SAMPLESIZE'],
+                                      np.iinfo(np.uint32).max, dtype=np.uint32)
+        self.elapsedMillis = -1
+        self.timeUnwrapper = TimeUnwrapper()
+        self.displayedWaveformBlocks = 0
+        self.displayedStatsSecond = -1
+        self.plottedMillis = -HISTORY_PLOT_MILLIS
+        for strip in self.discreteStrips:
+            strip.statsDisp = ''
+            strip.configStatusDisp = ''
+        for strip in self.analogStrips:
+            strip.statsDisp = ''
+            strip.configStatusDisp = ''
+            strip.ids.analogMeter.waveformDisp = ''
+            strip.ids.analogMeter.levelStatsDisp = ''
+            strip.ids.historyPlot.clear()
+
+    def buildDisplayTargets(self):
+        """Returns a list mapping each frame column to a function that
+           displays its value."""
+
+        targets = [None]*COM_CONFIG['SAMPLESIZE']
+        targets[0] = self.setElapsedTime
+
+        for strip in self.discreteStrips:
+            targets[strip.channelID] = partial(setattr, strip, 'eventCounter')
+
+        for strip in self.analogStrips:
+            targets[(strip.channelID*2)+7] = partial(setattr, strip,
+                                                     'eventCounter')
+            targets[(strip.channelID*2)+8] = partial(setattr,
+                strip.ids.analogMeter, 'level')
+
+        return targets
+
+    def setElapsedTime(self, frameTime):
+        """Display target of the time column of the frames."""
+        self.elapsedMillis = self.timeUnwrapper.unwrapTime(frameTime)
+
+    def startTest(self, gateThresholdMicros):
+        """Starts recording and creates self.device, which connects to the
+           unit and sends it the test configuration once added to a
+           DeviceManager."""
+
+        # Every received frame is recorded to disk by a separate writer
+        # thread. The protocol version is agreed on each connection, so only
+        # the version requested is recorded.
+        config = self.testConfig(gateThresholdMicros)
+        self.config = config
+        header = dict(config)
+        header['startTime'] = datetime.now().isoformat()
+        header['fixture'] = self.name
+        header['port'] = self.port
+        header['requestedProtocolVersion'] = COM_CONFIG['PROTOCOL']
+        header['waveformIntervalMicros'] = WAVEFORM_INTERVAL_MICROS
+        self.recordingPath = sessionPath(RECORDING_DIR,
+            self.name if len(app.fixtures) > 1 else None)
+        self.recorder = SessionRecorder(self.recordingPath, header)
+        self.recorder.start()
+
+        self.frames = FrameRingBuffer(FRAME_BUFFER_SIZE)
+        self.events = EventLog()
+        self.stats = RollingStats()
+        self.waveforms = WaveformBuffer(WAVEFORM_WINDOW_SAMPLES)
+        self.history = LevelHistory()
+
+        # Every decoded frame goes to the display buffer, the recorder, the
+        # event log, the rolling statistics and the level history. Waveform
+        # blocks (protocol v3 only) go to the waveform display, and
+        # configuration changes, timebase checkpoints and loop statistics
+        # (protocol v5) to the recording.
+        self.device = Device(self.name, self.port, config,
+            [self.frames, self.recorder, self.events, self.stats,
+             self.history],
+            COM_CONFIG['PROTOCOL'], WAVEFORM_INTERVAL_MICROS,
+            [self.waveforms], [self.recorder.changeLog],
+            [self.recorder.timebaseLog], [self.recorder.loopLog])
+        if app.metrics is not None:
+            self.device.instrument(app.metrics)
+            self.metrics = FixtureMetrics(app.metrics, self)
+
+    def changeConfig(self, change):
+        """Sends a configuration change (see protocol.packCommand) to the
+           unit during a test, unless it changes nothing."""
+
+        config = applyChange(self.config, change)
+        if config == self.config:
+            return None
+        self.config = config
+        self.device.configure(change)
+
+    def configLocked(self):
+        """Returns True during a test on a unit whose firmware cannot change
+           its configuration while it runs (protocol below v4)."""
+        return (app.controlsLayout.testRunning and
+                self in app.controlsLayout.runningFixtures and
+                not self.device.acceptsChanges)
+
+    def connectionStatus(self):
+        """Returns the fixture's name and connection state for display,
+           and whether the unit is not using the gate threshold shown."""
+
+        text = '{}: {}'.format(self.name, self.device.status())
+        unconfirmed = self.device.unconfirmed(GATE_SETTING)
+        if unconfirmed is not None:
+            text += ', gate threshold ' + UNCONFIRMED_TEXT[unconfirmed]
+        return text
+
+    def testConfig(self, gateThresholdMicros):
+        """Returns the test configuration set in the GUI as a dict (see
+           protocol.packConfig)."""
+
+        return {
+            'discreteConfig': [strip.channelConfig
+                               for strip in self.discreteStrips],
+            'analogConfig': [strip.channelConfig
+                             for strip in self.analogStrips],
+            'analogLowThreshold': [strip.ids.analogMeter.lowThreshold
+                                   for strip in self.analogStrips],
+            'analogHighThreshold': [strip.ids.analogMeter.highThreshold
+                                    for strip in self.analogStrips],
+            'gateThresholdMicros': gateThresholdMicros,
+            'triggerDurationMicros': int(TRIGGER_DURATION*1000) }
+
+    def stopTest(self):
+        """Stops recording after the serial reader has stopped."""
+
+        self.recorder.stop()
+        print('{}: {} frames overwritten before display'.format(
+              self.name, self.frames.overwritten))
+        print('{}: {} frames recorded to {}, {} dropped'.format(
+              self.name, self.recorder.framesWritten, self.recordingPath,
+              self.recorder.framesDropped))
+        print('{}: {} events logged, {} waveform blocks received, {} '
+              'configuration changes logged'.format(
+              self.name, len(self.events), self.waveforms.blocks,
+              self.recorder.changeLog.count))
+
+
+class FixtureMetrics(object):
+    """Display and buffer metrics of one FixturePanel in a
+       metrics.Registry, labelled with its name. The buffer depths are read
+       by collect() when the registry is read."""
+
+    def __init__(self, registry, fixture):
+        self.fixture = fixture
+        labels = {'device': fixture.name}
+        self.backlog = registry.histogram('svb_display_backlog_frames',
+            'Frames waiting in the display buffer at each display update',
+            labels, DEPTH_BUCKETS)
+        self.dispatch = registry.histogram('svb_display_dispatch_seconds',
+            'Time spent setting widget properties in one display update',
+            labels, LATENCY_BUCKETS)
+        self.overwritten = registry.gauge('svb_display_overwritten_frames',
+            'Frames overwritten in the display buffer before being read, in '
+            'the current test', labels)
+        self.recorderQueue = registry.gauge('svb_recorder_queue_frames',
+            'Frames waiting to be written to the session file', labels)
+        self.recorderDropped = registry.gauge('svb_recorder_dropped_frames',
+            'Frames dropped by the session recorder in the current test',
+            labels)
+        registry.setCollector('fixture ' + fixture.name, self.collect)
+
+    def collect(self):
+        fixture = self.fixture
+        self.overwritten.set(fixture.frames.overwritten)
+        self.recorderQueue.set(len(fixture.recorder.frames))
+        self.recorderDropped.set(fixture.recorder.framesDropped)
+
+
+class FixtureTabs(TabbedPanel):
+    pass
+
+
 class GateThresholdControls(BoxLayout):
     # Gate threshold in milliseconds
     gateThresholdMillis = NumericProperty(1.0)
@@ -414,7 +974,7 @@ class GateThresholdControls(BoxLayout):
            current threshold value (i.e. as the threshold value gets larger
            variable speed scrolling as the buttons are held down."""
 
-        if app.controlsLayout.testRunning == True:
+        if app.controlsLayout.configLocked():
             return None
 
         if self.gateThresholdMillis >= 0.25:
@@ -425,7 +985,7 @@ class GateThresholdControls(BoxLayout):
     def incrementThreshold(self):
         """Decrements gate threshold"""
 
-        if app.controlsLayout.testRunning == True:
+        if app.controlsLayout.configLocked():
             return None
 
         self.gateThresholdMillis += 0.25
@@ -435,7 +995,7 @@ class GateThresholdControls(BoxLayout):
     def manualEntry(self):
         ''' Allows manual entry of gate threshold value '''
 
-        if app.controlsLayout.testRunning == True:
+        if app.controlsLayout.configLocked():
             return None
 
         popup = Popup(title = 'Enter detection threshold time in ms',
@@ -445,45 +1005,159 @@ class GateThresholdControls(BoxLayout):
 
     def setThreshold(self, popup):
         try:
-            self.gateThresholdMillis = float(popup.content.text)
+            gateThresholdMillis = float(popup.content.text)
         except ValueError:
             return None
+        if gateThresholdMillis < 0:
+            return None
 
+        self.gateThresholdMillis = gateThresholdMillis
         self.gateThresholdMicros = int(self.gateThresholdMillis*1000)
         self.gateThresholdStr = '{:0.3f} ms'.format(self.gateThresholdMillis)
 
+    def on_gateThresholdMicros(self, instance, value):
+        """Sends a new gate threshold to every unit during a test."""
+        if app.controlsLayout.testRunning == True:
+            for fixture in app.controlsLayout.runningFixtures:
+                fixture.changeConfig({'gateThresholdMicros': int(value)})
 
-class LineSeparator(Widget):
-    pass
 
+class HistoryPlot(Widget):
+    """Plot of one analog channel's level (0 to 1023) over time, with a
+       marker above each pixel column in which events were counted.
 
-class PassFailCheckBox(CheckBox):
-    pass
+       The range of the level in each column is drawn as a single triangle
+       strip mesh, so a one-frame excursion still shows as a spike however
+       long the time span, and a redraw costs the same for any span. Event
+       markers are a second mesh of lines."""
+
+    # Threshold values (0 to 1023), drawn as lines across the plot
+    lowThreshold = NumericProperty(0)
+    highThreshold = NumericProperty(1023)
 
+    # Height of the event markers as a fraction of the plot height
+    markerHeight = 0.15
+
+    def __init__(self, **kwargs):
+        Widget.__init__(self, **kwargs)
+        with self.canvas:
+            Color(0, 0.8, 1)
+            self.traceMesh = Mesh(mode='triangle_strip')
+            Color(1, 0, 0)
+            self.markerMesh = Mesh(mode='lines')
+
+    def clear(self):
+        for mesh in (self.traceMesh, self.markerMesh):
+            mesh.vertices = []
+            mesh.indices = []
+
+    def draw(self, mins, maxs, events):
+        """Draws one column per element of the arrays <mins> and <maxs>
+           (the level range in each pixel column, min above max where there
+           is no data) and <events> (the number of events in each)."""
+
+        scale = (self.height * (1 - self.markerHeight)) / 1023.0
+        used = np.flatnonzero(mins <= maxs)
+        x = self.x + used + 0.5
+        bottom = self.y + mins[used] * scale
+        # At least a pixel high, so a flat level is still drawn
+        top = np.maximum(self.y + maxs[used] * scale, bottom + 1)
+
+        # Vertices are x, y, u, v; each column is a bottom and a top vertex
+        vertices = np.zeros((len(used), 2, 4))
+        vertices[:, :, 0] = x[:, None]
+        vertices[:, 0, 1] = bottom
+        vertices[:, 1, 1] = top
+        self.traceMesh.vertices = vertices.ravel().tolist()
+        self.traceMesh.indices = list(range(2 * len(used)))
+
+        marked = self.x + np.flatnonzero(events) + 0.5
+        vertices = np.zeros((len(marked), 2, 4))
+        vertices[:, :, 0] = marked[:, None]
+        vertices[:, 0, 1] = self.top - self.height * self.markerHeight
+        vertices[:, 1, 1] = self.top
+        self.markerMesh.vertices = vertices.ravel().tolist()
+        self.markerMesh.indices = list(range(2 * len(marked)))
 
-class SerialReader(threading.Thread):
-    def __init__(self, q, usb):
-        threading.Thread.__init__(self)
-        self.q = q
-        self.usb = usb
-        self.stopFlag = False
-        self.daemon = True
 
-    def serialRead(self):
-        """Reads one packet of incoming serial data"""
+class LineSeparator(Widget):
+    pass
 
-        data = self.usb.read(COM_CONFIG['FRAMESIZE'])
-        DATAFRAME = np.fromstring(data, dtype=np.uint32)
-        return DATAFRAME
 
-    def run(self):
-        while not self.stopFlag:
-            self.q.put(self.serialRead())
-        print('Reader thread stopping')
+class MetricsOverlay(Label):
+    """Overlay showing the pipeline metrics over the last
+       METRICS_OVERLAY_INTERVAL: serial throughput and read times, display
+       buffer backlog and display update timing. Only updated while
+       shown."""
+
+    def __init__(self, **kwargs):
+        Label.__init__(self, **kwargs)
+        self.previous = {}
+        self.updateTime = None
+
+    def toggle(self):
+        if self.parent is None:
+            self.previous = {}
+            self.updateTime = time()
+            self.update(0)
+            Window.add_widget(self)
+            Clock.schedule_interval(self.update, METRICS_OVERLAY_INTERVAL)
+        else:
+            Clock.unschedule(self.update)
+            Window.remove_widget(self)
+
+    def update(self, dt):
+        now = time()
+        elapsed = max(1e-3, now - self.updateTime)
+        self.updateTime = now
+
+        metrics = app.displayMetrics
+        lines = ['Display update  interval {}  jitter {}  duration {}'.format(
+                 self.histogramText(metrics.interval),
+                 self.histogramText(metrics.jitter),
+                 self.histogramText(metrics.duration))]
+        for fixture in app.fixtures:
+            if fixture.metrics is None:
+                continue
+            deviceMetrics = fixture.device.metrics
+            lines.append('{}  {:.1f} kB/s  {:.0f} frames/s  read {}'.format(
+                fixture.name,
+                self.increase(deviceMetrics.bytes) / elapsed / 1000,
+                self.increase(deviceMetrics.frames) / elapsed,
+                self.histogramText(deviceMetrics.reads)))
+            lines.append('    backlog {}  dispatch {}  recorder queue '
+                         '{}'.format(
+                self.histogramText(fixture.metrics.backlog, 1, ' frames'),
+                self.histogramText(fixture.metrics.dispatch),
+                len(fixture.recorder.frames)))
+        self.text = '\n'.join(lines)
+        self.pos = (0, Window.height - self.height)
+
+    def increase(self, counter):
+        """Returns how much a counter has gone up since the last update."""
+        value = counter.value
+        before = self.previous.get(id(counter), value)
+        self.previous[id(counter)] = value
+        return value - before
+
+    def histogramText(self, histogram, scale=1000.0, unit=' ms'):
+        """Returns the mean and 99th percentile bucket of the values
+           observed since the last update as text."""
+
+        count, mean, bound = summarize(histogram,
+                                       self.previous.get(id(histogram)))
+        self.previous[id(histogram)] = histogram.snapshot()
+        if count == 0:
+            return '-'
+        if bound == float('inf'):
+            p99 = '> {:g}'.format(histogram.bounds[-1]*scale)
+        else:
+            p99 = '<= {:g}'.format(bound*scale)
+        return 'avg {:.2f}{}, p99 {}{}'.format(mean*scale, unit, p99, unit)
 
-    def stop(self):
-        self.stopFlag = True
-        self.usb.close()
+
+class PassFailCheckBox(CheckBox):
+    pass
 
 
 class ThresholdMarker(Image):
@@ -495,45 +1169,70 @@ if DEV_MODE == False:
     Window.fullscreen = True
 
 class ShockVibeBoxApp(App):
+    # Units shown, one entry per fixture (see DEVICES in config.py)
+    devices = DEVICES
+
+    # metrics.Registry and DisplayMetrics, if instrumented (see
+    # METRICS_ENABLED in config.py)
+    metrics = None
+    displayMetrics = None
+
     def build(self):
-        # Top level layout is 3 panel side-by-side box
+        # Top level layout is the fixture channel strips beside the controls
         mainLayout = BoxLayout(orientation='horizontal')
-        discreteLayout = DiscreteLayout(orientation='vertical')
-        analogLayout = AnalogLayout(orientation='vertical')
         self.controlsLayout = ControlsLayout(orientation='vertical')
 
+        # Each fixture has its own set of discrete and analog channel strips.
+        # With more than one fixture, each gets a tab.
+        self.fixtures = [FixturePanel(device, orientation='horizontal')
+                         for device in self.devices]
+        if len(self.fixtures) == 1:
+            self.fixtureTabs = None
+            mainLayout.add_widget(self.fixtures[0])
+        else:
+            self.fixtureTabs = FixtureTabs()
+            for fixture in self.fixtures:
+                tab = TabbedPanelItem(text=fixture.name)
+                tab.add_widget(fixture)
+                self.fixtureTabs.add_widget(tab)
+            self.fixtureTabs.switch_to(self.fixtureTabs.tab_list[-1])
+            mainLayout.add_widget(self.fixtureTabs)
 
-        # Add labels for discrete channels to left half of top level layout
-        discreteLabels = DiscreteLabels()
-        discreteLayout.add_widget(discreteLabels)
-
-        # Add labels for analog channels to left half of top level layout
-        analogLabels = AnalogLabels()
-        analogLayout.add_widget(analogLabels)
-
-        # Add discrete channel strips discrete sublayout
-        self.discreteStrips = []
-        for i in range(8):
-            self.discreteStrips.append(ChannelStripDiscrete())
-        for i in range(len(self.discreteStrips)):
-            self.discreteStrips[i].channelID = i+1
-            discreteLayout.add_widget(self.discreteStrips[i])
-
-        # Add analog channel strips to analog sublayout
-        self.analogStrips = []
-        for i in range(4):
-            self.analogStrips.append(ChannelStripAnalog())
-        for i in range(len(self.analogStrips)):
-            self.analogStrips[i].channelID = i+1
-            analogLayout.add_widget(self.analogStrips[i])
-
-        # Add sublayouts to main layout
-        mainLayout.add_widget(discreteLayout)
-        mainLayout.add_widget(analogLayout)
         mainLayout.add_widget(self.controlsLayout)
 
+        if METRICS_ENABLED:
+            self.instrument(METRICS_PORT)
+
         return mainLayout
 
+    def instrument(self, port):
+        """Starts collecting metrics, served over HTTP on <port> (unless
+           None) and shown in an overlay toggled with F8. If the port cannot
+           be opened (e.g. another instance uses it) the metrics are only
+           shown in the overlay."""
+
+        self.metrics = Registry()
+        self.displayMetrics = DisplayMetrics(self.metrics)
+        self.metricsOverlay = MetricsOverlay()
+        Window.bind(on_key_down=self.onKeyDown)
+        if port is not None:
+            try:
+                self.metricsServer = MetricsServer(self.metrics, port)
+            except OSError as error:
+                print('Warning: cannot serve metrics on port {} ({}), they '
+                      'are only shown in the overlay (F8)'.format(port,
+                                                                 error))
+                return None
+            self.metricsServer.start()
+            print('Serving metrics at http://127.0.0.1:{}/metrics'.format(
+                  port))
+
+    def onKeyDown(self, window, key, scancode, codepoint, modifiers):
+        if key == Keyboard.keycodes['f8']:
+            self.metricsOverlay.toggle()
+            return True
+        return False
+
 
 if __name__ == '__main__':
     app = ShockVibeBoxApp()
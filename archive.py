@@ -0,0 +1,433 @@
+# Compressed archives of recorded sessions, for long-term storage. Frames are
+# very redundant: times go up in near-constant steps and counters rarely
+# change. So an archive stores each frame column separately, in chunks of
+# CHUNK_FRAMES frames. Each column of a chunk is encoded on its own and then
+# compressed with zlib or lzma:
+#
+#   ENCODING_DELTA  the first value and the steps between values (taken
+#                   modulo 2**32), stored as the narrowest of 8, 16 or 32-bit
+#                   signed integers that holds them
+#   ENCODING_RLE    runs of equal values: the run values delta-encoded as
+#                   above, and the run lengths. Used when the column has
+#                   fewer than one run per RLE_MIN_RUN_LENGTH frames.
+#
+# The bytes of the encoded integers are grouped by significance (all low
+# bytes, then all high bytes and so on), which the compressors handle much
+# better than interleaved bytes.
+#
+# Archive file layout:
+#
+#   Offset      Contents
+#   0           Magic bytes b'SVBARC'
+#   6           Format version (<H)
+#   8           Words per frame (<H)
+#   10          Compression (<H, COMPRESSION_ZLIB or COMPRESSION_LZMA)
+#   12          Metadata size in bytes (<L)
+#   16          Metadata, compressed UTF-8 JSON: the session's configuration
+#               header, configuration changes, timebase checkpoints and loop
+#               statistics (see recorder.py)
+#               Chunks, back to back: the compressed columns of each chunk in
+#               column order
+#   indexStart  Chunk index, a compressed array of CHUNK_DTYPE
+#   end - 16    Index offset (<Q), index size in bytes (<L), padding (<L)
+#
+# The index gives the frames and the unwrapped time range (see timebase.py)
+# of each chunk and where each of its columns is, so reading a time range only
+# decompresses the chunks it touches, and only the columns asked for.
+#
+# The size reduction depends mostly on the analog channels: quiet or disabled
+# channels compress to almost nothing, while every enabled channel with a noisy
+# level costs a byte or so per frame.
+#
+# This module must not import Kivy.
+#
+# Usage from the command line:
+#   python archive.py <file> [<file> ...] [--lzma] [--chunk-frames N]
+#                     [--output DIR]
+# Session files (.svb) are archived and archives (.svba) restored to session
+# files, with their changes, timebase and loop statistics logs. Files are
+# written next to the originals unless --output is given.
+
+import argparse
+import json
+import lzma
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from protocol import FRAME_DTYPE, SAMPLESIZE, TIME_COLUMN
+from recorder import (SESSION_EXTENSION, changesPath, loopPath,
+                      timebasePath, writeHeader)
+from session import SessionFile
+from timebase import WRAP_MILLIS, unwrapMillis
+
+ARCHIVE_MAGIC = b'SVBARC'
+ARCHIVE_VERSION = 1
+ARCHIVE_EXTENSION = '.svba'
+ARCHIVE_HEADER_FORMAT = '<6sHHHL'
+ARCHIVE_FOOTER_FORMAT = '<QLL'
+
+# Frames per chunk. Reading any frame decompresses the columns of its whole
+# chunk.
+CHUNK_FRAMES = 65536
+
+# Compressors
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+
+# Column encodings
+ENCODING_DELTA = 1
+ENCODING_RLE = 2
+
+# A column is run-length encoded if its runs are at least this long on average
+RLE_MIN_RUN_LENGTH = 8
+
+# One entry of the chunk index: first frame, frame count, unwrapped time of
+# the first and last frames, file offset of the first column and the
+# compressed size and encoding of each column
+CHUNK_DTYPE = np.dtype([('first', '<i8'),
+                        ('count', '<i8'),
+                        ('startMillis', '<i8'),
+                        ('stopMillis', '<i8'),
+                        ('offset', '<i8'),
+                        ('sizes', '<u4', (SAMPLESIZE,)),
+                        ('encodings', 'u1', (SAMPLESIZE,))])
+
+# Narrowest signed integer types, by size in bytes
+_WIDTHS = (1, 2, 4)
+
+
+def _compress(data, compression):
+    if compression == COMPRESSION_LZMA:
+        return lzma.compress(data)
+    return zlib.compress(data, 9)
+
+
+def _decompress(data, compression):
+    if compression == COMPRESSION_LZMA:
+        return lzma.decompress(data)
+    return zlib.decompress(data)
+
+
+def _packIntegers(values):
+    """Returns an array of signed integers as bytes: the width in bytes,
+       then the values at that width with their bytes grouped by
+       significance."""
+
+    width = 4
+    if len(values):
+        low, high = int(values.min()), int(values.max())
+        for width in _WIDTHS:
+            if -(1 << (8*width - 1)) <= low and high < 1 << (8*width - 1):
+                break
+    packed = values.astype('<i{}'.format(width)).view(np.uint8)
+    return (struct.pack('<B', width) +
+            packed.reshape(-1, width).T.tobytes())
+
+
+def _unpackIntegers(data, pos, count):
+    """Reads <count> integers written by _packIntegers() at <pos>. Returns
+       (int64 array, position after them)."""
+
+    width = bytearray(data[pos:pos + 1])[0]
+    pos += 1
+    planes = np.frombuffer(data, dtype=np.uint8, count=count*width,
+                           offset=pos).reshape(width, count)
+    values = planes.T.copy().view('<i{}'.format(width)).ravel()
+    return values.astype(np.int64), pos + count*width
+
+
+def _steps(values):
+    """Returns the first value and the steps between values of an int64
+       array, as signed 32-bit steps."""
+    steps = np.concatenate((values[:1], np.diff(values)))
+    return (steps + (1 << 31)) % WRAP_MILLIS - (1 << 31)
+
+
+def encodeColumn(values):
+    """Returns (encoding, bytes) for one column of a chunk (a uint32
+       array)."""
+
+    values = values.astype(np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(values)) + 1))
+    if len(starts) * RLE_MIN_RUN_LENGTH <= len(values):
+        lengths = np.diff(np.concatenate((starts, [len(values)])))
+        return ENCODING_RLE, (struct.pack('<L', len(starts)) +
+                              _packIntegers(_steps(values[starts])) +
+                              _packIntegers(lengths))
+    return ENCODING_DELTA, _packIntegers(_steps(values))
+
+
+def decodeColumn(encoding, data, count):
+    """Returns the <count> values (uint32) of a column encoded by
+       encodeColumn()."""
+
+    if encoding == ENCODING_RLE:
+        runs = struct.unpack_from('<L', data)[0]
+        steps, pos = _unpackIntegers(data, 4, runs)
+        lengths = _unpackIntegers(data, pos, runs)[0]
+        values = np.repeat(np.cumsum(steps), lengths)
+    elif encoding == ENCODING_DELTA:
+        values = np.cumsum(_unpackIntegers(data, 0, count)[0])
+    else:
+        raise ValueError('Unknown column encoding {}'.format(encoding))
+    if len(values) != count:
+        raise ValueError('Column holds {} values, expected {}'.format(
+                         len(values), count))
+    return (values % WRAP_MILLIS).astype(FRAME_DTYPE)
+
+
+def archivePath(path, directory=None):
+    """Returns the path of the archive of a session file, next to it or in
+       <directory>."""
+    base = os.path.splitext(path)[0]
+    if directory is not None:
+        base = os.path.join(directory, os.path.basename(base))
+    return base + ARCHIVE_EXTENSION
+
+
+def _makeDirectory(path):
+    """Creates the directory of an output file if needed."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+
+def writeArchive(path, outputPath=None, compression=COMPRESSION_ZLIB,
+                 chunkFrames=CHUNK_FRAMES):
+    """Archives a session file, with its changes, timebase and loop
+       statistics logs. Returns the path of the archive, by default next to
+       the session file. Its directory is created if needed.
+
+       The session is read in chunks from its memory map, so memory use does
+       not depend on its length."""
+
+    if outputPath is None:
+        outputPath = archivePath(path)
+    _makeDirectory(outputPath)
+
+    with SessionFile(path) as session, open(outputPath, 'wb') as f:
+        metadata = _compress(json.dumps(
+            {'config': session.config, 'changes': session.changes,
+             'timebase': session.timebase, 'loopStats': session.loopStats},
+            sort_keys=True).encode('utf-8'),
+            compression)
+        f.write(struct.pack(ARCHIVE_HEADER_FORMAT, ARCHIVE_MAGIC,
+                            ARCHIVE_VERSION, SAMPLESIZE, compression,
+                            len(metadata)))
+        f.write(metadata)
+
+        frames = session.array()
+        index = np.zeros((len(frames) + chunkFrames - 1) // chunkFrames,
+                         dtype=CHUNK_DTYPE)
+        lastMillis = None
+        for i in range(len(index)):
+            first = i * chunkFrames
+            block = np.array(frames[first:first + chunkFrames])
+            times = unwrapMillis(block[:, TIME_COLUMN], lastMillis)
+            lastMillis = int(times[-1])
+            index['first'][i] = first
+            index['count'][i] = len(block)
+            index['startMillis'][i] = times[0]
+            index['stopMillis'][i] = times[-1]
+            index['offset'][i] = f.tell()
+            for column in range(SAMPLESIZE):
+                encoding, data = encodeColumn(block[:, column])
+                data = _compress(data, compression)
+                index['encodings'][i, column] = encoding
+                index['sizes'][i, column] = len(data)
+                f.write(data)
+
+        indexStart = f.tell()
+        indexData = _compress(index.tobytes(), compression)
+        f.write(indexData)
+        f.write(struct.pack(ARCHIVE_FOOTER_FORMAT, indexStart, len(indexData),
+                            0))
+    return outputPath
+
+
+class ArchiveFile(object):
+    """Read access to a session archive.
+
+       self.config, self.changes, self.timebase and self.loopStats are those
+       of the archived session (see session.SessionFile), and self.index the
+       chunk index.
+       Frames are read with timeSlice() or frameSlice(), which decompress
+       only the chunks and columns needed:
+
+           archive = ArchiveFile('recordings/20170301-101500.svba')
+           archive.timeSlice(60000, 120000)          # second minute
+           archive.timeSlice(columns=[TIME_COLUMN])  # all frame times"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        headerSize = struct.calcsize(ARCHIVE_HEADER_FORMAT)
+        magic, version, sampleSize, self.compression, metadataSize = \
+            struct.unpack(ARCHIVE_HEADER_FORMAT, self._file.read(headerSize))
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError('Not a ShockVibeBox archive')
+        if version != ARCHIVE_VERSION or sampleSize != SAMPLESIZE:
+            raise ValueError('Unsupported archive version {} ({} words per '
+                             'frame)'.format(version, sampleSize))
+        metadata = json.loads(_decompress(self._file.read(metadataSize),
+                                          self.compression).decode('utf-8'))
+        self.config = metadata['config']
+        self.changes = metadata['changes']
+        self.timebase = metadata['timebase']
+        self.loopStats = metadata.get('loopStats', [])
+
+        footerSize = struct.calcsize(ARCHIVE_FOOTER_FORMAT)
+        self._file.seek(-footerSize, os.SEEK_END)
+        indexStart, indexSize, _ = struct.unpack(ARCHIVE_FOOTER_FORMAT,
+                                                 self._file.read(footerSize))
+        self._file.seek(indexStart)
+        self.index = np.frombuffer(_decompress(self._file.read(indexSize),
+                                               self.compression),
+                                   dtype=CHUNK_DTYPE)
+
+    def __len__(self):
+        if len(self.index) == 0:
+            return 0
+        return int(self.index['first'][-1] + self.index['count'][-1])
+
+    @property
+    def duration(self):
+        """Time between the first and last frame in milliseconds."""
+        if len(self.index) == 0:
+            return 0
+        return int(self.index['stopMillis'][-1] -
+                   self.index['startMillis'][0])
+
+    def readChunk(self, i, columns=None):
+        """Returns the frames of chunk <i> as an Nx<SAMPLESIZE> uint32 array.
+           Only <columns> (a list of column indices, default all) are
+           decompressed; the others are left zero."""
+
+        chunk = self.index[i]
+        count = int(chunk['count'])
+        ends = np.cumsum(chunk['sizes'].astype(np.int64))
+        frames = np.zeros((count, SAMPLESIZE), dtype=FRAME_DTYPE)
+        for column in range(SAMPLESIZE) if columns is None else columns:
+            size = int(chunk['sizes'][column])
+            self._file.seek(int(chunk['offset']) + int(ends[column]) - size)
+            data = _decompress(self._file.read(size), self.compression)
+            frames[:, column] = decodeColumn(int(chunk['encodings'][column]),
+                                             data, count)
+        return frames
+
+    def frameSlice(self, start=0, stop=None, columns=None):
+        """Returns the frames start to stop as an Nx<SAMPLESIZE> uint32
+           array (see readChunk() for <columns>)."""
+
+        stop = len(self) if stop is None else min(stop, len(self))
+        if stop <= start:
+            return np.zeros((0, SAMPLESIZE), dtype=FRAME_DTYPE)
+        firsts = self.index['first']
+        chunks = range(int(np.searchsorted(firsts, start, 'right')) - 1,
+                       int(np.searchsorted(firsts, stop, 'left')))
+        frames = np.concatenate([self.readChunk(i, columns) for i in chunks])
+        offset = int(firsts[chunks[0]])
+        return frames[start - offset:stop - offset]
+
+    def indexRange(self, startMillis=None, stopMillis=None):
+        """Returns the (start, stop) frame indices covering the unwrapped
+           time range startMillis <= time < stopMillis. Either end may be None
+           for an open range. Only the time columns of the chunks holding
+           the ends are decompressed."""
+
+        start = 0 if startMillis is None else self._search(startMillis)
+        stop = len(self) if stopMillis is None else self._search(stopMillis)
+        return start, max(start, stop)
+
+    def _search(self, millis):
+        """Returns the index of the first frame at or after unwrapped time
+           <millis>."""
+
+        i = int(np.searchsorted(self.index['stopMillis'], millis, 'left'))
+        if i == len(self.index):
+            return len(self)
+        chunk = self.index[i]
+        times = unwrapMillis(self.readChunk(i, [TIME_COLUMN])[:, TIME_COLUMN])
+        times += int(chunk['startMillis']) - times[0]
+        return int(chunk['first']) + int(np.searchsorted(times, millis,
+                                                         'left'))
+
+    def timeSlice(self, startMillis=None, stopMillis=None, columns=None):
+        """Returns the frames with startMillis <= time < stopMillis (unwrapped
+           times) as an Nx<SAMPLESIZE> uint32 array (see readChunk() for
+           <columns>)."""
+        start, stop = self.indexRange(startMillis, stopMillis)
+        return self.frameSlice(start, stop, columns)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def restoreArchive(path, outputPath=None):
+    """Restores the session file of an archive, with its changes, timebase
+       and loop statistics logs. Returns the path of the session file, by
+       default next to the archive. Its directory is created if needed.
+
+       The restored files are identical to the originals, except that a
+       partial frame at the end of the session file is not kept."""
+
+    if outputPath is None:
+        outputPath = os.path.splitext(path)[0] + SESSION_EXTENSION
+    _makeDirectory(outputPath)
+
+    with ArchiveFile(path) as archive:
+        with open(outputPath, 'wb') as f:
+            writeHeader(f, archive.config)
+            for i in range(len(archive.index)):
+                f.write(archive.readChunk(i).tobytes())
+        for entries, logPath in ((archive.changes, changesPath(outputPath)),
+                                 (archive.timebase,
+                                  timebasePath(outputPath)),
+                                 (archive.loopStats, loopPath(outputPath))):
+            if entries:
+                with open(logPath, 'w') as f:
+                    for entry in entries:
+                        f.write(json.dumps(entry, sort_keys=True) + '\n')
+    return outputPath
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Archive session files, or restore archived ones')
+    parser.add_argument('files', nargs='+',
+                        help='session files (.svb) to archive or archives '
+                             '(.svba) to restore')
+    parser.add_argument('--lzma', action='store_true',
+                        help='compress with lzma (smaller, slower) instead '
+                             'of zlib')
+    parser.add_argument('--chunk-frames', type=int, default=CHUNK_FRAMES,
+                        help='frames per chunk (default {})'.format(
+                             CHUNK_FRAMES))
+    parser.add_argument('--output',
+                        help='directory for the written files, created if '
+                             'needed (default next to each file)')
+    args = parser.parse_args()
+
+    compression = COMPRESSION_LZMA if args.lzma else COMPRESSION_ZLIB
+    for path in args.files:
+        if path.endswith(ARCHIVE_EXTENSION):
+            outputPath = None if args.output is None else os.path.join(
+                args.output, os.path.splitext(os.path.basename(path))[0] +
+                SESSION_EXTENSION)
+            print('Restored ' + restoreArchive(path, outputPath))
+            continue
+        outputPath = writeArchive(path, archivePath(path, args.output),
+                                  compression, args.chunk_frames)
+        size = os.path.getsize(path)
+        archived = os.path.getsize(outputPath)
+        print('{}: {} bytes archived to {} bytes ({:.1f}x)'.format(
+              outputPath, size, archived, size / float(max(1, archived))))
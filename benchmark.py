@@ -0,0 +1,237 @@
+# Throughput and latency benchmark for the serial ingest -> UI pipeline:
+#
+#   simulator.py (separate process per unit) -> pty -> DeviceManager
+#       -> FrameRingBuffer -> ControlsLayout.readData
+#
+# The GUI widget tree is built but the Kivy event loop is never started.
+# readData is called directly every DISPLAY_INTERVAL, so no display is
+# needed. Timings therefore include Kivy property dispatch and the kv rules it
+# triggers, but not drawing. Latency is measured on the first unit only.
+#
+# Usage from the command line (Linux only, as the simulator needs a pty):
+#   python benchmark.py [--rates 10,100,1000,5000] [--duration 5]
+#                       [--protocol N] [--waveform-interval MICROS]
+#                       [--devices N] [--metrics]
+#
+# --metrics turns on the pipeline instrumentation (see METRICS_ENABLED in
+# config.py), to measure its overhead.
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+# Kivy must not parse our command line, and the kv file and images are
+# loaded relative to the application directory
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+
+import ShockVibeBox
+from devices import STATE_RUNNING, Device, DeviceManager
+from framebuffer import FrameRingBuffer
+from history import LevelHistory
+from protocol import PROTOCOL_VERSION, TIME_COLUMN
+from rollingstats import RollingStats
+from simulator import BOOT_MILLIS, VirtualShockVibeBox
+from waveform import WaveformBuffer
+
+# Configuration sent to the simulator: every channel enabled
+BENCHMARK_CONFIG = {
+    'discreteConfig': [1]*8,
+    'analogConfig': [2]*4,
+    'analogLowThreshold': [100]*4,
+    'analogHighThreshold': [900]*4,
+    'gateThresholdMicros': 1000,
+    'triggerDurationMicros': 1000 }
+
+
+class TimedRingBuffer(FrameRingBuffer):
+    """FrameRingBuffer that remembers the time of each frame handed to the UI."""
+
+    def __init__(self, *args, **kwargs):
+        FrameRingBuffer.__init__(self, *args, **kwargs)
+        self.displayed = []
+
+    def latest(self):
+        dataframe = FrameRingBuffer.latest(self)
+        if dataframe is not None:
+            self.displayed.append(int(dataframe[TIME_COLUMN]))
+        return dataframe
+
+
+def simulate(rate, connection, startTime, framesSent, stopEvent):
+    """Runs the simulator in a child process, so its CPU use is not counted."""
+
+    device = VirtualShockVibeBox(rate, seed=0)
+    device.start()
+    connection.send(device.portName)
+    while not stopEvent.wait(0.05):
+        startTime.value = device.startTime
+        framesSent.value = device.framesSent
+    device.stop()
+
+
+def buildGui(devices=1, metrics=False):
+    """Builds the GUI widget tree for <devices> units without starting the
+       Kivy event loop, with the pipeline instrumented if <metrics> is
+       true."""
+
+    app = ShockVibeBox.ShockVibeBoxApp()
+    app.devices = [{'name': 'Unit {}'.format(i + 1), 'port': None}
+                   for i in range(devices)]
+    ShockVibeBox.app = app
+    app.load_kv(filename='ShockVibeBox.kv')
+    app.build()
+    if metrics:
+        app.instrument(None)
+    return app
+
+
+def runStage(app, rate, duration, protocolVersion, waveformIntervalMicros=0):
+    """Drives the pipeline of every unit in the GUI at <rate> frames/s for
+       <duration> seconds, using the given serial protocol version and
+       waveform capture interval.
+
+       Returns a dict of results."""
+
+    controls = app.controlsLayout
+    manager = DeviceManager()
+    simulators = []
+    for fixture in app.fixtures:
+        connection, childConnection = multiprocessing.Pipe()
+        startTime = multiprocessing.Value('d', 0.0)
+        framesSent = multiprocessing.Value('l', 0)
+        stopEvent = multiprocessing.Event()
+        process = multiprocessing.Process(target=simulate, args=(rate,
+            childConnection, startTime, framesSent, stopEvent))
+        process.start()
+        simulators.append((process, startTime, framesSent, stopEvent))
+
+        fixture.frames = TimedRingBuffer(ShockVibeBox.FRAME_BUFFER_SIZE)
+        fixture.waveforms = WaveformBuffer(
+            ShockVibeBox.WAVEFORM_WINDOW_SAMPLES)
+        fixture.stats = RollingStats()
+        fixture.history = LevelHistory()
+        fixture.device = Device(fixture.name, connection.recv(),
+            BENCHMARK_CONFIG, [fixture.frames, fixture.stats,
+                               fixture.history],
+            protocolVersion, waveformIntervalMicros, [fixture.waveforms])
+        if app.metrics is not None:
+            fixture.device.instrument(app.metrics)
+            fixture.metrics = ShockVibeBox.FixtureMetrics(app.metrics,
+                                                          fixture)
+        manager.add(fixture.device)
+    devices = list(manager.devices)
+    manager.start()
+    # Frames sent before the handshake completed are discarded, so only count
+    # from when every unit is connected
+    while not all(device.state == STATE_RUNNING for device in devices):
+        time.sleep(0.05)
+    sentBefore = sum(simulator[2].value for simulator in simulators)
+    receivedBefore = sum(device.frameCount for device in devices)
+    controls.runningFixtures = app.fixtures
+    controls.resetDisplay()
+
+    fixture = app.fixtures[0]
+    startTime = simulators[0][1]
+    tickDurations = []
+    latencies = []
+    cpuStart = time.process_time()
+    wallStart = time.time()
+    nextTick = wallStart
+    while time.time() - wallStart < duration:
+        nextTick += ShockVibeBox.DISPLAY_INTERVAL
+        time.sleep(max(0.0, nextTick - time.time()))
+
+        displayed = len(fixture.frames.displayed)
+        tickStart = time.perf_counter()
+        controls.readData(ShockVibeBox.DISPLAY_INTERVAL)
+        tickDurations.append(time.perf_counter() - tickStart)
+
+        # Latency from when the simulator emitted the frame to when its values
+        # were set on the widgets. Frame times start from zero at the first
+        # frame received.
+        if len(fixture.frames.displayed) > displayed:
+            emitted = (startTime.value +
+                (fixture.frames.displayed[-1] +
+                 fixture.device.stitcher.originMillis - BOOT_MILLIS) / 1000.0)
+            latencies.append(time.time() - emitted)
+
+    wallTime = time.time() - wallStart
+    cpuTime = time.process_time() - cpuStart
+    received = sum(device.frameCount for device in devices) - receivedBefore
+    sent = sum(simulator[2].value for simulator in simulators) - sentBefore
+
+    manager.stop()
+    manager.join(1.0)
+    for process, startTime, framesSent, stopEvent in simulators:
+        stopEvent.set()
+        process.join()
+
+    latencies = np.array(latencies) * 1000.0 if latencies else np.zeros(1)
+    tickDurations = np.array(tickDurations) * 1000.0
+    return {
+        'rate': rate,
+        'devices': len(devices),
+        'sent': sent,
+        'received': received,
+        'lost': max(0, sent - received),
+        'overwritten': sum(fixture.frames.overwritten
+                           for fixture in app.fixtures),
+        'resyncs': sum(device.stat('resyncs') for device in devices),
+        'framesPerSecond': received / wallTime,
+        'latencyMillis': np.percentile(latencies, [50, 90, 99, 100]),
+        'tickMillis': (tickDurations.mean(), tickDurations.max()),
+        'cpuMicrosPerFrame': cpuTime * 1e6 / max(1, received),
+        'cpuPercent': cpuTime * 100.0 / wallTime }
+
+
+def printResults(results):
+    print('{:>5} {:>7} {:>9} {:>8} {:>6} {:>11} {:>7} {:>21} {:>13} {:>9} '
+          '{:>6}'.format(
+          'units', 'rate', 'frames/s', 'received', 'lost', 'overwritten',
+          'resyncs', 'latency ms p50/90/99', 'tick ms avg/max', 'cpu us/fr',
+          'cpu %'))
+    for result in results:
+        print('{:>5d} {:>7.0f} {:>9.1f} {:>8d} {:>6d} {:>11d} {:>7d} {:>21} '
+              '{:>13} {:>9.1f} {:>6.1f}'.format(
+              result['devices'], result['rate'], result['framesPerSecond'],
+              result['received'],
+              result['lost'], result['overwritten'], result['resyncs'],
+              '{:.1f}/{:.1f}/{:.1f}'.format(*result['latencyMillis'][:3]),
+              '{:.2f}/{:.2f}'.format(*result['tickMillis']),
+              result['cpuMicrosPerFrame'], result['cpuPercent']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the serial ingest -> UI pipeline')
+    parser.add_argument('--rates', default='10,100,1000,5000',
+                        help='comma-separated frame rates to test (frames/s)')
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='seconds per rate (default 5)')
+    parser.add_argument('--protocol', type=int, default=PROTOCOL_VERSION,
+                        help='serial protocol version (default {})'.format(
+                            PROTOCOL_VERSION))
+    parser.add_argument('--waveform-interval', type=int, default=0,
+                        help='waveform capture sample interval in '
+                             'microseconds (default 0, off)')
+    parser.add_argument('--devices', type=int, default=1,
+                        help='number of simulated units (default 1)')
+    parser.add_argument('--metrics', action='store_true',
+                        help='instrument the pipeline')
+    args = parser.parse_args()
+
+    if not sys.platform.startswith('linux'):
+        print('The benchmark needs a pseudo-terminal and only runs on Linux')
+        raise SystemExit(1)
+
+    app = buildGui(args.devices, args.metrics)
+    results = []
+    for rate in [float(rate) for rate in args.rates.split(',')]:
+        results.append(runStage(app, rate, args.duration, args.protocol,
+                                args.waveform_interval))
+    printResults(results)
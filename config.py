@@ -1,8 +1,13 @@
 # This file contains all of the configuration values that must be set by the
 # user for each installation.
 
-# COM_PORT defines the serial port used. On Windows this will be 'COM#'.
-COM_PORT = 'COM3'
+# DEVICES lists the ShockVibeBox units run from this PC, one entry per
+# fixture. 'port' is the serial port the unit is on; on Windows this will be
+# 'COM#'. 'name' labels the unit's tab (shown when there is more than one
+# unit) and its session recordings. For example:
+#   DEVICES = [{'name': 'Table 1', 'port': 'COM3'},
+#              {'name': 'Table 2', 'port': 'COM4'}]
+DEVICES = [{'name': 'Table 1', 'port': 'COM3'}]
 
 # Set to false for normal use (fullsceen). Set to true when you want the GUI
 # to launch as a floating window (e.g. development using a screen with a
@@ -15,3 +20,26 @@ SCREEN_RES = (1366, 768)
 # The duration of the 3.3V output in milliseconds (for triggering external
 # devices when events are logged).
 TRIGGER_DURATION = 1
+
+# Directory where every test is recorded to a session file. Relative paths are
+# relative to the directory the application is launched from.
+RECORDING_DIR = 'recordings'
+
+# Interval in microseconds between analog samples in waveform capture mode
+# (100 to 25500, in steps of 100), or 0 to turn waveform capture off. All
+# enabled analog channels are sampled at this rate and their min/max/RMS is
+# shown next to each analog level.
+WAVEFORM_INTERVAL_MICROS = 2000
+
+# Instrumentation of the acquisition pipeline (serial throughput and read
+# times, buffer depths and display update timing). When True, F8 shows or
+# hides an overlay of the metrics and they are served in Prometheus text
+# format at http://127.0.0.1:<METRICS_PORT>/metrics (None for no HTTP
+# endpoint). When False nothing is measured.
+METRICS_ENABLED = False
+METRICS_PORT = 9105
+
+# Time span in seconds of the level history plot under each analog meter, or
+# None to plot the whole test so far. Either way every pixel column shows the
+# full range of the level within it, so brief excursions are not hidden.
+HISTORY_PLOT_SECONDS = None
@@ -0,0 +1,674 @@
+# Serial acquisition from one or more ShockVibeBox units. One DeviceManager
+# thread services every unit: each pass it reads whatever has arrived on each
+# port without blocking, decodes it and hands the frames to that unit's sinks,
+# then sleeps until the next batch. Adding units adds no threads and no
+# wakeups, only the work of decoding their data.
+#
+# Connecting is done on the same thread, also without blocking: each Device
+# steps through opening its port, the configuration handshake and reading,
+# and starts again from opening the port whenever its link fails or stalls.
+# The Arduino restarts its test (elapsed time and counters from zero) every
+# time the port is opened, so frames received after a reconnect are stitched
+# onto the ones before and totals keep growing from where they were. Frame
+# times start from zero at the start of the test, and each Device fits them
+# against the PC clock (see timebase.py) so they can be matched with other
+# logs.
+#
+# Configuration changes made during a test are sent to the unit as command
+# packets (protocol v4) without a reset. Each one is reported to the device's
+# change sinks, with the time of the frame it took effect after, so the session
+# record shows what every frame was measured with. Changes the unit is not
+# known to be using (rejected, never acknowledged, or waiting for the next
+# connection) are kept until it is, so the GUI can show them.
+#
+# From protocol v5 the unit also reports how long each scan of its inputs
+# takes. The gate threshold time can only be resolved to about one scan, so a
+# warning is printed whenever the longest scan exceeds it.
+#
+# This module must not import Kivy.
+
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+from time import monotonic, perf_counter, sleep
+
+import numpy as np
+import serial
+
+from events import CHANNEL_NAMES
+from metrics import LATENCY_BUCKETS
+from protocol import (ACK_APPLIED, BAUDRATE, COUNTER_COLUMNS, FRAME_DTYPE,
+                      PROTOCOL_VERSION, SAMPLESIZE, TIME_COLUMN, FrameDecoder,
+                      Handshake, PacketDecoder, PacketEncoder, applyChange,
+                      packCommand)
+from timebase import WRAP_MILLIS, Timebase, unwrapTime
+
+# Loop statistics kept in the loop statistics log and metrics
+LOOP_STATS = ('minMicros', 'meanMicros', 'maxMicros')
+
+# Minimum time in seconds between serial reads. Reading (and decoding) in
+# batches rather than as each packet arrives keeps the per-read overhead low at
+# high frame rates. Must be well below the display update interval.
+READ_BATCH_INTERVAL = 0.02
+
+# Time in seconds to wait after opening a port before the handshake (the
+# Arduino resets when the port is opened), and after the handshake before
+# reading frames
+PORT_OPEN_DELAY = 0.5
+SETTLE_DELAY = 0.25
+
+# Time in seconds to wait for the reply to the handshake
+HANDSHAKE_TIMEOUT = 1.0
+
+# A link that has received nothing for this many seconds is treated as lost.
+# The sketch sends at least one frame or keyframe a second.
+STALL_TIMEOUT = 3.0
+
+# Time in seconds before the first attempt to reconnect a lost link. Every
+# failed attempt doubles it, up to MAX_RECONNECT_DELAY.
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 30.0
+
+# Time in seconds to wait for a command to be acknowledged before sending it
+# again, and the number of times it is sent
+COMMAND_TIMEOUT = 1.0
+COMMAND_ATTEMPTS = 3
+
+# Outcomes of a configuration change: applied by the running unit, rejected by
+# it, sent with the configuration at the next connection (the unit was not
+# connected, or its firmware only reads the configuration at the start), or
+# never acknowledged
+CHANGE_APPLIED = 'applied'
+CHANGE_REJECTED = 'rejected'
+CHANGE_DEFERRED = 'deferred'
+CHANGE_UNACKNOWLEDGED = 'unacknowledged'
+
+# Setting changed by a change without a channel (see changeKey())
+GATE_SETTING = 'gateThresholdMicros'
+
+# Connection states of a Device
+STATE_CONNECTING = 'connecting'
+STATE_RESETTING = 'resetting'
+STATE_HANDSHAKE = 'handshake'
+STATE_SETTLING = 'settling'
+STATE_RUNNING = 'running'
+STATE_CLOSED = 'closed'
+
+# Decoder statistics summed over every connection of a Device
+DECODER_STATS = ('frameCount', 'resyncs', 'discardedBytes', 'crcErrors',
+                 'lostPackets', 'waveformBlocks')
+
+# Frame columns that restart from zero when the Arduino resets
+_STITCHED_COLUMNS = [TIME_COLUMN] + COUNTER_COLUMNS
+
+
+class CounterStitcher(object):
+    """Keeps elapsed time and event counters continuous across Arduino
+       resets.
+
+       The elapsed time is offset to start from zero at the first frame
+       (self.originMillis is that frame's own time). After resume(), the
+       first frames are compared with the last ones before. If the unit has
+       restarted (its elapsed time went back), the new counters are offset
+       by the totals reached before, and the elapsed time by the time
+       reached plus <gapMillis>, the time the link was down. Times are offset
+       modulo 2**32, so they wrap like the Arduino's own (see timebase.py)."""
+
+    def __init__(self):
+        self._offsets = np.zeros(SAMPLESIZE, dtype=FRAME_DTYPE)
+        self._last = None
+        self._lastRawTime = None
+        self._gapMillis = None
+        self.originMillis = None
+
+    def resume(self, gapMillis):
+        self._gapMillis = gapMillis
+
+    def stitch(self, frames):
+        """Returns an Nx<SAMPLESIZE> array of frames with the offsets
+           applied."""
+
+        firstTime = int(frames[0, TIME_COLUMN])
+        if self._last is None:
+            self.originMillis = firstTime
+            self._offsets[TIME_COLUMN] = -firstTime % WRAP_MILLIS
+        elif self._gapMillis is not None and firstTime < self._lastRawTime:
+            self._offsets[_STITCHED_COLUMNS] = self._last[_STITCHED_COLUMNS]
+            self._offsets[TIME_COLUMN] = ((int(self._last[TIME_COLUMN]) +
+                                           self._gapMillis - firstTime) %
+                                          WRAP_MILLIS)
+        self._gapMillis = None
+        self._lastRawTime = int(frames[-1, TIME_COLUMN])
+
+        if self._offsets.any():
+            frames = frames + self._offsets
+        self._last = frames[-1].copy()
+        return frames
+
+    def stitchTime(self, millis):
+        """Returns an elapsed time from the current connection on the
+           stitched timebase."""
+        return (int(millis) + int(self._offsets[TIME_COLUMN])) % WRAP_MILLIS
+
+
+def describeChange(change):
+    """Returns a configuration change (see protocol.packCommand) as
+       printable text."""
+
+    if 'gateThresholdMicros' in change:
+        return 'gate threshold {} us'.format(change['gateThresholdMicros'])
+    text = '{} config {}'.format(CHANNEL_NAMES[change['channel']],
+                                 change['config'])
+    if 'lowThreshold' in change:
+        text += ', window {}-{}'.format(change['lowThreshold'],
+                                        change['highThreshold'])
+    return text
+
+
+def changeKey(change):
+    """Returns the setting a configuration change is to: its event channel
+       (0-11), or GATE_SETTING."""
+    return change.get('channel', GATE_SETTING)
+
+
+class DeviceMetrics(object):
+    """Metrics of one Device in a metrics.Registry, labelled with its
+       name.
+
+       The serial byte and frame counters and the read latency histogram are
+       updated by Device._read. The decoder and connection statistics are
+       copied into gauges by collect() when the registry is read, so they
+       cost nothing while reading."""
+
+    def __init__(self, registry, device):
+        self.device = device
+        labels = {'device': device.name}
+        self.bytes = registry.counter('svb_serial_bytes_total',
+            'Bytes read from the serial port', labels)
+        self.frames = registry.counter('svb_frames_total',
+            'Frames decoded', labels)
+        self.reads = registry.histogram('svb_serial_read_seconds',
+            'Time to read, decode and dispatch one batch of serial data',
+            labels, LATENCY_BUCKETS)
+        self.stats = dict((stat, registry.gauge('svb_decoder_' + stat,
+            'Decoder statistic {} in the current test'.format(stat), labels))
+            for stat in DECODER_STATS)
+        self.running = registry.gauge('svb_connected',
+            '1 while the unit is connected and sending frames', labels)
+        self.reconnects = registry.gauge('svb_reconnects',
+            'Reconnects in the current test', labels)
+        self.downtime = registry.gauge('svb_downtime_seconds',
+            'Time the link has been down in the current test', labels)
+        self.scans = dict((stat, registry.gauge(
+            'svb_scan_{}_seconds'.format(stat[:-len('Micros')]),
+            'Scan time of the sketch loop ({}) over the last second'.format(
+                stat[:-len('Micros')]), labels)) for stat in LOOP_STATS)
+        registry.setCollector(device.name, self.collect)
+
+    def collect(self):
+        device = self.device
+        for stat, gauge in self.stats.items():
+            gauge.set(device.stat(stat))
+        self.running.set(int(device.state == STATE_RUNNING))
+        self.reconnects.set(device.reconnects)
+        downtime = device.downtime
+        downSince = device.downSince
+        if downSince is not None:
+            downtime += monotonic() - downSince
+        self.downtime.set(downtime)
+        loopStats = device.loopStats
+        if loopStats is not None:
+            for stat, gauge in self.scans.items():
+                gauge.set(loopStats[stat] / 1e6)
+
+
+class Device(object):
+    """One ShockVibeBox unit on serial port <port>, running the test
+       configuration <config> (see protocol.packConfig).
+
+       <sinks> are objects with a write() method that receives each batch of
+       decoded frames (an Nx<SAMPLESIZE> array). <waveformSinks> receive
+       each list of waveform blocks (protocol v3 waveform capture), and
+       <changeSinks> each list of configuration changes made with
+       configure(), <timebaseSinks> each list of checkpoints of
+       self.timebase (see timebase.Timebase), and <loopSinks> each list of
+       loop statistics (protocol v5), as dicts with the unwrapped 'time' and
+       the fields of protocol.LoopStats. Frames from every connection
+       to the unit are stitched together, so the sinks see one continuous
+       test.
+
+       Only configure(), acceptsChanges, unconfirmed(), status() and the
+       statistics may be used from other threads than the DeviceManager's. instrument() adds the device's
+       metrics to a metrics.Registry; until then nothing is measured."""
+
+    def __init__(self, name, port, config, sinks,
+                 protocolVersion=PROTOCOL_VERSION, waveformIntervalMicros=0,
+                 waveformSinks=(), changeSinks=(), timebaseSinks=(),
+                 loopSinks=()):
+        self.name = name
+        self.port = port
+        self.config = config
+        self.sinks = sinks
+        self.requestedVersion = protocolVersion
+        self.waveformIntervalMicros = waveformIntervalMicros
+        self.waveformSinks = waveformSinks
+        self.changeSinks = changeSinks
+        self.loopSinks = loopSinks
+
+        self.usb = None
+        self.decoder = None
+        self.protocolVersion = None
+        self.state = STATE_CONNECTING
+        self.stitcher = CounterStitcher()
+        self.timebase = Timebase(timebaseSinks)
+        self._stateTime = 0.0
+        self._retryTime = 0.0
+        self._reconnectDelay = RECONNECT_DELAY
+        self._handshake = None
+        self._lastDataTime = None
+        self._lastFrameTime = None
+        self._totals = dict((stat, 0) for stat in DECODER_STATS)
+
+        # Configuration changes waiting to be sent, and those sent but not
+        # yet acknowledged: (change, time sent, attempts) by sequence number
+        self._changes = deque()
+        self._awaiting = OrderedDict()
+        self._commandEncoder = PacketEncoder()
+
+        # Outcome of the last change to each setting the unit is not known
+        # to be using, and the number of connections made when it was
+        # reported (see unconfirmed())
+        self._unconfirmed = {}
+        self._unconfirmedLock = threading.Lock()
+
+        # Successful connections, the time the link went down (None while it
+        # is up, and before the first connection) and the total downtime in
+        # seconds of earlier outages
+        self.connections = 0
+        self.downSince = None
+        self.downtime = 0.0
+        self.metrics = None
+
+        # Latest loop statistics entry, and the longest scan in microseconds
+        # so far (None before the first)
+        self.loopStats = None
+        self.maxLoopMicros = None
+        self._loopWarnedGate = None
+
+    def instrument(self, registry):
+        self.metrics = DeviceMetrics(registry, self)
+
+    def configure(self, change):
+        """Changes the configuration of the running test (see
+           protocol.packCommand for <change>). May be called from any thread.
+
+           The change is sent to the unit on the next poll, and reported to
+           the change sinks once the unit acknowledges it, with the time of
+           the last frame measured with the old configuration. Later
+           connections use the new configuration. Raises ValueError if the
+           change is invalid."""
+
+        packCommand(change)
+        self._changes.append(dict(change))
+
+    @property
+    def acceptsChanges(self):
+        """False if the unit's firmware cannot change its configuration
+           during a test (protocol below v4), as agreed on the last
+           connection or, before the first, as requested."""
+
+        version = self.protocolVersion
+        if version is None:
+            version = self.requestedVersion
+        return version >= 4
+
+    def unconfirmed(self, key):
+        """Returns the outcome (CHANGE_REJECTED, CHANGE_DEFERRED or
+           CHANGE_UNACKNOWLEDGED) of the last change to a setting (see
+           changeKey()) if the unit is not known to be using it, or None.
+
+           Such a change stays unconfirmed until a later change to the same
+           setting is applied, or until the unit reconnects, as every
+           connection sends it the whole configuration."""
+
+        with self._unconfirmedLock:
+            if key not in self._unconfirmed:
+                return None
+            status, connections = self._unconfirmed[key]
+            if self.connections > connections:
+                del self._unconfirmed[key]
+                return None
+            return status
+
+    def poll(self, now):
+        """Advances the connection by one step without blocking. Once
+           connected, reads and decodes the serial data that has arrived and
+           passes it on to the sinks. <now> is time.monotonic(), so that
+           clock changes on the PC do not upset the timeouts."""
+
+        try:
+            if self._changes or self._awaiting:
+                self._command(now)
+            if self.state == STATE_RUNNING:
+                self._read(now)
+            elif self.state == STATE_CONNECTING and now >= self._retryTime:
+                self.usb = serial.Serial(self.port, BAUDRATE, timeout=0)
+                self._enter(STATE_RESETTING, now)
+            elif (self.state == STATE_RESETTING and
+                  now - self._stateTime >= PORT_OPEN_DELAY):
+                # Anything already received predates the handshake
+                self.usb.reset_input_buffer()
+                self._handshake = Handshake(self.config,
+                    self.requestedVersion, self.waveformIntervalMicros)
+                self.usb.write(self._handshake.request)
+                self._enter(STATE_HANDSHAKE, now)
+            elif self.state == STATE_HANDSHAKE:
+                self._negotiate(now)
+            elif (self.state == STATE_SETTLING and
+                  now - self._stateTime >= SETTLE_DELAY):
+                self.usb.reset_input_buffer()
+                self._connected(now)
+        except (serial.SerialException, OSError, ValueError) as error:
+            self._fail(now, error)
+
+    def _enter(self, state, now):
+        self.state = state
+        self._stateTime = now
+
+    def _negotiate(self, now):
+        agreed = self._handshake.feed(self.usb.read(self.usb.in_waiting))
+        if agreed is None and now - self._stateTime >= HANDSHAKE_TIMEOUT:
+            agreed = 1
+        if agreed is None:
+            return None
+
+        self.protocolVersion = agreed
+        previous = self.decoder
+        self.decoder = PacketDecoder() if agreed >= 2 else FrameDecoder()
+        if previous is not None:
+            for stat in DECODER_STATS:
+                self._totals[stat] += getattr(previous, stat, 0)
+        print('{}: using serial protocol version {}'.format(self.name,
+                                                           agreed))
+        self._enter(STATE_SETTLING, now)
+
+    def _command(self, now):
+        """Sends queued configuration changes to the running unit, and
+           sends again any that have not been acknowledged in time. While
+           the handshake is under way changes wait, so they are not missed
+           by the configuration it sends."""
+
+        running = self.state == STATE_RUNNING
+        if running or self.state in (STATE_CONNECTING, STATE_RESETTING):
+            while self._changes:
+                change = self._changes.popleft()
+                self.config = applyChange(self.config, change)
+                if running and self.protocolVersion >= 4:
+                    self._send(change, now, 1)
+                else:
+                    self._logChange(change, CHANGE_DEFERRED)
+
+        for sequence, (change, sent, attempts) in list(
+                self._awaiting.items()):
+            if now - sent < COMMAND_TIMEOUT:
+                continue
+            del self._awaiting[sequence]
+            if attempts < COMMAND_ATTEMPTS:
+                self._send(change, now, attempts + 1)
+            else:
+                self._logChange(change, CHANGE_UNACKNOWLEDGED)
+
+    def _send(self, change, now, attempts):
+        packet, sequence = self._commandEncoder.encodeCommand(change)
+        self._awaiting[sequence] = (change, now, attempts)
+        self.usb.write(packet)
+
+    def _acknowledge(self, acks):
+        for ack in acks:
+            if ack.sequence not in self._awaiting:
+                continue
+            change = self._awaiting.pop(ack.sequence)[0]
+            if ack.status == ACK_APPLIED:
+                self._logChange(change, CHANGE_APPLIED, unwrapTime(
+                    self.stitcher.stitchTime(ack.time),
+                    self.timebase.lastMillis))
+            else:
+                self._logChange(change, CHANGE_REJECTED)
+
+    def _logChange(self, change, status, timeMillis=None):
+        """Reports a configuration change to the change sinks.
+           <timeMillis> is the elapsed time of the last frame before the
+           change, or None if it was not applied to the running test."""
+
+        print('{}: {} {}'.format(self.name, describeChange(change), status))
+        with self._unconfirmedLock:
+            if status == CHANGE_APPLIED:
+                self._unconfirmed.pop(changeKey(change), None)
+            else:
+                self._unconfirmed[changeKey(change)] = (status,
+                                                        self.connections)
+        entry = {'time': timeMillis, 'hostTime': datetime.now().isoformat(),
+                 'change': change, 'status': status}
+        for sink in self.changeSinks:
+            sink.write([entry])
+
+    def _logLoopStats(self, loopStats):
+        """Reports loop statistics to the loop sinks, and warns the first
+           time a scan is longer than each gate threshold time."""
+
+        entries = []
+        for stats in loopStats:
+            entry = {'time': unwrapTime(self.stitcher.stitchTime(stats.time),
+                                        self.timebase.lastMillis),
+                     'scans': stats.scans}
+            for stat in LOOP_STATS:
+                entry[stat] = getattr(stats, stat)
+            entries.append(entry)
+            self.maxLoopMicros = max(self.maxLoopMicros or 0, stats.maxMicros)
+        self.loopStats = entries[-1]
+        for sink in self.loopSinks:
+            sink.write(entries)
+
+        gate = self.config['gateThresholdMicros']
+        if self.maxLoopMicros > gate and gate != self._loopWarnedGate:
+            print('{}: scans of up to {} us are longer than the gate '
+                  'threshold of {} us, so shorter dropouts may be '
+                  'missed'.format(self.name, self.maxLoopMicros, gate))
+            self._loopWarnedGate = gate
+
+    def _connected(self, now):
+        if self.downSince is not None:
+            print('{}: reconnected after {:.1f} s'.format(
+                  self.name, now - self.downSince))
+            self.downtime += now - self.downSince
+            self.downSince = None
+        if self._lastFrameTime is not None:
+            self.stitcher.resume(int((now - self._lastFrameTime) * 1000))
+            self.timebase.resume()
+        self.connections += 1
+        self._reconnectDelay = RECONNECT_DELAY
+        self._lastDataTime = now
+        self._enter(STATE_RUNNING, now)
+
+    def _read(self, now):
+        metrics = self.metrics
+        if metrics is not None:
+            readStart = perf_counter()
+        waiting = self.usb.in_waiting
+        if waiting == 0:
+            if now - self._lastDataTime > STALL_TIMEOUT:
+                raise serial.SerialException('no data for {:.0f} s'.format(
+                                             now - self._lastDataTime))
+            return None
+        self._lastDataTime = now
+
+        data = self.usb.read(waiting)
+        dataframes = self.decoder.feed(data)
+        if len(dataframes) > 0:
+            dataframes = self.stitcher.stitch(dataframes)
+            self._lastFrameTime = now
+            self.timebase.update(dataframes[-1, TIME_COLUMN], monotonic())
+            for sink in self.sinks:
+                sink.write(dataframes)
+        if isinstance(self.decoder, PacketDecoder):
+            blocks = self.decoder.takeWaveforms()
+            if blocks:
+                for sink in self.waveformSinks:
+                    sink.write(blocks)
+            acks = self.decoder.takeAcks()
+            if acks:
+                self._acknowledge(acks)
+            loopStats = self.decoder.takeLoopStats()
+            if loopStats:
+                self._logLoopStats(loopStats)
+        if metrics is not None:
+            metrics.bytes.inc(len(data))
+            metrics.frames.inc(len(dataframes))
+            metrics.reads.observe(perf_counter() - readStart)
+
+    def _fail(self, now, error):
+        """Closes the port after an error and schedules the next attempt to
+           connect, backing off after each failed attempt."""
+
+        if self.state == STATE_RUNNING:
+            # The link has been down since it last received anything
+            print('{}: link lost ({}), reconnecting'.format(self.name, error))
+            self.downSince = self._lastDataTime
+        elif self._reconnectDelay == RECONNECT_DELAY:
+            print('{}: could not connect on {} ({}), retrying'.format(
+                  self.name, self.port, error))
+        self._closePort()
+        self._deferAwaiting()
+        self._retryTime = now + self._reconnectDelay
+        self._reconnectDelay = min(MAX_RECONNECT_DELAY,
+                                   self._reconnectDelay * 2)
+        self._enter(STATE_CONNECTING, now)
+
+    def _closePort(self):
+        if self.usb is not None:
+            try:
+                self.usb.close()
+            except (serial.SerialException, OSError):
+                pass
+            self.usb = None
+
+    def _deferAwaiting(self):
+        """Changes still awaiting acknowledgement when the link goes down
+           are sent with the configuration when it reconnects."""
+        for change, sent, attempts in self._awaiting.values():
+            self._logChange(change, CHANGE_DEFERRED)
+        self._awaiting.clear()
+
+    def close(self):
+        self._closePort()
+        self.timebase.close()
+        for change, sent, attempts in self._awaiting.values():
+            self._logChange(change, CHANGE_UNACKNOWLEDGED)
+        self._awaiting.clear()
+        while self._changes:
+            self._logChange(self._changes.popleft(), CHANGE_UNACKNOWLEDGED)
+        if self.downSince is not None:
+            self.downtime += monotonic() - self.downSince
+            self.downSince = None
+        self.state = STATE_CLOSED
+
+    def stat(self, name):
+        """Returns a decoder statistic (one of DECODER_STATS) summed over
+           every connection."""
+
+        decoder = self.decoder
+        current = getattr(decoder, name, 0) if decoder is not None else 0
+        return self._totals[name] + current
+
+    @property
+    def frameCount(self):
+        return self.stat('frameCount')
+
+    @property
+    def reconnects(self):
+        return max(0, self.connections - 1)
+
+    def status(self):
+        """Returns the connection state as a short line of text, with the
+           number of reconnects and the total downtime so far."""
+
+        if self.state == STATE_RUNNING:
+            text = 'connected'
+        elif self.state == STATE_CLOSED:
+            text = 'closed'
+        elif self.connections == 0:
+            text = 'connecting'
+        else:
+            text = 'reconnecting'
+
+        downSince = self.downSince
+        downtime = self.downtime
+        if downSince is not None:
+            downtime += monotonic() - downSince
+        if self.reconnects or downSince is not None:
+            text += ', {} reconnects, {:.0f} s down'.format(self.reconnects,
+                                                            downtime)
+        return text
+
+    def summary(self):
+        """Returns the decoder and connection statistics as a printable
+           string."""
+
+        text = '{}: {} frames received, {} resyncs, {} bytes discarded'.format(
+            self.name, self.stat('frameCount'), self.stat('resyncs'),
+            self.stat('discardedBytes'))
+        if self.requestedVersion >= 2:
+            text += (', {} CRC errors, {} packets lost, {} waveform '
+                     'blocks'.format(self.stat('crcErrors'),
+                                     self.stat('lostPackets'),
+                                     self.stat('waveformBlocks')))
+        text += ', {} reconnects, {:.1f} s down'.format(self.reconnects,
+                                                       self.downtime)
+        if self.timebase.clockError is not None:
+            text += ', clock error {:+.0f} ppm'.format(
+                self.timebase.clockError)
+        if self.maxLoopMicros is not None:
+            text += ', longest scan {} us'.format(self.maxLoopMicros)
+        return text
+
+
+class DeviceManager(threading.Thread):
+    """Connects and reads every Device from a single thread.
+
+       Devices can be added before or after start(). A device whose link
+       fails (e.g. the USB cable is pulled) reconnects on its own without
+       affecting the others. stop() ends the thread, which then closes all
+       ports."""
+
+    def __init__(self, batchInterval=READ_BATCH_INTERVAL):
+        threading.Thread.__init__(self)
+        self.batchInterval = batchInterval
+        self.devices = []
+        self._lock = threading.Lock()
+        self.stopFlag = False
+        self.daemon = True
+
+    def add(self, device):
+        with self._lock:
+            self.devices.append(device)
+
+    def run(self):
+        while not self.stopFlag:
+            readStart = monotonic()
+            with self._lock:
+                devices = list(self.devices)
+            for device in devices:
+                device.poll(monotonic())
+
+            # Let more data accumulate before the next read
+            sleep(max(0.0, self.batchInterval - (monotonic() - readStart)))
+
+        print('Reader thread stopping')
+        with self._lock:
+            devices = list(self.devices)
+        for device in devices:
+            device.close()
+            print(device.summary())
+
+    def stop(self):
+        self.stopFlag = True
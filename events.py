@@ -0,0 +1,213 @@
+# Event timestamp log. The Arduino only reports cumulative event counters, so
+# the time of each individual event is recovered here from the frame in which
+# its counter went up.
+#
+# This module must not import Kivy.
+
+import threading
+
+import numpy as np
+
+from protocol import ANALOG_VALUE_COLUMNS, COUNTER_COLUMNS, TIME_COLUMN
+from timebase import TimeUnwrapper
+
+# Event channels are numbered 0-7 for D1-D8 and 8-11 for A1-A4
+CHANNEL_NAMES = (['D{}'.format(i) for i in range(1, 9)] +
+                 ['A{}'.format(i) for i in range(1, 5)])
+
+# Event kinds
+EVENT_DISCRETE = 0
+EVENT_ANALOG = 1
+
+# One logged event. time is the unwrapped test time (see timebase.py) and level
+# the analog channel's value (0-1023) in the frame where the event was counted,
+# or -1 for discrete channels.
+EVENT_DTYPE = np.dtype([('time', '<i8'),
+                        ('channel', 'u1'),
+                        ('kind', 'u1'),
+                        ('level', '<i2')])
+
+# Frame column holding the analog level for each event channel (discrete
+# channels have none)
+_LEVEL_COLUMNS = np.array([0]*8 + ANALOG_VALUE_COLUMNS)
+_KINDS = np.array([EVENT_DISCRETE]*8 + [EVENT_ANALOG]*4, dtype=np.uint8)
+
+
+def clockToMillis(clock):
+    """Converts an 'HH:MM:SS' string, as shown on the elapsed time display,
+       to milliseconds."""
+
+    hours, minutes, seconds = clock.split(':')
+    return int((int(hours)*3600 + int(minutes)*60 + float(seconds)) * 1000)
+
+
+def millisToClock(millis):
+    """Converts milliseconds to an 'HH:MM:SS' string (the inverse of
+       clockToMillis, to the nearest second below)."""
+
+    seconds = int(millis) // 1000
+    return '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60,
+                                         seconds % 60)
+
+
+def channelNumber(channel):
+    """Accepts a channel number (0-11) or name ('D1'-'D8', 'A1'-'A4') and
+       returns the channel number."""
+
+    if isinstance(channel, str):
+        return CHANNEL_NAMES.index(channel.upper())
+    return int(channel)
+
+
+def _searchRange(times, startMillis, stopMillis):
+    """Returns the (start, stop) indices of the sorted array <times> covering
+       startMillis <= time < stopMillis. Either end may be None."""
+
+    start = 0 if startMillis is None else \
+        int(np.searchsorted(times, startMillis, side='left'))
+    stop = len(times) if stopMillis is None else \
+        int(np.searchsorted(times, stopMillis, side='left'))
+    return start, max(start, stop)
+
+
+class _GrowableArray(object):
+    """Append-only array that doubles its capacity as needed."""
+
+    def __init__(self, dtype, capacity=1024):
+        self._data = np.zeros(capacity, dtype=dtype)
+        self.size = 0
+
+    def append(self, values):
+        end = self.size + len(values)
+        if end > len(self._data):
+            data = np.zeros(max(end, 2*len(self._data)), dtype=self._data.dtype)
+            data[:self.size] = self._data[:self.size]
+            self._data = data
+        self._data[self.size:end] = values
+        self.size = end
+
+    @property
+    def values(self):
+        return self._data[:self.size]
+
+
+class EventLog(object):
+    """Log of every counted event, with a per-channel time index.
+
+       write() is called from the serial reader thread with each batch of
+       decoded frames. The counter deltas between consecutive frames are
+       expanded into events in one vectorized pass. Events arrive in time
+       order, so each channel's event times form a sorted array and range
+       queries are binary searches:
+
+           log.count('D3', clockToMillis('01:10:00'),
+                     clockToMillis('01:20:00'))
+           log.ratePerMinute('A1')
+
+       Query methods can be called from any thread and return copies."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = _GrowableArray(EVENT_DTYPE)
+        # Per-channel index: sorted event times and their positions in the
+        # main log
+        self._channelTimes = [_GrowableArray(np.int64)
+                              for name in CHANNEL_NAMES]
+        self._channelPositions = [_GrowableArray(np.int64)
+                                  for name in CHANNEL_NAMES]
+        self._lastCounters = np.zeros(len(COUNTER_COLUMNS), dtype=np.int64)
+        self._unwrapper = TimeUnwrapper()
+
+    def __len__(self):
+        return self._events.size
+
+    def write(self, frames):
+        """Logs the events in an Nx<SAMPLESIZE> array of frames."""
+
+        if len(frames) == 0:
+            return None
+
+        times = self._unwrapper.unwrap(frames[:, TIME_COLUMN])
+        counters = frames[:, COUNTER_COLUMNS].astype(np.int64)
+        previous = np.vstack((self._lastCounters, counters[:-1]))
+        self._lastCounters = counters[-1]
+
+        # A counter going down means the Arduino restarted; the new value is
+        # then the baseline rather than an event
+        deltas = np.clip(counters - previous, 0, None)
+        rows, channels = np.nonzero(deltas)
+        if len(rows) == 0:
+            return None
+
+        repeats = deltas[rows, channels]
+        rows = np.repeat(rows, repeats)
+        channels = np.repeat(channels, repeats)
+
+        events = np.zeros(len(rows), dtype=EVENT_DTYPE)
+        events['time'] = times[rows]
+        events['channel'] = channels
+        events['kind'] = _KINDS[channels]
+        events['level'] = np.where(events['kind'] == EVENT_ANALOG,
+                                   frames[rows, _LEVEL_COLUMNS[channels]], -1)
+
+        # Rows are in time order, so a stable sort by channel keeps each
+        # channel's events in time order too
+        order = np.argsort(channels, kind='mergesort')
+        bounds = np.searchsorted(channels[order],
+                                 np.arange(len(CHANNEL_NAMES) + 1))
+
+        with self._lock:
+            base = self._events.size
+            self._events.append(events)
+            for channel in np.flatnonzero(np.diff(bounds)):
+                positions = order[bounds[channel]:bounds[channel+1]]
+                self._channelTimes[channel].append(events['time'][positions])
+                self._channelPositions[channel].append(base + positions)
+
+    def events(self, channel=None, startMillis=None, stopMillis=None):
+        """Returns the events with startMillis <= time < stopMillis, for one
+           channel or (if channel is None) all channels."""
+
+        with self._lock:
+            if channel is None:
+                events = self._events.values
+                start, stop = _searchRange(events['time'], startMillis,
+                                           stopMillis)
+                return events[start:stop].copy()
+
+            channel = channelNumber(channel)
+            start, stop = _searchRange(self._channelTimes[channel].values,
+                                       startMillis, stopMillis)
+            positions = self._channelPositions[channel].values[start:stop]
+            return self._events.values[positions]
+
+    def times(self, channel):
+        """Returns the sorted event times of one channel."""
+        with self._lock:
+            return self._channelTimes[channelNumber(channel)].values.copy()
+
+    def count(self, channel, startMillis=None, stopMillis=None):
+        """Returns the number of events on a channel with
+           startMillis <= time < stopMillis (O(log n))."""
+
+        with self._lock:
+            start, stop = _searchRange(
+                self._channelTimes[channelNumber(channel)].values,
+                startMillis, stopMillis)
+            return stop - start
+
+    def ratePerMinute(self, channel, startMillis=None, stopMillis=None,
+                      binMillis=60000):
+        """Returns (binStarts, counts): the number of events on a channel in
+           each <binMillis> interval from startMillis to stopMillis. By
+           default the range covers all events on the channel."""
+
+        times = self.times(channel)
+        if startMillis is None:
+            startMillis = int(times[0]) if len(times) else 0
+        if stopMillis is None:
+            stopMillis = int(times[-1]) + 1 if len(times) else startMillis
+
+        edges = np.arange(startMillis, stopMillis + binMillis, binMillis)
+        counts = np.diff(np.searchsorted(times, edges, side='left'))
+        return edges[:-1], counts
@@ -0,0 +1,94 @@
+# Fixed-size buffer used to hand decoded frames from the serial reader thread
+# to the consumer (the GUI clock tick).
+#
+# This module must not import Kivy.
+
+import threading
+
+import numpy as np
+
+from protocol import FRAME_DTYPE, SAMPLESIZE
+
+
+class FrameRingBuffer(object):
+    """Preallocated ring buffer of frames shared between two threads.
+
+       The writer (the serial reader thread) copies frames into a fixed
+       <capacity>x<width> array and never allocates. If the reader falls more
+       than <capacity> frames behind, the oldest unread frames are overwritten
+       and counted in self.overwritten, so memory use stays flat no matter how
+       long the consumer stalls."""
+
+    def __init__(self, capacity=64, width=SAMPLESIZE):
+        self.capacity = capacity
+        self.width = width
+        self._frames = np.zeros((capacity, width), dtype=FRAME_DTYPE)
+        self._latest = np.zeros(width, dtype=FRAME_DTYPE)
+        self._lock = threading.Lock()
+
+        # Total frames ever written and consumed. The write position in the
+        # ring is self.written % capacity.
+        self.written = 0
+        self.consumed = 0
+
+        # Frames lost because the consumer fell too far behind
+        self.overwritten = 0
+
+    def __len__(self):
+        """Number of unread frames."""
+        return self.written - self.consumed
+
+    def write(self, frames):
+        """Copies an Nx<width> array of frames into the buffer."""
+
+        count = len(frames)
+        if count == 0:
+            return None
+
+        with self._lock:
+            # Only the newest <capacity> frames can be kept
+            if count > self.capacity:
+                self.overwritten += count - self.capacity
+                self.consumed += count - self.capacity
+                self.written += count - self.capacity
+                frames = frames[-self.capacity:]
+                count = self.capacity
+
+            # Copy in one or two slices depending on wrap-around
+            start = self.written % self.capacity
+            first = min(count, self.capacity - start)
+            self._frames[start:start + first] = frames[:first]
+            if first < count:
+                self._frames[:count - first] = frames[first:]
+            self.written += count
+
+            unread = self.written - self.consumed
+            if unread > self.capacity:
+                self.overwritten += unread - self.capacity
+                self.consumed = self.written - self.capacity
+
+    def latest(self):
+        """Consumes all unread frames and returns the newest one.
+
+           Returns None if nothing new has been written since the last call.
+           The returned array is reused by the next call, so copy it if it
+           needs to be kept."""
+
+        with self._lock:
+            if self.written == self.consumed:
+                return None
+            self._latest[:] = self._frames[(self.written - 1) % self.capacity]
+            self.consumed = self.written
+        return self._latest
+
+    def drain(self):
+        """Consumes all unread frames and returns them (oldest first) as a new
+           Nx<width> array."""
+
+        with self._lock:
+            count = self.written - self.consumed
+            start = self.consumed % self.capacity
+            index = (start + np.arange(count)) % self.capacity
+            frames = self._frames[index]
+            self.consumed = self.written
+        return frames
@@ -0,0 +1,291 @@
+# Headless acquisition. Runs a test on one or more ShockVibeBox units without
+# the GUI, for automated rigs and test scripts. The channel configuration is
+# read from a file, the handshake and serial reading are the same as in the
+# GUI, every frame is recorded to a session file in RECORDING_DIR and a
+# summary of the event counts is printed at intervals.
+#
+# The configuration file is JSON with the keys of protocol.packConfig, e.g.
+#
+#   {"discreteConfig": [1, 1, 2, 0, 0, 0, 0, 0],
+#    "analogConfig": [2, 0, 0, 0],
+#    "analogLowThreshold": [100, 0, 0, 0],
+#    "analogHighThreshold": [900, 1023, 1023, 1023],
+#    "gateThresholdMicros": 1000}
+#
+# Discrete configs are 0 (off), 1 (rising edge) or 2 (falling edge), analog
+# configs 0 (off), 1 (current) or 2 (voltage). Missing keys default to the
+# channel being off and to the GUI's default thresholds and times. A session
+# file (.svb) can be given instead to repeat the configuration of a recorded
+# test. The units are those in DEVICES in config.py unless ports are given
+# with --port.
+#
+# This module must not import Kivy.
+#
+# Usage from the command line:
+#   python headless.py <config file> [--port PORT ...] [--duration SECONDS]
+#                      [--summary-interval SECONDS] [--protocol N]
+#                      [--recording-dir DIR] [--metrics-port PORT]
+#
+# The test runs until the duration has passed or it is interrupted (Ctrl+C or
+# SIGTERM). Units whose link fails are reconnected and their counts carry on.
+# The exit status is 0 if no events were counted on any enabled channel, 1 if
+# any were and 2 if the test could not be run (invalid arguments or
+# configuration, or no unit could be connected). With --metrics-port, the
+# serial metrics of every unit (see metrics.py) are served in Prometheus text
+# format at http://127.0.0.1:PORT/metrics while the test runs.
+
+import argparse
+import json
+import signal
+import struct
+from datetime import datetime
+from time import sleep, time
+
+from config import DEVICES, RECORDING_DIR, TRIGGER_DURATION
+from devices import Device, DeviceManager
+from events import CHANNEL_NAMES, millisToClock
+from metrics import MetricsServer, Registry
+from protocol import ANALOG_MAX, PROTOCOL_VERSION, packConfig
+from recorder import (SESSION_EXTENSION, SessionRecorder, readHeader,
+                      sessionPath)
+from rollingstats import RollingStats, formatEventStats
+
+# Test configuration used for any key missing from the configuration file
+DEFAULT_TEST_CONFIG = {
+    'discreteConfig': [0]*8,
+    'analogConfig': [0]*4,
+    'analogLowThreshold': [0]*4,
+    'analogHighThreshold': [ANALOG_MAX]*4,
+    'gateThresholdMicros': 1000,
+    'triggerDurationMicros': int(TRIGGER_DURATION*1000) }
+
+# Time in seconds between serial reads. Nothing is displayed, so reads can be
+# batched further than in the GUI to save CPU.
+HEADLESS_READ_INTERVAL = 0.1
+
+# Time in seconds to wait for the first unit to connect
+CONNECT_TIMEOUT = 10.0
+
+# Exit statuses
+EXIT_PASS = 0
+EXIT_FAIL = 1
+EXIT_NO_CONNECTION = 2
+
+
+def loadTestConfig(path):
+    """Reads a test configuration from a JSON file or the header of a session
+       file.
+
+       Returns a dict as taken by protocol.packConfig. Raises ValueError if
+       the configuration is invalid."""
+
+    if path.endswith(SESSION_EXTENSION):
+        with open(path, 'rb') as f:
+            config = readHeader(f)[0]
+    else:
+        with open(path) as f:
+            config = json.load(f)
+
+    testConfig = {}
+    for key, default in DEFAULT_TEST_CONFIG.items():
+        value = config.get(key, default)
+        if isinstance(default, list):
+            if not isinstance(value, list) or len(value) != len(default):
+                raise ValueError('{} must be a list of {} values'.format(
+                                 key, len(default)))
+            value = [int(item) for item in value]
+        else:
+            value = int(value)
+        testConfig[key] = value
+
+    try:
+        packConfig(testConfig)
+    except struct.error:
+        raise ValueError('Configuration value out of range')
+    return testConfig
+
+
+def enabledChannels(testConfig):
+    """Returns the event channel numbers (see events.CHANNEL_NAMES) enabled
+       in a test configuration."""
+
+    configs = testConfig['discreteConfig'] + testConfig['analogConfig']
+    return [channel for channel, config in enumerate(configs) if config != 0]
+
+
+class HeadlessUnit(object):
+    """Device, recording and statistics of one unit under test."""
+
+    def __init__(self, name, port):
+        self.name = name
+        self.port = port
+        self.device = None
+
+    def startTest(self, testConfig, protocolVersion, recordingDir, named,
+                  registry=None):
+        """Starts recording and creates self.device, which connects to the
+           unit and sends it the test configuration once added to a
+           DeviceManager. The session file name includes the unit's name if
+           <named> is true. The device's metrics are kept in <registry>
+           unless it is None."""
+
+        header = dict(testConfig)
+        header['startTime'] = datetime.now().isoformat()
+        header['fixture'] = self.name
+        header['port'] = self.port
+        header['requestedProtocolVersion'] = protocolVersion
+        header['waveformIntervalMicros'] = 0
+        header['headless'] = True
+        self.recordingPath = sessionPath(recordingDir,
+                                         self.name if named else None)
+        self.recorder = SessionRecorder(self.recordingPath, header)
+        self.recorder.start()
+
+        self.stats = RollingStats()
+        self.device = Device(self.name, self.port, testConfig,
+                             [self.recorder, self.stats], protocolVersion,
+                             timebaseSinks=[self.recorder.timebaseLog],
+                             loopSinks=[self.recorder.loopLog])
+        if registry is not None:
+            self.device.instrument(registry)
+
+    def summary(self, testConfig):
+        """Returns the event counts and rates of the enabled channels as
+           printable text."""
+
+        stats = self.stats.snapshot()
+        elapsed = stats['timeMillis']
+        lines = ['{} {}: {} frames, {}'.format(
+                 '--:--:--' if elapsed is None else millisToClock(elapsed),
+                 self.name, self.device.frameCount, self.device.status())]
+        for channel in enabledChannels(testConfig):
+            lines.append('  {:<3} {:>6} events  {}'.format(
+                CHANNEL_NAMES[channel], stats['eventTotals'][channel],
+                formatEventStats(stats['ratePerMinute'][channel],
+                                 stats['windowCounts'][:, channel])))
+        return '\n'.join(lines)
+
+    def eventCount(self, testConfig):
+        """Returns the number of events counted on the enabled channels."""
+        totals = self.stats.snapshot()['eventTotals']
+        return int(sum(totals[channel]
+                       for channel in enabledChannels(testConfig)))
+
+    def stopTest(self):
+        """Stops recording after the serial reader has stopped."""
+
+        self.recorder.stop()
+        print('{}: {} frames recorded to {}, {} dropped'.format(
+              self.name, self.recorder.framesWritten, self.recordingPath,
+              self.recorder.framesDropped))
+
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt
+
+
+def runTest(units, testConfig, duration=None, summaryInterval=10.0,
+            protocolVersion=PROTOCOL_VERSION, recordingDir=RECORDING_DIR,
+            connectTimeout=CONNECT_TIMEOUT, metricsPort=None):
+    """Runs a test on a list of HeadlessUnits for <duration> seconds, or
+       until interrupted if None, printing a summary every <summaryInterval>
+       seconds. Units whose link fails are reconnected. The test is abandoned
+       if no unit has connected after <connectTimeout> seconds. Metrics are
+       served on <metricsPort> during the test unless it is None.
+
+       Returns the exit status (EXIT_PASS, EXIT_FAIL or
+       EXIT_NO_CONNECTION)."""
+
+    registry = None if metricsPort is None else Registry()
+    for unit in units:
+        unit.startTest(testConfig, protocolVersion, recordingDir,
+                       len(units) > 1, registry)
+    if registry is not None:
+        server = MetricsServer(registry, metricsPort)
+        server.start()
+
+    # A single reader thread connects and reads every unit
+    manager = DeviceManager(HEADLESS_READ_INTERVAL)
+    for unit in units:
+        manager.add(unit.device)
+    manager.start()
+
+    startTime = time()
+    endTime = None if duration is None else startTime + duration
+    nextSummary = startTime + summaryInterval
+    connected = False
+    try:
+        while endTime is None or time() < endTime:
+            connected = connected or any(unit.device.connections
+                                         for unit in units)
+            if not connected and time() - startTime > connectTimeout:
+                print('No unit could be connected')
+                break
+            if time() >= nextSummary:
+                nextSummary += summaryInterval
+                for unit in units:
+                    print(unit.summary(testConfig))
+            wake = nextSummary if endTime is None else min(nextSummary,
+                                                           endTime)
+            sleep(max(0.0, min(1.0, wake - time())))
+    except KeyboardInterrupt:
+        print('Test interrupted')
+    finally:
+        manager.stop()
+        manager.join(1.0)
+        for unit in units:
+            unit.stopTest()
+        if registry is not None:
+            server.stop()
+    if not connected:
+        return EXIT_NO_CONNECTION
+
+    events = 0
+    for unit in units:
+        print(unit.summary(testConfig))
+        events += unit.eventCount(testConfig)
+    print('FAIL' if events else 'PASS')
+    return EXIT_FAIL if events else EXIT_PASS
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run a ShockVibeBox test without the GUI')
+    parser.add_argument('config',
+                        help='test configuration (.json, or a session file '
+                             'to repeat its configuration)')
+    parser.add_argument('--port', action='append',
+                        help='serial port of a unit (may be repeated; '
+                             'default DEVICES in config.py)')
+    parser.add_argument('--duration', type=float,
+                        help='test duration in seconds (default until '
+                             'interrupted)')
+    parser.add_argument('--summary-interval', type=float, default=10.0,
+                        help='seconds between summaries (default 10)')
+    parser.add_argument('--protocol', type=int, default=PROTOCOL_VERSION,
+                        help='highest serial protocol version to request '
+                             '(default {})'.format(PROTOCOL_VERSION))
+    parser.add_argument('--recording-dir', default=RECORDING_DIR,
+                        help='directory for session files (default '
+                             '{})'.format(RECORDING_DIR))
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve metrics on this local port during the '
+                             'test (default off)')
+    args = parser.parse_args()
+
+    try:
+        testConfig = loadTestConfig(args.config)
+    except (IOError, ValueError) as error:
+        parser.error('{}: {}'.format(args.config, error))
+
+    if args.port:
+        units = [HeadlessUnit(port, port) for port in args.port]
+    else:
+        units = [HeadlessUnit(device['name'], device['port'])
+                 for device in DEVICES]
+
+    signal.signal(signal.SIGTERM, _terminate)
+    raise SystemExit(runTest(units, testConfig, args.duration,
+                             args.summary_interval, args.protocol,
+                             args.recording_dir,
+                             metricsPort=args.metrics_port))
@@ -0,0 +1,208 @@
+# History of the analog levels and events over a whole test, for plotting.
+#
+# Frames are reduced to the min and max level and the number of events of each
+# analog channel in fixed time bins, kept at several resolutions: each level
+# of the pyramid has bins LEVEL_FACTOR times as long as the one below. A plot
+# of any time range reads the coarsest level whose bins are still no wider
+# than a pixel, so drawing costs the same whether the test has run for
+# minutes or days. Every bin keeps the extremes of the frames in it, so a
+# short excursion past a threshold is never averaged away however far the plot
+# is zoomed out.
+#
+# Each level is a ring of LEVEL_CAPACITY bins, so memory is fixed. The finest
+# level covers the last 80 seconds or so, the coarsest a couple of weeks.
+#
+# This module must not import Kivy.
+
+import threading
+
+import numpy as np
+
+from protocol import ANALOG_COUNTER_COLUMNS, ANALOG_VALUE_COLUMNS, TIME_COLUMN
+from timebase import TimeUnwrapper
+
+# Length in milliseconds of the bins of the finest level
+BIN_MILLIS = 10
+
+# Ratio of the bin lengths of neighbouring levels, and the number of levels
+LEVEL_FACTOR = 4
+LEVELS = 8
+
+# Number of bins held by each level
+LEVEL_CAPACITY = 8192
+
+# Min and max of a bin without frames
+_EMPTY_MIN = np.iinfo(np.uint16).max
+_EMPTY_MAX = 0
+
+
+def _reduceBins(bins, mins, maxs, events):
+    """Merges the runs of equal values in the sorted array <bins>."""
+
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+    return (bins[starts], np.minimum.reduceat(mins, starts),
+            np.maximum.reduceat(maxs, starts),
+            np.add.reduceat(events, starts))
+
+
+class LevelHistory(object):
+    """Min/max pyramid of the analog levels and events of a test.
+
+       write() is called from the serial reader thread with each batch of
+       decoded frames, and plot() from any thread, e.g. the UI thread. The
+       level of analog channel i (0-3) is that of frame column
+       ANALOG_VALUE_COLUMNS[i] (0-1023) and its events are the increases of
+       ANALOG_COUNTER_COLUMNS[i].
+
+       Every level is kept in the same arrays, so one batch updates all of
+       them at once. Bin b of level k (starting at b*binMillis*levelFactor**k)
+       is held in row k*capacity + b % capacity. Times are unwrapped test
+       times (see timebase.py)."""
+
+    def __init__(self, binMillis=BIN_MILLIS, levelFactor=LEVEL_FACTOR,
+                 levels=LEVELS, capacity=LEVEL_CAPACITY):
+        self._lock = threading.Lock()
+        channels = len(ANALOG_VALUE_COLUMNS)
+        self.capacity = capacity
+        self.binMillis = binMillis
+
+        # Finest bins per bin of each level, and the first row of each level
+        self._ratios = levelFactor ** np.arange(levels, dtype=np.int64)
+        self._offsets = np.arange(levels, dtype=np.int64) * capacity
+
+        rows = levels * capacity
+        self._bins = np.full(rows, -1, dtype=np.int64)
+        self._mins = np.full((rows, channels), _EMPTY_MIN, dtype=np.uint16)
+        self._maxs = np.full((rows, channels), _EMPTY_MAX, dtype=np.uint16)
+        self._events = np.zeros((rows, channels), dtype=np.uint32)
+        self._newest = np.full(levels, -1, dtype=np.int64)
+        self._lastCounters = None
+        self._lastTime = None
+        self._unwrapper = TimeUnwrapper()
+
+        # Time (ms) of the first and newest frames
+        self.startMillis = None
+        self.stopMillis = None
+
+    def write(self, frames):
+        """Adds an Nx<SAMPLESIZE> array of frames."""
+
+        if len(frames) == 0:
+            return None
+
+        levels = frames[:, ANALOG_VALUE_COLUMNS].astype(np.uint16)
+        counters = frames[:, ANALOG_COUNTER_COLUMNS].astype(np.int64)
+        with self._lock:
+            times = self._unwrapper.unwrap(frames[:, TIME_COLUMN])
+            if self._lastTime is None:
+                self._lastTime = self.startMillis = int(times[0])
+                self._lastCounters = counters[0]
+
+            # As in events.EventLog, a counter going down means the Arduino
+            # restarted and the new value is the baseline. Bins must stay in
+            # order, so frame times never go backwards here either.
+            previous = np.concatenate((self._lastCounters[None],
+                                       counters[:-1]))
+            events = np.maximum(counters - previous, 0).astype(np.uint32)
+            self._lastCounters = counters[-1]
+            times = np.maximum.accumulate(np.maximum(times, self._lastTime))
+            self._lastTime = self.stopMillis = int(times[-1])
+
+            bins, mins, maxs, events = _reduceBins(times // self.binMillis,
+                                                   levels, levels, events)
+            self._merge(bins, mins, maxs, events)
+
+    def _merge(self, bins, mins, maxs, events):
+        """Adds the sorted, unique finest bins <bins> to every level."""
+
+        # The bins of each level; a batch spanning more than a level's
+        # capacity only keeps its newest bins there
+        levelBins = bins[None, :] // self._ratios[:, None]
+        kept = levelBins > levelBins[:, -1:] - self.capacity
+        rows = (self._offsets[:, None] + levelBins % self.capacity)[kept]
+        levelBins = levelBins[kept]
+        sources = np.nonzero(kept)[1]
+        self._newest = np.maximum(self._newest,
+                                  bins[-1] // self._ratios)
+
+        # Several finest bins can fall in the same bin of a coarser level.
+        # They are next to each other, as are the rows of each level.
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(rows)) + 1))
+        rows = rows[starts]
+        levelBins = levelBins[starts]
+        mins = np.minimum.reduceat(mins[sources], starts)
+        maxs = np.maximum.reduceat(maxs[sources], starts)
+        events = np.add.reduceat(events[sources], starts)
+
+        # Rows still holding an older bin start again from empty
+        replaced = self._bins[rows] != levelBins
+        stale = rows[replaced]
+        self._bins[stale] = levelBins[replaced]
+        self._mins[stale] = _EMPTY_MIN
+        self._maxs[stale] = _EMPTY_MAX
+        self._events[stale] = 0
+
+        self._mins[rows] = np.minimum(self._mins[rows], mins)
+        self._maxs[rows] = np.maximum(self._maxs[rows], maxs)
+        self._events[rows] += events
+
+    def plot(self, startMillis, stopMillis, columns):
+        """Returns (mins, maxs, events) for plotting the range
+           startMillis <= time < stopMillis in <columns> columns: arrays of
+           columns x channels holding the min and max level and number of
+           events in each column. Columns without frames have a min above
+           their max.
+
+           The cost depends on <columns>, not on the length of the range.
+           Each column covers whole bins, so a column's min and max include
+           every frame in it."""
+
+        mins = np.full((columns, len(ANALOG_VALUE_COLUMNS)), _EMPTY_MIN,
+                       dtype=np.uint16)
+        maxs = np.full(mins.shape, _EMPTY_MAX, dtype=np.uint16)
+        events = np.zeros(mins.shape, dtype=np.uint32)
+        span = stopMillis - startMillis
+        if columns <= 0 or span <= 0:
+            return mins, maxs, events
+
+        with self._lock:
+            if self._lastTime is None:
+                return mins, maxs, events
+            level = self._chooseLevel(max(startMillis, self.startMillis),
+                                      span / float(columns))
+            binMillis = self.binMillis * int(self._ratios[level])
+            oldest = int(self._newest[level]) - self.capacity + 1
+            bins = np.arange(max(startMillis // binMillis, oldest),
+                             (stopMillis - 1) // binMillis + 1)
+            rows = self._offsets[level] + bins % self.capacity
+            held = self._bins[rows] == bins
+            bins = bins[held]
+            rows = rows[held]
+            binMins = self._mins[rows]
+            binMaxs = self._maxs[rows]
+            binEvents = self._events[rows]
+        if len(bins) == 0:
+            return mins, maxs, events
+
+        # Column of each bin, by the bin's start (clipped for the first bin)
+        positions = np.clip((bins * binMillis - startMillis) * columns //
+                            span, 0, columns - 1)
+        columnBins = _reduceBins(positions, binMins, binMaxs, binEvents)
+        used = columnBins[0]
+        mins[used] = columnBins[1]
+        maxs[used] = columnBins[2]
+        events[used] = columnBins[3]
+        return mins, maxs, events
+
+    def _chooseLevel(self, startMillis, columnMillis):
+        """Returns the coarsest level whose bins are no wider than a column
+           and which still holds <startMillis>, or failing that the finest
+           level that still holds it."""
+
+        binMillis = self.binMillis * self._ratios
+        oldestMillis = (self._newest - self.capacity + 1) * binMillis
+        holding = np.flatnonzero(oldestMillis <= startMillis)
+        if len(holding) == 0:
+            return len(self._ratios) - 1
+        narrow = holding[binMillis[holding] <= columnMillis]
+        return int(narrow[-1]) if len(narrow) else int(holding[0])
@@ -0,0 +1,228 @@
+# Instrumentation of the acquisition pipeline: counters, gauges and histograms
+# kept in a Registry, which can render them in the Prometheus text exposition
+# format and serve them over HTTP for a local scraper.
+#
+# Updating a metric is a few Python operations with no locking. Each metric is
+# only ever updated from one thread (the serial reader or the UI), and readers
+# on other threads may see a histogram mid-update, which is harmless for
+# monitoring. Values that already exist elsewhere (decoder statistics,
+# connection state) are not counted twice: collectors copy them into gauges
+# when the metrics are read.
+#
+# This module must not import Kivy.
+
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# Histogram buckets (upper bounds) for durations in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 1.0)
+
+# Histogram buckets for intervals in seconds between regular ticks
+INTERVAL_BUCKETS = (0.01, 0.02, 0.03, 0.04, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5,
+                    1.0)
+
+# Histogram buckets for queue depths in frames
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 1024, 8192)
+
+
+class Counter(object):
+    """Monotonically increasing value."""
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge(object):
+    """Value that can go up and down."""
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    """Counts of observed values in fixed buckets, with their sum.
+
+       <buckets> are the bucket upper bounds in increasing order. A value
+       falls in the first bucket whose bound it does not exceed, or in a
+       final +Inf bucket."""
+
+    def __init__(self, buckets):
+        self.bounds = tuple(buckets)
+        self.counts = [0]*(len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """Returns a copy of the state as (counts, sum, count), e.g. for
+           summarize()."""
+        return list(self.counts), self.sum, self.count
+
+
+def summarize(histogram, before=None, quantile=0.99):
+    """Summarizes the values observed by <histogram> since the snapshot
+       <before> (or since it was created).
+
+       Returns (count, mean, bound): the number of values, their mean and
+       the upper bound of the bucket holding the given quantile (inf if it
+       is in the +Inf bucket). Mean and bound are None if there were no
+       values."""
+
+    counts, total, count = histogram.snapshot()
+    if before is not None:
+        counts = [now - then for now, then in zip(counts, before[0])]
+        total -= before[1]
+        count -= before[2]
+    if count <= 0:
+        return 0, None, None
+
+    rank = quantile * count
+    seen = 0
+    for index, bucketCount in enumerate(counts):
+        seen += bucketCount
+        if seen >= rank:
+            break
+    bounds = histogram.bounds + (float('inf'),)
+    return count, total / count, bounds[index]
+
+
+class Registry(object):
+    """Named metric families, each holding one metric per set of label
+       values.
+
+       counter(), gauge() and histogram() return the existing metric for a
+       name and labels if there is one, so metrics survive from one test to
+       the next. Collectors are functions called before the metrics are
+       rendered; each is registered under a key and replaces any earlier
+       collector with that key."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = OrderedDict()
+        self._collectors = OrderedDict()
+
+    def counter(self, name, help, labels=None):
+        return self._metric(name, 'counter', help, labels, Counter)
+
+    def gauge(self, name, help, labels=None):
+        return self._metric(name, 'gauge', help, labels, Gauge)
+
+    def histogram(self, name, help, labels=None, buckets=LATENCY_BUCKETS):
+        return self._metric(name, 'histogram', help, labels,
+                            lambda: Histogram(buckets))
+
+    def _metric(self, name, kind, help, labels, factory):
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            if name not in self._families:
+                self._families[name] = (kind, help, OrderedDict())
+            metrics = self._families[name][2]
+            if key not in metrics:
+                metrics[key] = factory()
+            return metrics[key]
+
+    def setCollector(self, key, function):
+        with self._lock:
+            self._collectors[key] = function
+
+    def collect(self):
+        """Runs the collectors."""
+        with self._lock:
+            collectors = list(self._collectors.values())
+        for function in collectors:
+            function()
+
+    def render(self):
+        """Runs the collectors and returns every metric in the Prometheus
+           text exposition format (version 0.0.4)."""
+
+        self.collect()
+        lines = []
+        with self._lock:
+            families = [(name, kind, help, list(metrics.items()))
+                        for name, (kind, help, metrics)
+                        in self._families.items()]
+        for name, kind, help, metrics in families:
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, metric in metrics:
+                if kind != 'histogram':
+                    lines.append('{}{} {}'.format(name, _labelText(labels),
+                                                  _number(metric.value)))
+                    continue
+                counts, total, count = metric.snapshot()
+                cumulative = 0
+                for bound, bucketCount in zip(metric.bounds + ('+Inf',),
+                                              counts):
+                    cumulative += bucketCount
+                    le = bound if bound == '+Inf' else _number(bound)
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _labelText(labels + (('le', le),)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, _labelText(labels),
+                                                  _number(total)))
+                lines.append('{}_count{} {}'.format(name, _labelText(labels),
+                                                    count))
+        return '\n'.join(lines) + '\n'
+
+
+def _labelText(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsServer(threading.Thread):
+    """Serves a Registry at http://<host>:<port>/metrics from a background
+       thread. Only listens on the local machine by default."""
+
+    def __init__(self, registry, port, host='127.0.0.1'):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return None
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
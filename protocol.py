@@ -0,0 +1,964 @@
+# Serial protocol definitions shared by everything on the PC side that talks to
+# the ShockVibeBox Arduino sketch (Arduino/ShockVibeBox/ShockVibeBox.ino).
+#
+# This module must not import Kivy, so that it can be used by scripts that run
+# without a display.
+
+import struct
+import time
+from collections import namedtuple
+
+import numpy as np
+
+################################################################################
+###### Protocol constants ######################################################
+################################################################################
+# Number of unsigned 32-bit words in one data frame (see DATAFRAME in
+# ShockVibeBox.py for the meaning of each word)
+SAMPLESIZE = 17
+
+# Serial baud rate set in the Arduino sketch
+BAUDRATE = 115200
+
+# Size of one data frame in bytes
+FRAMESIZE = SAMPLESIZE * 4
+
+# The Arduino Mega is little-endian, so frames are always decoded as
+# little-endian regardless of the PC architecture
+FRAME_DTYPE = np.dtype('<u4')
+
+# Frame column indices
+TIME_COLUMN = 0
+DISCRETE_COUNTER_COLUMNS = [1, 2, 3, 4, 5, 6, 7, 8]
+ANALOG_COUNTER_COLUMNS = [9, 11, 13, 15]
+ANALOG_VALUE_COLUMNS = [10, 12, 14, 16]
+
+# All 12 event counters, in channel order D1-D8, A1-A4
+COUNTER_COLUMNS = DISCRETE_COUNTER_COLUMNS + ANALOG_COUNTER_COLUMNS
+
+# Column names used when exporting frames
+COLUMN_NAMES = (['time_ms'] +
+                ['D{}_count'.format(i) for i in range(1, 9)] +
+                [name.format(i) for i in range(1, 5)
+                 for name in ('A{}_count', 'A{}_value')])
+
+# Largest value returned by analogRead() (10-bit ADC)
+ANALOG_MAX = 1023
+
+# Largest step in elapsed time (ms) accepted between two consecutive frames.
+# The Arduino writes a frame every 100ms, so anything much larger than that
+# almost certainly means the decoder is looking at the wrong byte offset.
+MAX_FRAME_GAP_MILLIS = 10000
+
+# Size in bytes of the configuration handshake sent to the Arduino at the
+# start of a test: 8 discrete configs, 4x(analog config, low threshold, high
+# threshold), gate threshold time, trigger duration
+CONFIG_FORMAT = '<8B' + 'BHH'*4 + 'LL'
+CONFIG_SIZE = struct.calcsize(CONFIG_FORMAT)
+
+# Protocol version negotiation. A PC that supports protocol v2 sends
+# VERSION_MAGIC + <version> straight after the configuration, and firmware that
+# supports it echoes the request back, with the version it agreed to, before
+# its first packet. Firmware without v2 support never reads the extra bytes and
+# sends v1 frames. From version 3 the request (and the echo) has one more byte:
+# the waveform capture sample interval in units of WAVEFORM_INTERVAL_UNIT
+# microseconds, or 0 to turn capture off. Version 4 adds command packets from
+# the PC, which change the configuration while a test runs. Version 5 adds
+# loop statistics packets, which show how often the sketch scans its inputs.
+PROTOCOL_VERSION = 5
+VERSION_MAGIC = b'SVB'
+WAVEFORM_INTERVAL_UNIT = 100
+
+# Protocol v2 packet layout:
+#
+#   Offset  Contents
+#   0       Sync bytes 0xA5 0x5A
+#   2       Packet type (PACKET_SAMPLE, PACKET_KEYFRAME or PACKET_WAVEFORM)
+#   3       Sequence number (increments by 1 per packet, wraps at 256)
+#   4       Payload length in bytes
+#   5       Payload
+#   5+len   CRC16-CCITT (polynomial 0x1021, initial value 0xFFFF) of bytes
+#           2 to 4+len, little-endian
+#
+# Sample payload (sent every few milliseconds):
+#   <H  Low 16 bits of elapsed time in milliseconds
+#   <H  Bit mask of the counters (bit 0 = D1 ... bit 11 = A4) that changed
+#       since the previous packet
+#   B   Increase of each changed counter, one byte each, lowest bit first
+#   5B  Analog values 1-4, 10 bits each, packed little-endian
+#
+# Keyframe payload (sent once a second, and whenever a counter increases by
+# more than 255 between samples):
+#   <L  Elapsed time in milliseconds
+#   12<L Counters D1-D8, A1-A4
+#   5B  Analog values 1-4, packed as above
+#
+# Waveform payload (protocol v3, only while waveform capture is on). The
+# sketch samples each enabled analog channel at a fixed interval and sends a
+# block of WAVEFORM_BLOCK_SAMPLES samples per channel as it fills:
+#   <L  Elapsed time in milliseconds of the first sample
+#   <H  Sample interval in microseconds
+#   B   Analog channel (0-3)
+#   <H  Samples (0-1023), one per interval
+#
+# Command payload (protocol v4, sent by the PC with its own sequence numbers).
+# The sketch applies a command straight after sending its next sample or
+# keyframe, and answers with an acknowledgement packet:
+#   B   Command (COMMAND_CHANNEL or COMMAND_GATE)
+#   COMMAND_CHANNEL:
+#     B   Event channel (0-7 = D1-D8, 8-11 = A1-A4)
+#     B   Channel config, as in the handshake
+#     <H  Low threshold (0-1023, analog channels only)
+#     <H  High threshold (0-1023, analog channels only)
+#   COMMAND_GATE:
+#     <L  Gate threshold time in microseconds
+#
+# Acknowledgement payload (protocol v4):
+#   B   Sequence number of the command packet
+#   B   ACK_APPLIED, or ACK_REJECTED if the command was invalid
+#   <L  Elapsed time in milliseconds of the last frame sent before the change.
+#       Every later frame was measured with the new configuration.
+#
+# Loop statistics payload (protocol v5, sent straight after each periodic
+# keyframe). The sketch checks every input once per scan of its loop, so the
+# scan time is the resolution of the gate threshold time: a dropout shorter
+# than the longest scan can be missed.
+#   <L  Elapsed time in milliseconds of the keyframe
+#   <L  Number of scans since the previous loop statistics packet
+#   <H  Minimum scan time in microseconds
+#   <H  Mean scan time in microseconds
+#   <H  Maximum scan time in microseconds (65535 if longer)
+SYNC = b'\xa5\x5a'
+PACKET_SAMPLE = 1
+PACKET_KEYFRAME = 2
+PACKET_WAVEFORM = 3
+PACKET_COMMAND = 4
+PACKET_ACK = 5
+PACKET_LOOP_STATS = 6
+COMMAND_CHANNEL = 1
+COMMAND_GATE = 2
+ACK_APPLIED = 0
+ACK_REJECTED = 1
+COMMAND_CHANNEL_FORMAT = '<BBBHH'
+COMMAND_GATE_FORMAT = '<BL'
+ACK_FORMAT = '<BBL'
+LOOP_STATS_FORMAT = '<LLHHH'
+PACKET_HEADER_SIZE = 5
+PACKET_OVERHEAD = PACKET_HEADER_SIZE + 2
+SAMPLE_PAYLOAD_SIZE = 9
+KEYFRAME_PAYLOAD_SIZE = 4 + 4*len(COUNTER_COLUMNS) + 5
+WAVEFORM_HEADER_FORMAT = '<LHB'
+WAVEFORM_HEADER_SIZE = struct.calcsize(WAVEFORM_HEADER_FORMAT)
+WAVEFORM_BLOCK_SAMPLES = 32
+################################################################################
+##### End protocol constants ###################################################
+################################################################################
+
+# One block of waveform samples from an analog channel. <samples> is a uint16
+# array; sample i was taken intervalMicros*i microseconds after <time> (ms).
+WaveformBlock = namedtuple('WaveformBlock',
+                           'channel time intervalMicros samples')
+
+# Acknowledgement of a command packet: the command's sequence number,
+# ACK_APPLIED or ACK_REJECTED and the elapsed time (ms) of the last frame
+# before the change
+CommandAck = namedtuple('CommandAck', 'sequence status time')
+
+# Command packet received (by the simulator): its sequence number and payload
+Command = namedtuple('Command', 'sequence payload')
+
+# Loop statistics of the sketch: the elapsed time (ms) of the keyframe they
+# were sent with, the number of scans since the previous ones and the
+# minimum, mean and maximum scan time in microseconds
+LoopStats = namedtuple('LoopStats',
+                       'time scans minMicros meanMicros maxMicros')
+
+
+def packConfig(config):
+    """Packs a test configuration into the handshake bytes read by the Arduino
+       in setup().
+
+       <config> is a dict with the keys:
+           discreteConfig       list of 8 discrete channel configs
+           analogConfig         list of 4 analog channel configs
+           analogLowThreshold   list of 4 analog low thresholds (0-1023)
+           analogHighThreshold  list of 4 analog high thresholds (0-1023)
+           gateThresholdMicros  gate threshold time in microseconds
+           triggerDurationMicros  trigger output duration in microseconds"""
+
+    values = list(config['discreteConfig'])
+    for i in range(4):
+        values.append(config['analogConfig'][i])
+        values.append(config['analogLowThreshold'][i])
+        values.append(config['analogHighThreshold'][i])
+    values.append(config['gateThresholdMicros'])
+    values.append(config['triggerDurationMicros'])
+    return struct.pack(CONFIG_FORMAT, *[int(value) for value in values])
+
+
+def unpackConfig(data):
+    """Unpacks handshake bytes into a test configuration dict (the inverse of
+       packConfig)."""
+
+    values = struct.unpack(CONFIG_FORMAT, data)
+    analog = values[8:20]
+    return {
+        'discreteConfig': list(values[0:8]),
+        'analogConfig': list(analog[0::3]),
+        'analogLowThreshold': list(analog[1::3]),
+        'analogHighThreshold': list(analog[2::3]),
+        'gateThresholdMicros': values[20],
+        'triggerDurationMicros': values[21] }
+
+
+def packCommand(change):
+    """Packs a configuration change into a command payload (protocol v4).
+
+       <change> is a dict, either
+           channel         event channel (0-7 = D1-D8, 8-11 = A1-A4)
+           config          channel config, as in packConfig
+           lowThreshold    low threshold (0-1023, analog channels only)
+           highThreshold   high threshold (0-1023, analog channels only)
+       or
+           gateThresholdMicros  gate threshold time in microseconds
+
+       Raises ValueError if the change is invalid."""
+
+    _checkChange(change)
+    if 'gateThresholdMicros' in change:
+        return struct.pack(COMMAND_GATE_FORMAT, COMMAND_GATE,
+                           int(change['gateThresholdMicros']))
+    return struct.pack(COMMAND_CHANNEL_FORMAT, COMMAND_CHANNEL,
+                       int(change['channel']), int(change['config']),
+                       int(change.get('lowThreshold', 0)),
+                       int(change.get('highThreshold', ANALOG_MAX)))
+
+
+def unpackCommand(payload):
+    """Unpacks a command payload into a configuration change dict (the
+       inverse of packCommand). Raises ValueError if it is invalid."""
+
+    payload = bytes(payload)
+    try:
+        if payload[:1] == struct.pack('<B', COMMAND_GATE):
+            return {'gateThresholdMicros': struct.unpack(COMMAND_GATE_FORMAT,
+                                                         payload)[1]}
+        command, channel, config, low, high = struct.unpack(
+            COMMAND_CHANNEL_FORMAT, payload)
+    except struct.error:
+        raise ValueError('Invalid command')
+    if command != COMMAND_CHANNEL:
+        raise ValueError('Unknown command {}'.format(command))
+    change = {'channel': channel, 'config': config}
+    if channel >= len(DISCRETE_COUNTER_COLUMNS):
+        change['lowThreshold'] = low
+        change['highThreshold'] = high
+    _checkChange(change)
+    return change
+
+
+def _checkChange(change):
+    if 'gateThresholdMicros' in change:
+        if not 0 <= change['gateThresholdMicros'] <= 0xFFFFFFFF:
+            raise ValueError('Gate threshold time out of range')
+        return None
+    if not 0 <= change['channel'] < len(COUNTER_COLUMNS):
+        raise ValueError('No channel {}'.format(change['channel']))
+    if not 0 <= change['config'] <= 2:
+        raise ValueError('Invalid channel config {}'.format(change['config']))
+    for key in ('lowThreshold', 'highThreshold'):
+        if not 0 <= change.get(key, 0) <= ANALOG_MAX:
+            raise ValueError('Analog threshold out of range')
+
+
+def applyChange(config, change):
+    """Returns a copy of the test configuration <config> (see packConfig)
+       with a configuration change (see packCommand) applied."""
+
+    config = dict((key, list(value) if isinstance(value, list) else value)
+                  for key, value in config.items())
+    if 'gateThresholdMicros' in change:
+        config['gateThresholdMicros'] = change['gateThresholdMicros']
+        return config
+    channel = change['channel']
+    discreteCount = len(DISCRETE_COUNTER_COLUMNS)
+    if channel < discreteCount:
+        config['discreteConfig'][channel] = change['config']
+    else:
+        channel -= discreteCount
+        config['analogConfig'][channel] = change['config']
+        config['analogLowThreshold'][channel] = change['lowThreshold']
+        config['analogHighThreshold'][channel] = change['highThreshold']
+    return config
+
+
+def versionRequest(version=PROTOCOL_VERSION, waveformIntervalMicros=0):
+    """Returns the bytes that request (and acknowledge) a protocol version and,
+       from version 3, a waveform capture sample interval."""
+
+    request = VERSION_MAGIC + struct.pack('<B', version)
+    if version >= 3:
+        units = int(round(waveformIntervalMicros /
+                          float(WAVEFORM_INTERVAL_UNIT)))
+        request += struct.pack('<B', min(255, max(0, units)))
+    return request
+
+
+def negotiate(usb, config, version=PROTOCOL_VERSION, timeout=1.0,
+              waveformIntervalMicros=0):
+    """Sends the configuration handshake and negotiates the protocol version.
+
+       Returns the version the Arduino agreed to, or 1 if the firmware does
+       not support version negotiation (it starts sending v1 frames instead
+       of an acknowledgement). Waveform capture at <waveformIntervalMicros>
+       is requested if both sides support version 3."""
+
+    handshake = Handshake(config, version, waveformIntervalMicros)
+    usb.write(handshake.request)
+    agreed = handshake.feed(b'')
+    if agreed is not None:
+        return agreed
+
+    portTimeout = usb.timeout
+    usb.timeout = 0.05
+    try:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            agreed = handshake.feed(usb.read(max(1, usb.in_waiting)))
+            if agreed is not None:
+                return agreed
+    finally:
+        usb.timeout = portTimeout
+    return 1
+
+
+class Handshake(object):
+    """The configuration handshake and protocol version negotiation of
+       negotiate(), for callers that cannot block while waiting for the
+       reply.
+
+       Send self.request to the Arduino, then pass everything received to
+       feed() until it returns the agreed version. If nothing conclusive
+       has arrived after about a second, the firmware does not support
+       negotiation and the version is 1."""
+
+    def __init__(self, config, version=PROTOCOL_VERSION,
+                 waveformIntervalMicros=0):
+        self.version = version
+        self._versionRequest = (versionRequest(version, waveformIntervalMicros)
+                                if version > 1 else b'')
+        self.request = packConfig(config) + self._versionRequest
+        self._received = b''
+
+    def feed(self, data):
+        """Takes bytes received since the request was sent. Returns the
+           agreed version, or None if it is not known yet."""
+
+        if self.version == 1:
+            return 1
+        self._received += data
+        agreed = _acknowledgedVersion(self._received, self.version)
+        if agreed is not None:
+            return agreed
+        if len(self._received) >= FRAMESIZE + len(self._versionRequest):
+            return 1
+        return None
+
+
+def _acknowledgedVersion(received, version):
+    """Returns the version acknowledged in <received>, or None if a complete
+       acknowledgement of a version from 2 to <version> is not there (yet)."""
+
+    start = received.find(VERSION_MAGIC)
+    if start < 0 or len(received) < start + len(VERSION_MAGIC) + 1:
+        return None
+    agreed = bytearray(received)[start + len(VERSION_MAGIC)]
+    if agreed < 2 or agreed > version:
+        return None
+    if len(received) < start + len(versionRequest(agreed)):
+        return None
+    return agreed
+
+
+def crc16(data):
+    """Returns the CRC16-CCITT of a bytes-like object."""
+    crc = 0xFFFF
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC_TABLE[((crc >> 8) ^ byte) & 0xFF]
+    return int(crc)
+
+
+def _crcTable():
+    table = np.zeros(256, dtype=np.int64)
+    for i in range(256):
+        crc = i << 8
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table[i] = crc & 0xFFFF
+    return table
+
+_CRC_TABLE = _crcTable()
+
+
+def packAnalog(values):
+    """Packs an Nx4 array of 10-bit analog values into Nx5 bytes."""
+
+    values = np.asarray(values, dtype=np.uint64) & 0x3FF
+    packed = (values[:, 0] | (values[:, 1] << 10) | (values[:, 2] << 20) |
+              (values[:, 3] << 30))
+    shifts = np.arange(5, dtype=np.uint64) * 8
+    return ((packed[:, None] >> shifts) & 0xFF).astype(np.uint8)
+
+
+def unpackAnalog(packed):
+    """Unpacks Nx5 bytes into an Nx4 array of 10-bit analog values."""
+
+    shifts = np.arange(5, dtype=np.uint64) * 8
+    packed = (packed.astype(np.uint64) << shifts).sum(axis=1)
+    shifts = np.arange(4, dtype=np.uint64) * 10
+    return ((packed[:, None] >> shifts) & 0x3FF).astype(np.int64)
+
+
+class PacketEncoder(object):
+    """Encodes frames as protocol v2 packets, the same way the sketch does.
+
+       Used by the simulator. The first packet and every <keyframeInterval>
+       after it are keyframes. Waveform blocks, command acknowledgements and
+       loop statistics are encoded separately with encodeWaveform(),
+       encodeAck() and encodeLoopStats(). The PC
+       encodes its command packets with encodeCommand()."""
+
+    def __init__(self, keyframeInterval=200):
+        self.keyframeInterval = keyframeInterval
+        self.sequence = 0
+        self.packets = 0
+        self._counters = None
+
+    def encode(self, frames):
+        """Returns the packets for an Nx<SAMPLESIZE> array of frames."""
+
+        frames = np.asarray(frames, dtype=np.int64)
+        analog = packAnalog(frames[:, ANALOG_VALUE_COLUMNS])
+        packets = []
+        for i in range(len(frames)):
+            counters = frames[i, COUNTER_COLUMNS]
+            if self._counters is not None:
+                deltas = counters - self._counters
+            if (self._counters is None or
+                    self.packets % self.keyframeInterval == 0 or
+                    (deltas > 255).any() or (deltas < 0).any()):
+                payload = (struct.pack('<L', frames[i, TIME_COLUMN]) +
+                           counters.astype('<u4').tobytes() +
+                           analog[i].tobytes())
+                packets.append(self._packet(PACKET_KEYFRAME, payload))
+            else:
+                changed = np.flatnonzero(deltas)
+                mask = int((1 << changed).sum())
+                payload = (struct.pack('<HH', frames[i, TIME_COLUMN] & 0xFFFF,
+                                       mask) +
+                           deltas[changed].astype(np.uint8).tobytes() +
+                           analog[i].tobytes())
+                packets.append(self._packet(PACKET_SAMPLE, payload))
+            self._counters = counters
+            self.packets += 1
+        return b''.join(packets)
+
+    def encodeWaveform(self, channel, timeMillis, intervalMicros, samples):
+        """Returns the waveform packet for a block of analog samples."""
+        payload = (struct.pack(WAVEFORM_HEADER_FORMAT, timeMillis,
+                               intervalMicros, channel) +
+                   np.asarray(samples).astype('<u2').tobytes())
+        return self._packet(PACKET_WAVEFORM, payload)
+
+    def encodeCommand(self, change):
+        """Returns the command packet for a configuration change (see
+           packCommand) and its sequence number."""
+        sequence = self.sequence
+        return self._packet(PACKET_COMMAND, packCommand(change)), sequence
+
+    def encodeAck(self, sequence, status, timeMillis):
+        """Returns the acknowledgement packet for a command packet."""
+        return self._packet(PACKET_ACK, struct.pack(ACK_FORMAT, sequence,
+                                                    status, timeMillis))
+
+    def encodeLoopStats(self, stats):
+        """Returns the loop statistics packet for a LoopStats."""
+        return self._packet(PACKET_LOOP_STATS,
+                            struct.pack(LOOP_STATS_FORMAT, *stats))
+
+    def _packet(self, packetType, payload):
+        header = struct.pack('<BBB', packetType, self.sequence, len(payload))
+        self.sequence = (self.sequence + 1) & 0xFF
+        return (SYNC + header + payload +
+                struct.pack('<H', crc16(header + payload)))
+
+
+class PacketDecoder(object):
+    """Streaming decoder for protocol v2 packets.
+
+       Bytes are fed in as they arrive, in chunks of any size, and each valid
+       packet is expanded back into a full <SAMPLESIZE>-word frame so that
+       everything downstream works the same for both protocol versions.
+       Packet boundaries are found from the sync bytes, and every packet's
+       CRC is checked in one vectorized pass over the batch, so corrupt
+       packets are dropped (and counted) rather than displayed. Sequence
+       number gaps are counted as lost packets; any counter increases in
+       them are restored by the next keyframe.
+
+       Waveform blocks are not frames. They are collected as WaveformBlocks
+       until taken with takeWaveforms(). Likewise, command acknowledgements
+       are collected as CommandAcks until taken with takeAcks(), loop
+       statistics as LoopStats until taken with takeLoopStats(), and command
+       packets (only ever received by the simulator) as Commands until taken
+       with takeCommands()."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.locked = False
+        self._waveforms = []
+        self._acks = []
+        self._commands = []
+        self._loopStats = []
+
+        # Reconstructed state after the last decoded packet
+        self.lastTime = None
+        self._counters = np.zeros(len(COUNTER_COLUMNS), dtype=np.int64)
+        self._sequence = None
+
+        # Statistics
+        self.frameCount = 0
+        self.resyncs = 0
+        self.discardedBytes = 0
+        self.crcErrors = 0
+        self.lostPackets = 0
+        self.waveformBlocks = 0
+
+        self._empty = np.zeros((0, SAMPLESIZE), dtype=FRAME_DTYPE)
+
+    def feed(self, data):
+        """Adds received bytes and returns all complete frames decoded so far
+           as an Nx<SAMPLESIZE> uint32 array (N may be 0)."""
+
+        self._buffer.extend(data)
+        raw = bytes(self._buffer)
+        data = np.frombuffer(raw, dtype=np.uint8)
+        starts, types, lengths, end = self._findPackets(data)
+        del self._buffer[:end]
+
+        if len(starts) == 0:
+            return self._empty
+        self._countLost(data[starts + 3])
+
+        waveform = types == PACKET_WAVEFORM
+        if waveform.any():
+            self._decodeWaveforms(raw, starts[waveform], lengths[waveform])
+        message = ((types == PACKET_ACK) | (types == PACKET_COMMAND) |
+                   (types == PACKET_LOOP_STATS))
+        if message.any():
+            self._decodeMessages(raw, starts[message], types[message],
+                                 lengths[message])
+        frame = (types == PACKET_SAMPLE) | (types == PACKET_KEYFRAME)
+        if not frame.any():
+            return self._empty
+        return self._expand(data, starts[frame], types[frame], lengths[frame])
+
+    def takeWaveforms(self):
+        """Returns the WaveformBlocks decoded since the last call."""
+        waveforms, self._waveforms = self._waveforms, []
+        return waveforms
+
+    def takeAcks(self):
+        """Returns the CommandAcks decoded since the last call."""
+        acks, self._acks = self._acks, []
+        return acks
+
+    def takeCommands(self):
+        """Returns the Commands decoded since the last call."""
+        commands, self._commands = self._commands, []
+        return commands
+
+    def takeLoopStats(self):
+        """Returns the LoopStats decoded since the last call."""
+        loopStats, self._loopStats = self._loopStats, []
+        return loopStats
+
+    def _findPackets(self, data):
+        """Locates the valid packets in <data>.
+
+           Returns (starts, types, lengths, end): the start offset, type and
+           payload length of each valid packet, and the number of bytes that
+           can be dropped from the front of the buffer."""
+
+        size = len(data)
+        candidates = np.flatnonzero((data[:-1] == 0xA5) & (data[1:] == 0x5A))
+
+        # Candidates whose header or payload has not fully arrived yet
+        headerEnd = candidates + PACKET_HEADER_SIZE
+        complete = headerEnd <= size
+        lengths = np.zeros(len(candidates), dtype=np.int64)
+        lengths[complete] = data[headerEnd[complete] - 1]
+        complete &= candidates + PACKET_OVERHEAD + lengths <= size
+
+        # Check every complete candidate's CRC at once: one step of the table
+        # driven CRC per byte position, applied to all candidates together
+        valid = np.zeros(len(candidates), dtype=bool)
+        index = np.flatnonzero(complete)
+        if len(index) > 0:
+            covered = lengths[index] + 3
+            offsets = candidates[index] + 2
+            crc = np.full(len(index), 0xFFFF, dtype=np.int64)
+            for j in range(int(covered.max())):
+                active = j < covered
+                byte = data[np.minimum(offsets + j, size - 1)]
+                step = (((crc << 8) & 0xFFFF) ^
+                        _CRC_TABLE[((crc >> 8) ^ byte) & 0xFF])
+                crc = np.where(active, step, crc)
+            crcEnd = offsets + covered
+            received = (data[crcEnd].astype(np.int64) |
+                        (data[crcEnd + 1].astype(np.int64) << 8))
+            valid[index] = crc == received
+
+        # Walk the candidates in order, skipping any that start inside a
+        # packet already accepted. Stop at the first incomplete candidate: it
+        # may yet turn out to be a real packet.
+        starts = []
+        pos = 0
+        end = None
+        for i in range(len(candidates)):
+            start = int(candidates[i])
+            if start < pos:
+                continue
+            if not complete[i]:
+                end = start
+                break
+            if not valid[i]:
+                if self.locked:
+                    self.crcErrors += 1
+                continue
+            if start > pos:
+                self._discard(start - pos)
+            starts.append(start)
+            pos = start + PACKET_OVERHEAD + int(lengths[i])
+            self.locked = True
+
+        # Anything after the last packet that cannot be the start of another
+        # one is dropped. A trailing 0xA5 may be the first sync byte.
+        if end is None:
+            end = size - 1 if size > 0 and data[-1] == 0xA5 else size
+        if end > pos:
+            self._discard(end - pos)
+            pos = end
+
+        starts = np.array(starts, dtype=np.int64)
+        lengths = lengths[np.searchsorted(candidates, starts)]
+        return starts, data[starts + 2], lengths, pos
+
+    def _discard(self, count):
+        """Counts bytes skipped between packets."""
+        if self.locked:
+            self.resyncs += 1
+            self.locked = False
+        self.discardedBytes += count
+
+    def _countLost(self, sequence):
+        """Counts lost packets from gaps in the sequence numbers."""
+
+        sequence = sequence.astype(np.int64)
+        previous = np.empty(len(sequence), dtype=np.int64)
+        previous[0] = (sequence[0] - 1 if self._sequence is None
+                       else self._sequence)
+        previous[1:] = sequence[:-1]
+        self.lostPackets += int(((sequence - previous - 1) & 0xFF).sum())
+        self._sequence = int(sequence[-1])
+
+    def _decodeWaveforms(self, raw, starts, lengths):
+        """Decodes waveform packets, one frombuffer call per block."""
+
+        for start, length in zip(starts, lengths):
+            payload = int(start) + PACKET_HEADER_SIZE
+            timeMillis, intervalMicros, channel = struct.unpack_from(
+                WAVEFORM_HEADER_FORMAT, raw, payload)
+            samples = np.frombuffer(raw, dtype='<u2',
+                count=(int(length) - WAVEFORM_HEADER_SIZE) // 2,
+                offset=payload + WAVEFORM_HEADER_SIZE)
+            self._waveforms.append(WaveformBlock(channel, timeMillis,
+                                                 intervalMicros, samples))
+        self.waveformBlocks += len(starts)
+
+    def _decodeMessages(self, raw, starts, types, lengths):
+        """Decodes command, acknowledgement and loop statistics packets.
+           These are rare, so they are decoded one at a time."""
+
+        for start, packetType, length in zip(starts, types, lengths):
+            payload = raw[int(start) + PACKET_HEADER_SIZE:
+                          int(start) + PACKET_HEADER_SIZE + int(length)]
+            if packetType == PACKET_COMMAND:
+                sequence = struct.unpack_from('<B', raw, int(start) + 3)[0]
+                self._commands.append(Command(sequence, payload))
+            elif packetType == PACKET_LOOP_STATS:
+                if len(payload) == struct.calcsize(LOOP_STATS_FORMAT):
+                    self._loopStats.append(LoopStats(*struct.unpack(
+                        LOOP_STATS_FORMAT, payload)))
+            elif len(payload) == struct.calcsize(ACK_FORMAT):
+                self._acks.append(CommandAck(*struct.unpack(ACK_FORMAT,
+                                                            payload)))
+
+    def _expand(self, data, starts, types, lengths):
+        """Expands the given packets into full frames."""
+
+        count = len(starts)
+        payload = starts + PACKET_HEADER_SIZE
+
+        keyframe = types == PACKET_KEYFRAME
+        frames = np.zeros((count, SAMPLESIZE), dtype=np.int64)
+
+        # Analog values: packed in the last 5 bytes of every payload
+        analogStart = payload + lengths - 5
+        frames[:, ANALOG_VALUE_COLUMNS] = unpackAnalog(
+            data[analogStart[:, None] + np.arange(5)])
+
+        # Keyframes carry absolute time and counters
+        words = payload[keyframe, None] + 4*np.arange(1 + len(COUNTER_COLUMNS))
+        words = (data[words].astype(np.int64) |
+                 (data[words + 1].astype(np.int64) << 8) |
+                 (data[words + 2].astype(np.int64) << 16) |
+                 (data[words + 3].astype(np.int64) << 24))
+        keyTimes = words[:, 0]
+        keyCounters = words[:, 1:]
+
+        # Samples carry the low 16 bits of time, and counter increases for
+        # the counters flagged in the mask, one byte each in bit order
+        low = (data[payload].astype(np.int64) |
+               (data[payload + 1].astype(np.int64) << 8))
+        mask = (data[payload + 2].astype(np.int64) |
+                (data[payload + 3].astype(np.int64) << 8))
+        mask[keyframe] = 0
+        bits = (mask[:, None] >> np.arange(len(COUNTER_COLUMNS))) & 1
+        rows, channels = np.nonzero(bits)
+        firstDelta = np.cumsum(bits.sum(axis=1)) - bits.sum(axis=1)
+        deltaIndex = (payload[rows] + 4 + np.arange(len(rows)) -
+                      firstDelta[rows])
+        deltas = np.zeros((count, len(COUNTER_COLUMNS)), dtype=np.int64)
+        deltas[rows, channels] = data[deltaIndex]
+
+        # Rebuild absolute time and counters. Each keyframe restarts the
+        # running totals, so they are accumulated one segment at a time.
+        times = np.zeros(count, dtype=np.int64)
+        counters = np.zeros((count, len(COUNTER_COLUMNS)), dtype=np.int64)
+        keyIndex = np.flatnonzero(keyframe)
+        bounds = [0] + list(keyIndex) + [count]
+        for k in range(len(bounds) - 1):
+            first, last = bounds[k], bounds[k+1]
+            if first == last:
+                continue
+            if keyframe[first]:
+                key = np.searchsorted(keyIndex, first)
+                baseTime = keyTimes[key]
+                baseCounters = keyCounters[key]
+                times[first] = baseTime
+                counters[first] = baseCounters
+                first += 1
+            else:
+                baseTime = 0 if self.lastTime is None else self.lastTime
+                baseCounters = self._counters
+            if first == last:
+                continue
+
+            lows = low[first:last]
+            previousLows = np.empty_like(lows)
+            previousLows[0] = baseTime & 0xFFFF
+            previousLows[1:] = lows[:-1]
+            times[first:last] = baseTime + np.cumsum((lows - previousLows) &
+                                                     0xFFFF)
+            counters[first:last] = baseCounters + np.cumsum(
+                deltas[first:last], axis=0)
+
+        frames[:, TIME_COLUMN] = times
+        frames[:, COUNTER_COLUMNS] = counters
+        self.lastTime = int(times[-1]) & 0xFFFFFFFF
+        self._counters = counters[-1].copy()
+        self.frameCount += count
+        return frames.astype(FRAME_DTYPE)
+
+
+class FrameDecoder(object):
+    """Streaming decoder for the fixed-size binary frames sent by the Arduino.
+
+       Bytes are fed in as they arrive, in chunks of any size. Complete frames
+       are decoded in one vectorized pass and returned as an Nx<SAMPLESIZE>
+       array. The frames carry no sync header, so frame boundaries are found
+       by checking that the contents are plausible: elapsed time only moves
+       forward (by no more than MAX_FRAME_GAP_MILLIS) and analog values are
+       within the 10-bit ADC range. If a byte is dropped or inserted, the
+       decoder notices the first implausible frame, searches the following
+       bytes for the offset where <confirmFrames> consecutive frames line up
+       again, and carries on from there."""
+
+    def __init__(self, bufferFrames=1024, confirmFrames=4):
+        # Reusable receive buffer. Incoming data larger than the buffer is
+        # processed in chunks, so the buffer never needs to grow.
+        self.bufferSize = bufferFrames * FRAMESIZE
+        self._buffer = bytearray(self.bufferSize)
+        self._fill = 0
+
+        # Number of consecutive plausible frames needed to (re)acquire lock
+        self.confirmFrames = confirmFrames
+
+        # Word indices for viewing a resync window at every possible byte
+        # offset: shape (FRAMESIZE, confirmFrames, SAMPLESIZE)
+        self._resyncIndex = (np.arange(FRAMESIZE).reshape(-1, 1, 1) +
+                             4*np.arange(confirmFrames*SAMPLESIZE).reshape(
+                                 1, confirmFrames, SAMPLESIZE))
+
+        # If this many bytes are discarded without finding a frame boundary
+        # consistent with the last good frame, the last good time is
+        # forgotten. This lets the decoder recover if the Arduino restarts and
+        # its elapsed time goes back to zero.
+        self.relockBytes = 16 * FRAMESIZE
+
+        self.locked = False
+        self.lastTime = None
+
+        # Statistics
+        self.frameCount = 0
+        self.resyncs = 0
+        self.discardedBytes = 0
+        self._unlockedBytes = 0
+
+        self._empty = np.zeros((0, SAMPLESIZE), dtype=FRAME_DTYPE)
+
+    def feed(self, data):
+        """Adds received bytes and returns all complete frames decoded so far.
+
+           Returns an Nx<SAMPLESIZE> array of uint32 (N may be 0). The array
+           is a copy, so it remains valid after later calls to feed()."""
+
+        decoded = []
+        view = memoryview(data)
+        while len(view) > 0:
+            count = min(len(view), self.bufferSize - self._fill)
+            self._buffer[self._fill:self._fill + count] = view[:count]
+            self._fill += count
+            view = view[count:]
+            decoded.extend(self._decode())
+
+        if len(decoded) == 0:
+            return self._empty
+        elif len(decoded) == 1:
+            return decoded[0]
+        return np.concatenate(decoded)
+
+    def reset(self):
+        """Discards buffered bytes and forgets the current frame alignment."""
+        self._fill = 0
+        self.locked = False
+        self.lastTime = None
+        self._unlockedBytes = 0
+
+    def _decode(self):
+        """Decodes all complete frames in the buffer and compacts it."""
+
+        decoded = []
+        pos = 0
+        while True:
+            if not self.locked:
+                pos = self._resync(pos)
+                if not self.locked:
+                    break
+
+            count = (self._fill - pos) // FRAMESIZE
+            if count == 0:
+                break
+
+            frames = self._frames(pos, count)
+            ok = self._plausible(frames)
+            good = count if ok.all() else int(np.argmin(ok))
+            if good > 0:
+                decoded.append(frames[:good].copy())
+                self.lastTime = int(frames[good-1, TIME_COLUMN])
+                self.frameCount += good
+                pos += good * FRAMESIZE
+
+            # Implausible frame: the stream has slipped. Search for the new
+            # frame boundary starting one byte further on.
+            if good < count:
+                self.locked = False
+                self.resyncs += 1
+                self.discardedBytes += 1
+                self._unlockedBytes = 1
+                pos += 1
+
+        # Move any partial frame to the start of the buffer
+        remaining = self._fill - pos
+        if pos > 0 and remaining > 0:
+            self._buffer[:remaining] = self._buffer[pos:self._fill]
+        self._fill = remaining
+        return decoded
+
+    def _resync(self, pos):
+        """Searches for a frame boundary starting at byte <pos>.
+
+           All FRAMESIZE possible byte offsets are tested at once against a
+           window of <confirmFrames> frames. Of the offsets where every frame
+           in the window is plausible, the one where elapsed time advances the
+           most is chosen: a misaligned view of the stream sees either a
+           shifted copy of the time word (which advances more slowly) or
+           another column entirely (which barely changes at all).
+
+           Sets self.locked and returns the boundary position if one is found.
+           Otherwise returns the position up to which bytes can be discarded."""
+
+        need = self.confirmFrames * FRAMESIZE + FRAMESIZE - 1
+        start = pos
+        while self._fill - pos >= need:
+            # Assemble the little-endian word starting at every byte position
+            raw = np.frombuffer(self._buffer, dtype=np.uint8, count=need,
+                                offset=pos).astype(FRAME_DTYPE)
+            words = raw[:-3] | (raw[1:-2] << 8) | (raw[2:-1] << 16) | (raw[3:] << 24)
+            candidates = words[self._resyncIndex]
+
+            ok = self._plausible(candidates).all(axis=1)
+            if not ok.any():
+                pos += FRAMESIZE
+                continue
+
+            advance = (candidates[:, -1, TIME_COLUMN].astype(np.int64) -
+                       candidates[:, 0, TIME_COLUMN]) & 0xFFFFFFFF
+            advance[~ok] = -1
+            pos += int(np.argmax(advance))
+            self.locked = True
+            break
+
+        self.discardedBytes += pos - start
+        self._unlockedBytes += pos - start
+        if self.locked:
+            self._unlockedBytes = 0
+        elif self._unlockedBytes >= self.relockBytes:
+            self.lastTime = None
+        return pos
+
+    def _frames(self, pos, count):
+        """Returns a view of <count> frames in the buffer starting at <pos>."""
+        return np.frombuffer(self._buffer, dtype=FRAME_DTYPE,
+                             count=count*SAMPLESIZE,
+                             offset=pos).reshape(count, SAMPLESIZE)
+
+    def _plausible(self, frames):
+        """Returns a boolean array flagging frames that look correctly aligned.
+
+           <frames> has shape (..., N, SAMPLESIZE); the result has shape
+           (..., N)."""
+
+        times = frames[..., TIME_COLUMN].astype(np.int64)
+        previous = np.empty_like(times)
+        if self.lastTime is None:
+            previous[..., 0] = times[..., 0]
+        else:
+            previous[..., 0] = self.lastTime
+        previous[..., 1:] = times[..., :-1]
+        # Taken modulo 2**32, so the Arduino's millis() wrapping is a step
+        # like any other
+        step = (times - previous) & 0xFFFFFFFF
+
+        return ((step <= MAX_FRAME_GAP_MILLIS) &
+                (frames[..., ANALOG_VALUE_COLUMNS] <= ANALOG_MAX).all(axis=-1))
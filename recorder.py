@@ -0,0 +1,343 @@
+# Session recording. Every frame received from the Arduino is appended to a
+# binary session file by a background writer thread, and can be exported to
+# CSV or NumPy arrays afterwards.
+#
+# Session file layout:
+#
+#   Offset      Contents
+#   0           Magic bytes b'SVBREC'
+#   6           Format version (<H)
+#   8           Words per frame (<H)
+#   10          Header size in bytes, including this fixed part (<L)
+#   14          Test configuration as UTF-8 JSON, padded with spaces to the
+#               header size
+#   headerSize  Frames, each <SAMPLESIZE> little-endian uint32 words, back to
+#               back until the end of the file
+#
+# The header size is always a multiple of HEADER_ALIGN so the frame data can be
+# memory-mapped directly.
+#
+# Configuration changes made during the test (see devices.Device.configure)
+# are logged next to the session file, in a file with the extension
+# CHANGES_EXTENSION holding one JSON object per line:
+#
+#   time      Elapsed time (ms) of the last frame measured with the old
+#             configuration, or null if the change was not applied to the
+#             running test (see devices.CHANGE_DEFERRED)
+#   hostTime  PC time of the change, ISO format
+#   change    The change, as taken by protocol.packCommand
+#   status    One of the devices.CHANGE_ outcomes
+#
+# There is no changes file if nothing was changed.
+#
+# The alignment of the frame times with the PC clock (see timebase.py) is
+# logged in the same way, in a file with the extension TIMEBASE_EXTENSION
+# holding one checkpoint per line:
+#
+#   time        Elapsed time (ms), unwrapped to 64 bits
+#   hostTime    PC time (Unix seconds) at which the frame at that elapsed time
+#               was sent
+#   clockError  Rate error of the Arduino's clock in ppm (positive if fast),
+#               or null before it could be measured
+#
+# Loop statistics of the sketch (protocol v5, see protocol.LoopStats) are
+# logged once a second in a file with the extension LOOP_EXTENSION:
+#
+#   time        Elapsed time (ms), unwrapped to 64 bits
+#   scans       Number of scans of the inputs in the last second
+#   minMicros   Minimum, mean and maximum scan time in microseconds. The gate
+#   meanMicros  threshold time is only resolved to about the maximum.
+#   maxMicros
+#
+# Frame times in the session file are the 32-bit elapsed times as received,
+# which wrap after about 49.7 days; session.SessionFile unwraps them.
+#
+# This module must not import Kivy.
+#
+# Usage from the command line:
+#   python recorder.py <session file> [<csv file>]
+
+import json
+import os
+import re
+import struct
+import sys
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from framebuffer import FrameRingBuffer
+from protocol import (COLUMN_NAMES, FRAME_DTYPE, FRAMESIZE, SAMPLESIZE,
+                      TIME_COLUMN)
+from timebase import hostTimes, unwrapMillis
+
+SESSION_MAGIC = b'SVBREC'
+SESSION_VERSION = 1
+SESSION_EXTENSION = '.svb'
+CHANGES_EXTENSION = '.changes.jsonl'
+TIMEBASE_EXTENSION = '.timebase.jsonl'
+LOOP_EXTENSION = '.loop.jsonl'
+HEADER_FORMAT = '<6sHHL'
+HEADER_ALIGN = 512
+
+
+def sessionPath(directory, name=None):
+    """Returns the path of a new session file in <directory>, named after the
+       current time and, if given, the fixture <name>. If a session file of
+       that name already exists (a test started in the same second), a
+       suffix -1, -2, ... is added. The directory is created if needed."""
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fileName = datetime.now().strftime('%Y%m%d-%H%M%S')
+    if name is not None:
+        fileName += '-' + re.sub(r'[^\w-]+', '_', name)
+    path = os.path.join(directory, fileName + SESSION_EXTENSION)
+    suffix = 0
+    while os.path.exists(path):
+        suffix += 1
+        path = os.path.join(directory, '{}-{}{}'.format(
+            fileName, suffix, SESSION_EXTENSION))
+    return path
+
+
+def writeHeader(f, config):
+    """Writes the session header to an open binary file."""
+
+    configBytes = json.dumps(config, sort_keys=True).encode('utf-8')
+    fixedSize = struct.calcsize(HEADER_FORMAT)
+    headerSize = fixedSize + len(configBytes)
+    headerSize = -(-headerSize // HEADER_ALIGN) * HEADER_ALIGN
+
+    f.write(struct.pack(HEADER_FORMAT, SESSION_MAGIC, SESSION_VERSION,
+                        SAMPLESIZE, headerSize))
+    f.write(configBytes.ljust(headerSize - fixedSize, b' '))
+
+
+def readHeader(f):
+    """Reads the session header from an open binary file.
+
+       Returns (config, headerSize). Raises ValueError if the file is not a
+       session recording."""
+
+    fixedSize = struct.calcsize(HEADER_FORMAT)
+    fixed = f.read(fixedSize)
+    if len(fixed) < fixedSize:
+        raise ValueError('Not a ShockVibeBox session file')
+    magic, version, sampleSize, headerSize = struct.unpack(HEADER_FORMAT,
+                                                           fixed)
+    if magic != SESSION_MAGIC:
+        raise ValueError('Not a ShockVibeBox session file')
+    if version != SESSION_VERSION or sampleSize != SAMPLESIZE:
+        raise ValueError('Unsupported session file version {} ({} words per '
+                         'frame)'.format(version, sampleSize))
+
+    config = json.loads(f.read(headerSize - fixedSize).decode('utf-8'))
+    return config, headerSize
+
+
+def changesPath(path):
+    """Returns the path of the configuration changes log of a session
+       file."""
+    return os.path.splitext(path)[0] + CHANGES_EXTENSION
+
+
+def readChanges(path):
+    """Returns the configuration changes logged for a session file, oldest
+       first, as a list of dicts. A partial line at the end of the log (e.g.
+       after a crash) is ignored."""
+    return _readLog(changesPath(path))
+
+
+def timebasePath(path):
+    """Returns the path of the timebase log of a session file."""
+    return os.path.splitext(path)[0] + TIMEBASE_EXTENSION
+
+
+def readTimebase(path):
+    """Returns the timebase checkpoints logged for a session file, oldest
+       first, as a list of dicts (empty for sessions recorded without
+       them)."""
+    return _readLog(timebasePath(path))
+
+
+def loopPath(path):
+    """Returns the path of the loop statistics log of a session file."""
+    return os.path.splitext(path)[0] + LOOP_EXTENSION
+
+
+def readLoopStats(path):
+    """Returns the loop statistics logged for a session file, oldest first,
+       as a list of dicts (empty for sessions recorded without them)."""
+    return _readLog(loopPath(path))
+
+
+def _readLog(logPath):
+    try:
+        with open(logPath) as f:
+            lines = f.readlines()
+    except IOError:
+        return []
+
+    entries = []
+    for line in lines:
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            break
+    return entries
+
+
+def readSession(path):
+    """Loads a whole session file.
+
+       Returns (config, frames) where frames is an Nx<SAMPLESIZE> uint32
+       array. A partial frame at the end of the file (e.g. after a crash) is
+       ignored."""
+
+    with open(path, 'rb') as f:
+        config, headerSize = readHeader(f)
+        data = f.read()
+
+    count = len(data) // FRAMESIZE
+    frames = np.frombuffer(data, dtype=FRAME_DTYPE, count=count*SAMPLESIZE)
+    return config, frames.reshape(count, SAMPLESIZE)
+
+
+def exportCsv(path, csvPath=None):
+    """Exports a session file to CSV. Returns the path of the CSV file.
+
+       By default the CSV file is written next to the session file. Times
+       are unwrapped (see timebase.py), and if the session has a timebase
+       log a last column gives the PC time (Unix seconds) of each frame."""
+
+    if csvPath is None:
+        csvPath = os.path.splitext(path)[0] + '.csv'
+
+    config, frames = readSession(path)
+    columns = frames.astype(np.int64)
+    columns[:, TIME_COLUMN] = unwrapMillis(frames[:, TIME_COLUMN])
+    names = list(COLUMN_NAMES)
+    formats = ['%d']*SAMPLESIZE
+    host = hostTimes(readTimebase(path), columns[:, TIME_COLUMN])
+    if host is not None and len(frames):
+        columns = np.column_stack((columns, host))
+        names.append('host_time')
+        formats.append('%.3f')
+    np.savetxt(csvPath, columns, fmt=formats, delimiter=',',
+               header=','.join(names), comments='')
+    return csvPath
+
+
+class SessionRecorder(threading.Thread):
+    """Background writer that appends every received frame to a session file.
+
+       The serial reader calls write(), which only copies the frames into a
+       ring buffer and never touches the disk. The writer thread drains that
+       buffer every <syncInterval> seconds, appends the frames in one write
+       and fsyncs the file, so a crash loses at most one interval of data.
+       An existing file at <path> is never overwritten: FileExistsError is
+       raised instead (see sessionPath()).
+
+       self.changeLog, self.timebaseLog and self.loopLog are the sinks for
+       the configuration changes, timebase checkpoints and loop statistics
+       of the test (see devices.Device). They are appended to their logs by
+       the writer thread in the same way."""
+
+    def __init__(self, path, config, syncInterval=1.0, bufferFrames=8192):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.syncInterval = syncInterval
+        self.frames = FrameRingBuffer(bufferFrames)
+        self.framesWritten = 0
+        self.changeLog = LogQueue()
+        self.timebaseLog = LogQueue()
+        self.loopLog = LogQueue()
+        self._logs = [(self.changeLog, changesPath(path)),
+                      (self.timebaseLog, timebasePath(path)),
+                      (self.loopLog, loopPath(path))]
+        self._logFiles = {}
+
+        self._stopEvent = threading.Event()
+        # Never overwrite an existing recording
+        self._file = open(path, 'xb')
+        writeHeader(self._file, config)
+        self._sync(self._file)
+
+    def write(self, frames):
+        """Queues an Nx<SAMPLESIZE> array of frames for writing."""
+        self.frames.write(frames)
+
+    def run(self):
+        while not self._stopEvent.wait(self.syncInterval):
+            self._flush()
+        self._flush()
+        self._file.close()
+        for f in self._logFiles.values():
+            f.close()
+
+    def stop(self):
+        """Writes any remaining frames and closes the file."""
+        self._stopEvent.set()
+        self.join()
+
+    @property
+    def framesDropped(self):
+        """Frames lost because the disk fell too far behind."""
+        return self.frames.overwritten
+
+    def _flush(self):
+        frames = self.frames.drain()
+        if len(frames) > 0:
+            self._file.write(frames.tobytes())
+            self.framesWritten += len(frames)
+            self._sync(self._file)
+
+        # Changes and checkpoints are logged after the frames they refer to
+        for queue, logPath in self._logs:
+            entries = queue.drain()
+            if not entries:
+                continue
+            f = self._logFiles.get(logPath)
+            if f is None:
+                f = self._logFiles[logPath] = open(logPath, 'a')
+            for entry in entries:
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+            self._sync(f)
+
+    def _sync(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class LogQueue(object):
+    """Queue of the entries of a JSON lines log (configuration changes or
+       timebase checkpoints), filled by devices.Device and drained by
+       SessionRecorder."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = []
+        self.count = 0
+
+    def write(self, entries):
+        """Queues a list of dicts for logging."""
+        with self._lock:
+            self._entries.extend(entries)
+            self.count += len(entries)
+
+    def drain(self):
+        """Returns and removes every queued entry."""
+        with self._lock:
+            entries, self._entries = self._entries, []
+        return entries
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python recorder.py <session file> [<csv file>]')
+        raise SystemExit(1)
+
+    print('Exported to ' + exportCsv(*sys.argv[1:3]))
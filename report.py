@@ -0,0 +1,406 @@
+# Batch reports over a directory of recorded sessions, e.g. after a
+# qualification campaign. For every session file this works out:
+#
+#   - the number of events on each enabled channel
+#   - each channel's events per rate bin (one minute by default), for event
+#     rate curves
+#   - the time of the first event on each channel and on any channel (time to
+#     first failure)
+#   - for each enabled analog channel the level's min, max, mean and SD, and
+#     its excursions outside the threshold window: how many, the total and
+#     longest time outside and the peak distance beyond the threshold
+#
+# Sessions are summarised in parallel by a pool of worker processes. Each
+# worker memory-maps its session (see session.py) and reads it in chunks of
+# CHUNK_FRAMES, so memory use does not depend on the length of the test, and
+# returns a small summary; workers share nothing. The summary of each session
+# is written to <output>/sessions/<session>.json and reused on the next run as
+# long as the session file has not changed, so only new or changed sessions
+# are read. All summaries are combined in <output>/report.csv, with one row
+# per session and channel.
+#
+# This module must not import Kivy.
+#
+# Usage from the command line:
+#   python report.py <recording dir> [--output DIR] [--workers N]
+#                    [--rate-bin SECONDS] [--force]
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from events import CHANNEL_NAMES
+from protocol import ANALOG_VALUE_COLUMNS, COUNTER_COLUMNS, TIME_COLUMN
+from recorder import SESSION_EXTENSION
+from session import SessionFile
+from timebase import TimeUnwrapper
+
+# Version of the summary format. Cached summaries of another version are
+# worked out again.
+REPORT_VERSION = 1
+
+# Frames read from a session at a time
+CHUNK_FRAMES = 1 << 20
+
+# Default length in seconds of the bins of the event rate curves
+RATE_BIN_SECONDS = 60
+
+# Columns of the combined report
+REPORT_COLUMNS = ['session', 'fixture', 'startTime', 'frames', 'duration',
+                  'firstFailure', 'channel', 'events', 'firstEvent',
+                  'peakEventsPerBin', 'levelMin', 'levelMax', 'levelMean',
+                  'levelStd', 'excursions', 'timeOutside', 'longestExcursion',
+                  'peakExcursion', 'error']
+
+
+class _Excursions(object):
+    """Runs of an analog level outside its threshold window, followed across
+       the chunks of a session."""
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self.count = 0
+        self.totalMillis = 0
+        self.longestMillis = 0
+        self.peak = 0
+        # Start time and peak of a run still open at the end of the last
+        # chunk
+        self.openStart = None
+        self.openPeak = 0
+
+    def add(self, times, values):
+        beyond = np.maximum(self.low - values, values - self.high)
+        outside = np.flatnonzero(beyond > 0)
+        if len(outside) == 0:
+            if self.openStart is not None:
+                self._close(int(times[0]), self.openStart)
+            return None
+
+        # Runs of consecutive outside frames
+        breaks = np.flatnonzero(np.diff(outside) > 1) + 1
+        firsts = outside[np.concatenate(([0], breaks))]
+        lasts = outside[np.concatenate((breaks - 1, [-1]))]
+        peaks = np.maximum.reduceat(beyond[outside],
+                                    np.concatenate(([0], breaks)))
+        starts = times[firsts].astype(np.int64)
+
+        # An open run continues if the chunk starts outside, and is closed
+        # by the first frame otherwise
+        if self.openStart is not None:
+            if firsts[0] == 0:
+                starts[0] = self.openStart
+                peaks[0] = max(peaks[0], self.openPeak)
+                self.count -= 1
+            else:
+                self._close(int(times[0]), self.openStart)
+
+        self.count += len(firsts)
+        self.peak = max(self.peak, int(peaks.max()))
+        closed = lasts + 1 < len(times)
+        durations = times[lasts[closed] + 1].astype(np.int64) - \
+            starts[closed]
+        self.totalMillis += int(durations.sum())
+        if len(durations):
+            self.longestMillis = max(self.longestMillis,
+                                     int(durations.max()))
+        if closed[-1]:
+            self.openStart = None
+        else:
+            self.openStart = int(starts[-1])
+            self.openPeak = int(peaks[-1])
+
+    def _close(self, endMillis, startMillis):
+        self.totalMillis += endMillis - startMillis
+        self.longestMillis = max(self.longestMillis, endMillis - startMillis)
+        self.openStart = None
+
+    def finish(self, stopMillis):
+        """Closes a run still open at the end of the session."""
+        if self.openStart is not None:
+            self._close(stopMillis, self.openStart)
+
+
+def summarizeSession(path, rateBinSeconds=RATE_BIN_SECONDS):
+    """Works out the summary of one session file (see the top of this
+       module). Returns a dict that can be written as JSON."""
+
+    binMillis = int(rateBinSeconds * 1000)
+    with SessionFile(path) as session:
+        config = session.config
+        enabled = [channel for channel, channelConfig in
+                   enumerate(config['discreteConfig'] +
+                             config['analogConfig'])
+                   if channelConfig != 0]
+        analog = [channel - 8 for channel in enabled if channel >= 8]
+        excursions = dict((channel, _Excursions(
+            config['analogLowThreshold'][channel],
+            config['analogHighThreshold'][channel])) for channel in analog)
+
+        frames = session.array()
+        channels = len(CHANNEL_NAMES)
+        lastCounters = np.zeros(channels, dtype=np.int64)
+        totals = np.zeros(channels, dtype=np.int64)
+        firstEvents = [None]*channels
+        curve = np.zeros((0, channels), dtype=np.int64)
+        firstBin = None
+        levelCount = 0
+        levelMean = np.zeros(4)
+        levelM2 = np.zeros(4)
+        levelMin = np.full(4, np.inf)
+        levelMax = np.full(4, -np.inf)
+        unwrapper = TimeUnwrapper()
+        startMillis = None
+
+        for start in range(0, len(frames), CHUNK_FRAMES):
+            chunk = np.array(frames[start:start + CHUNK_FRAMES])
+            times = unwrapper.unwrap(chunk[:, TIME_COLUMN])
+            if startMillis is None:
+                startMillis = int(times[0])
+
+            # As in events.EventLog, a counter going down means the Arduino
+            # restarted and the new value is the baseline
+            counters = chunk[:, COUNTER_COLUMNS].astype(np.int64)
+            previous = np.concatenate((lastCounters[None], counters[:-1]))
+            deltas = np.maximum(counters - previous, 0)
+            lastCounters = counters[-1]
+            totals += deltas.sum(axis=0)
+            for channel in enabled:
+                if firstEvents[channel] is None:
+                    rows = np.flatnonzero(deltas[:, channel])
+                    if len(rows):
+                        firstEvents[channel] = int(times[rows[0]])
+
+            # Events per rate bin; frame times only increase
+            bins = times // binMillis
+            if firstBin is None:
+                firstBin = int(bins[0])
+            binStarts = np.concatenate(([0],
+                                        np.flatnonzero(np.diff(bins)) + 1))
+            binIndices = bins[binStarts] - firstBin
+            if binIndices[-1] >= len(curve):
+                grown = np.zeros((binIndices[-1] + 1, channels),
+                                 dtype=np.int64)
+                grown[:len(curve)] = curve
+                curve = grown
+            curve[binIndices] += np.add.reduceat(deltas, binStarts)
+
+            # Analog levels, merged chunk by chunk (Welford's method, as in
+            # rollingstats.RollingStats)
+            levels = chunk[:, ANALOG_VALUE_COLUMNS].astype(np.float64)
+            count = len(levels)
+            mean = levels.mean(axis=0)
+            total = levelCount + count
+            delta = mean - levelMean
+            levelMean += delta * count / total
+            levelM2 += (np.square(levels - mean).sum(axis=0) +
+                        delta**2 * levelCount * count / total)
+            levelCount = total
+            levelMin = np.minimum(levelMin, levels.min(axis=0))
+            levelMax = np.maximum(levelMax, levels.max(axis=0))
+
+            for channel, excursion in excursions.items():
+                excursion.add(times, chunk[:, ANALOG_VALUE_COLUMNS[channel]]
+                              .astype(np.int64))
+
+        stopMillis = unwrapper.last
+        summary = {
+            'session': os.path.basename(path),
+            'fixture': config.get('fixture'),
+            'startTime': config.get('startTime'),
+            'frames': len(frames),
+            'startMillis': startMillis,
+            'stopMillis': stopMillis,
+            'durationMillis': session.duration,
+            'rateBinSeconds': rateBinSeconds,
+            'firstBinMillis': None if firstBin is None
+                              else firstBin * binMillis,
+            'channels': {} }
+
+    failures = [(firstEvents[channel], CHANNEL_NAMES[channel])
+                for channel in enabled if firstEvents[channel] is not None]
+    first = min(failures) if failures else (None, None)
+    summary['firstFailureMillis'], summary['firstFailureChannel'] = first
+
+    for channel in enabled:
+        result = {'events': int(totals[channel]),
+                  'firstEventMillis': firstEvents[channel],
+                  'eventsPerBin': curve[:, channel].tolist()}
+        if channel >= 8 and levelCount:
+            index = channel - 8
+            excursion = excursions[index]
+            excursion.finish(stopMillis)
+            result.update({
+                'levelMin': int(levelMin[index]),
+                'levelMax': int(levelMax[index]),
+                'levelMean': float(levelMean[index]),
+                'levelStd': float(np.sqrt(levelM2[index] / levelCount)),
+                'excursions': excursion.count,
+                'timeOutsideMillis': excursion.totalMillis,
+                'longestExcursionMillis': excursion.longestMillis,
+                'peakExcursion': excursion.peak })
+        summary['channels'][CHANNEL_NAMES[channel]] = result
+    return summary
+
+
+def _sessionSource(path):
+    """Returns what identifies the contents of a session file for caching."""
+    status = os.stat(path)
+    return {'size': status.st_size, 'mtime': status.st_mtime}
+
+
+def _summaryJob(job):
+    """Pool worker: summarises one session. Any error is returned in the
+       summary, so that one bad session does not stop the report."""
+
+    path, rateBinSeconds = job
+    source = _sessionSource(path)
+    try:
+        summary = summarizeSession(path, rateBinSeconds)
+    except Exception as error:
+        summary = {'session': os.path.basename(path), 'channels': {},
+                   'error': '{}: {}'.format(type(error).__name__, error)}
+    summary['reportVersion'] = REPORT_VERSION
+    summary['rateBinSeconds'] = rateBinSeconds
+    summary['source'] = source
+    return summary
+
+
+def _cachePath(outputDir, path):
+    return os.path.join(outputDir, 'sessions',
+                        os.path.basename(path) + '.json')
+
+
+def _cachedSummary(cachePath, path, rateBinSeconds):
+    """Returns the cached summary of a session if it is still valid."""
+
+    try:
+        with open(cachePath) as f:
+            summary = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if (summary.get('reportVersion') != REPORT_VERSION or
+            summary.get('source') != _sessionSource(path) or
+            summary.get('rateBinSeconds') != rateBinSeconds):
+        return None
+    return summary
+
+
+def summarizeSessions(paths, outputDir, workers=None,
+                      rateBinSeconds=RATE_BIN_SECONDS, force=False):
+    """Summarises session files in parallel, reusing the cached summaries in
+       <outputDir>/sessions of those that have not changed (unless <force>).
+       <workers> defaults to the number of CPUs.
+
+       Returns (summaries, computed): the summaries in the order of <paths>
+       and the number that were worked out rather than cached."""
+
+    cacheDir = os.path.join(outputDir, 'sessions')
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+
+    summaries = {}
+    jobs = []
+    for path in paths:
+        cached = None if force else _cachedSummary(
+            _cachePath(outputDir, path), path, rateBinSeconds)
+        if cached is None:
+            jobs.append((path, rateBinSeconds))
+        else:
+            summaries[path] = cached
+
+    if jobs:
+        pool = multiprocessing.Pool(min(workers or multiprocessing.cpu_count(),
+                                        len(jobs)))
+        try:
+            # Longest sessions first, so one long session does not start last
+            jobs.sort(key=lambda job: -os.path.getsize(job[0]))
+            for (path, rate), summary in zip(
+                    jobs, pool.imap(_summaryJob, jobs)):
+                with open(_cachePath(outputDir, path), 'w') as f:
+                    json.dump(summary, f, indent=1, sort_keys=True)
+                summaries[path] = summary
+        finally:
+            pool.close()
+            pool.join()
+
+    return [summaries[path] for path in paths], len(jobs)
+
+
+def _seconds(millis):
+    return '' if millis is None else '{:.3f}'.format(millis / 1000.0)
+
+
+def writeReport(summaries, path):
+    """Writes the combined report (CSV, one row per session and enabled
+       channel, times in seconds)."""
+
+    with open(path, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(REPORT_COLUMNS)
+        for summary in summaries:
+            session = [summary['session'], summary.get('fixture', ''),
+                       summary.get('startTime', ''), summary.get('frames', ''),
+                       _seconds(summary.get('durationMillis')),
+                       _seconds(summary.get('firstFailureMillis'))]
+            if 'error' in summary:
+                writer.writerow(session + ['']*12 + [summary['error']])
+                continue
+            for name in CHANNEL_NAMES:
+                if name not in summary['channels']:
+                    continue
+                channel = summary['channels'][name]
+                writer.writerow(session + [
+                    name, channel['events'],
+                    _seconds(channel['firstEventMillis']),
+                    max(channel['eventsPerBin'] or [0]),
+                    channel.get('levelMin', ''), channel.get('levelMax', ''),
+                    '' if 'levelMean' not in channel
+                    else '{:.1f}'.format(channel['levelMean']),
+                    '' if 'levelStd' not in channel
+                    else '{:.1f}'.format(channel['levelStd']),
+                    channel.get('excursions', ''),
+                    _seconds(channel.get('timeOutsideMillis')),
+                    _seconds(channel.get('longestExcursionMillis')),
+                    channel.get('peakExcursion', ''), ''])
+
+
+def sessionFiles(directory):
+    """Returns the session files in a directory, sorted by name (and so by
+       start time)."""
+    return [os.path.join(directory, name)
+            for name in sorted(os.listdir(directory))
+            if name.endswith(SESSION_EXTENSION)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Summarise a directory of recorded sessions')
+    parser.add_argument('directory', help='directory of session files')
+    parser.add_argument('--output',
+                        help='report directory (default <directory>/report)')
+    parser.add_argument('--workers', type=int,
+                        help='worker processes (default one per CPU)')
+    parser.add_argument('--rate-bin', type=float, default=RATE_BIN_SECONDS,
+                        help='seconds per bin of the event rate curves '
+                             '(default {})'.format(RATE_BIN_SECONDS))
+    parser.add_argument('--force', action='store_true',
+                        help='summarise every session, ignoring the cache')
+    args = parser.parse_args()
+
+    outputDir = args.output or os.path.join(args.directory, 'report')
+    paths = sessionFiles(args.directory)
+    summaries, computed = summarizeSessions(paths, outputDir, args.workers,
+                                            args.rate_bin, args.force)
+    reportPath = os.path.join(outputDir, 'report.csv')
+    writeReport(summaries, reportPath)
+    print('{} sessions ({} summarised, {} cached), report written to '
+          '{}'.format(len(paths), computed, len(paths) - computed,
+                      reportPath))
+    for summary in summaries:
+        if 'error' in summary:
+            print('{}: {}'.format(summary['session'], summary['error']))
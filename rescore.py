@@ -0,0 +1,227 @@
+# Offline "what-if" re-scoring. Reimplements the event detection of the
+# Arduino sketch (the discreteState/analogState logic in loop()) over recorded
+# sample streams, so that a test can be re-scored for other gate times and
+# analog thresholds without running it again.
+#
+# The sketch steps a state machine once per loop for each channel:
+#
+#   state 0  failing, event already counted: a passing reading arms it (-> 1)
+#   state 1  armed: a failing reading starts the gate timer (-> 2)
+#   state 2  timing: once the gate time has passed the event is counted
+#            (-> 0), otherwise a passing reading re-arms it (-> 1)
+#
+# Analog readings pass when inside the threshold window by more than the
+# hysteresis, fail when outside the window, and neither in between. Rather
+# than stepping through every reading, the stream is split into episodes, one
+# per run of failing readings, and all episodes are scored for all gate times
+# at once with binary searches. The only carry-over between episodes is that an
+# event counted on the very reading that ends a run leaves the channel unarmed
+# if the next run follows straight after a single passing reading; that chain
+# is resolved from run lengths too.
+#
+# Counts match the sketch exactly when the stream holds every reading it took
+# (one per loop). Recorded frames and waveform blocks are a subsample of those
+# readings, so re-scoring a session gives an estimate.
+#
+# This module must not import Kivy.
+#
+# Usage from the command line:
+#   python rescore.py <session file> [--gates 0.5,1,2] [--lows 100,200]
+#                     [--highs 800,900]
+# Gate times are in milliseconds, thresholds 0-1023. The defaults are the
+# values the session was recorded with.
+
+import argparse
+
+import numpy as np
+
+from protocol import ANALOG_COUNTER_COLUMNS, ANALOG_VALUE_COLUMNS, TIME_COLUMN
+from timebase import unwrapMillis
+
+# Analog hysteresis used by the sketch
+HYSTERESIS = 20
+
+# Discrete channel configs (see ChannelStripDiscrete.channelConfig)
+DISCRETE_RISING = 1
+DISCRETE_FALLING = 2
+
+
+def discreteEvents(times, levels, edgeConfig, gateMicros):
+    """Returns the indices of the readings at which the sketch counts an
+       event on a discrete channel.
+
+       <times> are reading times in microseconds, <levels> the digitalRead()
+       values (0 or 1), <edgeConfig> DISCRETE_RISING or DISCRETE_FALLING.
+       <gateMicros> may be a single gate time or an array of them, in which
+       case a list with the event indices for each is returned."""
+
+    levels = np.asarray(levels) != 0
+    # Rising edge config: the sensor output fails (the Arduino input goes
+    # LOW) on an event
+    failing = ~levels if edgeConfig == DISCRETE_RISING else levels
+    return _events(times, ~failing, failing, gateMicros, False)
+
+
+def analogEvents(times, values, low, high, gateMicros,
+                 hysteresis=HYSTERESIS):
+    """Returns the indices of the readings at which the sketch counts an
+       event on an analog channel.
+
+       <times> are reading times in microseconds and <values> the
+       analogRead() values (0-1023). The first reading also sets the initial
+       state, as the reading taken in setup() does. <gateMicros> may be a
+       single gate time or an array of them, as for discreteEvents()."""
+
+    if high < hysteresis:
+        # The sketch compares the unsigned reading with high - hysteresis,
+        # which then wraps around, so a reading can pass and fail at once
+        raise ValueError('High threshold {} is below the hysteresis'.format(
+                         high))
+
+    values = np.asarray(values, dtype=np.int64)
+    passing = (values > low + hysteresis) & (values < high - hysteresis)
+    failing = (values > high) | (values < low)
+    armed = len(values) > 0 and low < values[0] < high
+    return _events(times, passing, failing, gateMicros, armed)
+
+
+def analogCounts(times, values, lows, highs, gatesMicros,
+                 hysteresis=HYSTERESIS):
+    """Returns the analog event count for every combination of low threshold,
+       high threshold and gate time, as a len(lows) x len(highs) x
+       len(gatesMicros) array. Combinations with low >= high, or with high
+       below the hysteresis, count -1."""
+
+    counts = np.full((len(lows), len(highs), len(gatesMicros)), -1,
+                     dtype=np.int64)
+    for i, low in enumerate(lows):
+        for j, high in enumerate(highs):
+            if low < high and high >= hysteresis:
+                events = analogEvents(times, values, low, high,
+                                      np.asarray(gatesMicros), hysteresis)
+                counts[i, j] = [len(indices) for indices in events]
+    return counts
+
+
+def _events(times, passing, failing, gateMicros, armed):
+    """Scores the failing runs of a stream of readings.
+
+       <passing> and <failing> are boolean arrays (never both true for the
+       same reading) and <armed> is the state before the first reading.
+       Returns the event indices for one gate time, or a list of them for an
+       array of gate times."""
+
+    times = np.asarray(times, dtype=np.int64)
+    gates = np.atleast_1d(np.asarray(gateMicros, dtype=np.int64))
+    count = len(times)
+    passIndex = np.flatnonzero(passing)
+
+    # A run of failing readings starts at each failing reading whose previous
+    # passing-or-failing reading passed. Readings that do neither (analog
+    # readings inside the hysteresis band) only extend the current state.
+    marked = np.flatnonzero(passing | failing)
+    fails = failing[marked]
+    starts = marked[fails & np.concatenate(([True], ~fails[:-1]))]
+    runs = len(starts)
+    if runs == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return [empty for gate in gates] if np.ndim(gateMicros) else empty
+
+    # Each run ends at the next passing reading (or the end of the stream).
+    # The gate timer is checked on every reading after the run starts, up to
+    # and including that passing reading.
+    firstPass = np.searchsorted(passIndex, starts, side='right')
+    ended = firstPass < len(passIndex)
+    ends = np.append(passIndex, count - 1)[firstPass]
+    due = np.searchsorted(times, times[starts][:, None] + gates[None, :],
+                          side='left')
+    due = np.maximum(due, (starts + 1)[:, None])
+    event = due <= ends[:, None]
+
+    # Number of passing readings between each run and the next
+    nextFirstPass = np.append(firstPass[1:], len(passIndex))
+    singlePass = (nextFirstPass - firstPass) == 1
+
+    # A run is scored only if the channel is armed when it starts. It is
+    # unarmed only after an event counted on the passing reading ending the
+    # previous (scored) run, when that was the only passing reading before
+    # this run. Along a chain of such runs the armed state alternates.
+    unarms = event & (due == ends[:, None]) & (ended & singlePass)[:, None]
+    first = np.empty(runs, dtype=bool)
+    first[0] = armed or (len(passIndex) > 0 and passIndex[0] < starts[0])
+    first[1:] = True
+    position = np.arange(runs)[:, None]
+    breaks = np.where(~unarms, position, -1)
+    lastBreak = np.vstack((np.full((1, len(gates)), -1),
+                           np.maximum.accumulate(breaks, axis=0)[:-1]))
+    chain = position - (lastBreak + 1)
+    scored = (chain % 2 == 0) == first[lastBreak + 1]
+    scored &= event
+
+    indices = [due[scored[:, g], g] for g in range(len(gates))]
+    return indices if np.ndim(gateMicros) else indices[0]
+
+
+def rescoreSession(session, lows=None, highs=None, gatesMillis=None):
+    """Re-scores the analog channels of a session.SessionFile from its
+       recorded analog levels.
+
+       Thresholds and gate times default to the values the session was
+       recorded with. Returns a dict with, for each enabled analog channel
+       number (0-3), (recordedCount, counts) where counts is the array
+       returned by analogCounts() for the given (or that channel's
+       recorded) thresholds."""
+
+    config = session.config
+    if gatesMillis is None:
+        gatesMillis = [config['gateThresholdMicros'] / 1000.0]
+    gates = np.round(np.asarray(gatesMillis, dtype=float) * 1000)
+
+    frames = session.array()
+    times = unwrapMillis(frames[:, TIME_COLUMN]) * 1000
+    results = {}
+    for channel in range(4):
+        if config['analogConfig'][channel] == 0 or len(frames) == 0:
+            continue
+        counter = frames[:, ANALOG_COUNTER_COLUMNS[channel]]
+        results[channel] = (int(counter[-1]) - int(counter[0]), analogCounts(
+            times, frames[:, ANALOG_VALUE_COLUMNS[channel]],
+            [config['analogLowThreshold'][channel]] if lows is None else lows,
+            [config['analogHighThreshold'][channel]] if highs is None
+            else highs, gates))
+    return results
+
+
+def _numbers(text):
+    return [float(value) for value in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Re-score the analog channels of a recorded session')
+    parser.add_argument('session', help='session file (.svb)')
+    parser.add_argument('--gates', type=_numbers,
+                        help='comma-separated gate times (ms)')
+    parser.add_argument('--lows', type=_numbers,
+                        help='comma-separated low thresholds (0-1023)')
+    parser.add_argument('--highs', type=_numbers,
+                        help='comma-separated high thresholds (0-1023)')
+    args = parser.parse_args()
+
+    from session import SessionFile
+    with SessionFile(args.session) as session:
+        gates = args.gates or [session.config['gateThresholdMicros'] / 1000.0]
+        results = rescoreSession(session, args.lows, args.highs, gates)
+        for channel, (recorded, counts) in sorted(results.items()):
+            lows = args.lows or [session.config['analogLowThreshold'][channel]]
+            highs = args.highs or \
+                [session.config['analogHighThreshold'][channel]]
+            print('A{}: {} events recorded'.format(channel + 1, recorded))
+            print('{:>6} {:>6} '.format('low', 'high') +
+                  ' '.join('{:>9}'.format('{:g} ms'.format(gate))
+                           for gate in gates))
+            for i, low in enumerate(lows):
+                for j, high in enumerate(highs):
+                    print('{:>6g} {:>6g} '.format(low, high) +
+                          ' '.join('{:>9d}'.format(count)
+                                   for count in counts[i, j]))
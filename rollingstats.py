@@ -0,0 +1,193 @@
+# Rolling statistics of a running test: the spread of each analog channel's
+# level, a smoothed event rate and event counts over the last few minutes for
+# every channel. Everything is updated incrementally from each batch of frames
+# in fixed memory, so the cost per frame does not grow with the length of the
+# test.
+#
+# This module must not import Kivy.
+
+import threading
+
+import numpy as np
+
+from events import CHANNEL_NAMES
+from protocol import ANALOG_VALUE_COLUMNS, COUNTER_COLUMNS, TIME_COLUMN
+from timebase import TimeUnwrapper
+
+# Sliding windows (seconds) over which event counts are kept
+WINDOWS = (60, 600, 3600)
+
+# Time constant (seconds) of the exponentially weighted event rate
+RATE_TIME_CONSTANT = 60.0
+
+
+def formatEventStats(ratePerMinute, windowCounts, windows=WINDOWS):
+    """Returns the event rate and window counts of one channel as a short
+       line of text, e.g. '2.5/min  1m 3  10m 21  60m 97'."""
+
+    return '  '.join(['{:0.1f}/min'.format(ratePerMinute)] +
+                     ['{}m {}'.format(window // 60, count)
+                      for window, count in zip(windows, windowCounts)])
+
+
+class RollingStats(object):
+    """Running statistics of a stream of frames.
+
+       write() is called from the serial reader thread with each batch of
+       decoded frames and snapshot() from any thread. For each analog
+       channel it keeps the level's min, max, mean and variance (Welford's
+       method, merging each batch in one step). For each event channel
+       (numbered as in events.CHANNEL_NAMES) it keeps:
+
+         - an exponentially weighted event rate with a time constant of
+           <rateTimeConstant> seconds, kept as a decayed event sum
+         - the number of events in each of the last <windows> seconds, from
+           a ring holding the event totals at the end of each second
+
+       Window counts have a resolution of one second."""
+
+    def __init__(self, windows=WINDOWS, rateTimeConstant=RATE_TIME_CONSTANT):
+        self.windows = tuple(windows)
+        self.rateTimeConstant = rateTimeConstant
+        self._lock = threading.Lock()
+        analog = len(ANALOG_VALUE_COLUMNS)
+        channels = len(CHANNEL_NAMES)
+
+        # Analog level count, mean, sum of squared deviations, min and max
+        self._levelCount = 0
+        self._levelMean = np.zeros(analog)
+        self._levelM2 = np.zeros(analog)
+        self._levelMin = np.full(analog, np.inf)
+        self._levelMax = np.full(analog, -np.inf)
+
+        # Event totals since the start, and the ring of totals at the end of
+        # each second (second s is held at s % len(self._ring))
+        self._lastCounters = np.zeros(channels, dtype=np.int64)
+        self._totals = np.zeros(channels, dtype=np.int64)
+        self._ring = np.zeros((max(self.windows) + 1, channels),
+                              dtype=np.int64)
+        self._firstSecond = None
+        self._second = None
+
+        # Event sums decayed to the time of the newest frame (ms)
+        self._decayed = np.zeros(channels)
+        self._startTime = None
+        self._lastTime = None
+        self._unwrapper = TimeUnwrapper()
+
+    def write(self, frames):
+        """Adds an Nx<SAMPLESIZE> array of frames."""
+
+        if len(frames) == 0:
+            return None
+
+        levels = frames[:, ANALOG_VALUE_COLUMNS].astype(np.float64)
+        counters = frames[:, COUNTER_COLUMNS].astype(np.int64)
+        with self._lock:
+            times = self._unwrapper.unwrap(frames[:, TIME_COLUMN])
+            self._addLevels(levels)
+            self._addEvents(times, counters)
+
+    def _addLevels(self, levels):
+        count = len(levels)
+        mean = levels.sum(axis=0) / count
+        m2 = np.square(levels - mean).sum(axis=0)
+
+        total = self._levelCount + count
+        delta = mean - self._levelMean
+        self._levelMean += delta * count / total
+        self._levelM2 += m2 + delta**2 * self._levelCount * count / total
+        self._levelCount = total
+        self._levelMin = np.minimum(self._levelMin, levels.min(axis=0))
+        self._levelMax = np.maximum(self._levelMax, levels.max(axis=0))
+
+    def _addEvents(self, times, counters):
+        if self._startTime is None:
+            self._startTime = self._lastTime = int(times[0])
+            self._firstSecond = self._second = int(times[0]) // 1000
+
+        # As in events.EventLog, a counter going down means the Arduino
+        # restarted and the new value is the baseline
+        previous = np.concatenate((self._lastCounters[None], counters[:-1]))
+        self._lastCounters = counters[-1]
+        deltas = np.maximum(counters - previous, 0)
+        before = self._totals
+        totals = before + np.cumsum(deltas, axis=0)
+        self._totals = totals[-1]
+
+        # Frame times never go backwards as far as the statistics go
+        times = np.maximum.accumulate(np.maximum(times, self._lastTime))
+        end = int(times[-1])
+
+        # Decay the event sums to the newest frame and add the new events
+        tau = self.rateTimeConstant * 1000.0
+        self._decayed = (self._decayed * np.exp((self._lastTime - end) / tau) +
+                         np.exp((times - end) / tau).dot(deltas))
+        self._lastTime = end
+
+        # Store the totals at the end of each second from the newest one in
+        # the ring up to the current (partial) one. Seconds without frames
+        # keep the total of the second before.
+        size = len(self._ring)
+        second = end // 1000
+        if second == self._second:
+            # Usually the whole batch falls within the current second
+            self._ring[second % size] = self._totals
+            return None
+        seconds = times // 1000
+        fill = np.arange(max(self._second, second - size + 1), second + 1)
+        last = np.searchsorted(seconds, fill, side='right') - 1
+        self._ring[fill % size] = np.where((last >= 0)[:, None],
+                                           totals[np.maximum(last, 0)], before)
+        self._second = second
+
+    def snapshot(self):
+        """Returns the current statistics as a dict:
+
+           'timeMillis'
+               time of the newest frame (None before the first frame)
+           'levelMin', 'levelMax', 'levelMean', 'levelStd'
+               per analog channel (0-1023 scale, NaN before the first frame)
+           'eventTotals'
+               number of events per event channel since the start
+           'ratePerMinute'
+               smoothed event rate per event channel
+           'windowCounts'
+               len(windows) x channels array of event counts over each
+               window"""
+
+        with self._lock:
+            stats = {'timeMillis': self._lastTime,
+                     'eventTotals': self._totals.copy()}
+            if self._levelCount == 0:
+                for key in ('levelMin', 'levelMax', 'levelMean', 'levelStd'):
+                    stats[key] = np.full(len(self._levelMean), np.nan)
+            else:
+                stats['levelMin'] = self._levelMin.copy()
+                stats['levelMax'] = self._levelMax.copy()
+                stats['levelMean'] = self._levelMean.copy()
+                stats['levelStd'] = np.sqrt(self._levelM2 / self._levelCount)
+
+            # The decayed sum only reaches its steady state after a few time
+            # constants, so scale it up early in the test
+            rate = np.zeros(len(self._totals))
+            if self._startTime is not None:
+                tau = self.rateTimeConstant * 1000.0
+                elapsed = max(1000, self._lastTime - self._startTime)
+                rate = self._decayed * 60000.0 / (tau * (1 - np.exp(
+                    -elapsed / tau)))
+            stats['ratePerMinute'] = rate
+
+            counts = np.zeros((len(self.windows), len(self._totals)),
+                              dtype=np.int64)
+            for i, window in enumerate(self.windows):
+                if self._second is None:
+                    break
+                second = self._second - window
+                if second < self._firstSecond:
+                    counts[i] = self._totals
+                else:
+                    counts[i] = (self._totals -
+                                 self._ring[second % len(self._ring)])
+            stats['windowCounts'] = counts
+        return stats
@@ -0,0 +1,200 @@
+# Read-only access to recorded session files (see recorder.py for the file
+# layout). The frame data is memory-mapped rather than loaded, so opening a
+# session and slicing a time range out of it costs the same whether the test
+# ran for five minutes or five days.
+#
+# Frame times are stored as the 32-bit elapsed times the Arduino sends, which
+# wrap after about 49.7 days. Time ranges are given as unwrapped times (see
+# timebase.py): the positions of the wraps are found once per session from a
+# sample of the frames, so slicing a long test stays cheap.
+#
+# This module must not import Kivy.
+
+import os
+
+import numpy as np
+
+from protocol import FRAME_DTYPE, FRAMESIZE, SAMPLESIZE, applyChange
+from recorder import readChanges, readHeader, readLoopStats, readTimebase
+from timebase import WRAP_MILLIS, hostTimes
+
+# Frames between the samples read to find wraps of the frame times. The sketch
+# sends a frame at least every second, so even at that rate the samples are
+# less than half a wrap apart.
+WRAP_SAMPLE_FRAMES = 1 << 20
+
+# Structured view of one frame. Same memory layout as the DATAFRAME array in
+# ShockVibeBox.py.
+SESSION_DTYPE = np.dtype([('time', '<u4'),
+                          ('discrete', '<u4', (8,)),
+                          ('analog', [('count', '<u4'), ('value', '<u4')],
+                           (4,))])
+assert SESSION_DTYPE.itemsize == FRAMESIZE
+
+
+class SessionFile(object):
+    """Memory-mapped session recording.
+
+       self.frames is a structured array (SESSION_DTYPE) with one element per
+       frame, e.g.:
+
+           session = SessionFile('recordings/20170301-101500.svb')
+           session.frames['time']                 # elapsed time in ms
+           session.frames['discrete'][:, 2]       # D3 event counter
+           session.frames['analog']['value'][:, 0]  # A1 level (0-1023)
+
+       Pages are only read from disk when they are accessed.
+
+       self.config is the configuration the test started with,
+       self.changes the configuration changes made during it (see
+       recorder.readChanges), self.timebase the checkpoints of the
+       alignment of its frame times with the PC clock (see
+       recorder.readTimebase) and self.loopStats the scan times of the
+       sketch (see recorder.readLoopStats)."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.config, self.headerSize = readHeader(f)
+        self.changes = readChanges(path)
+        self.timebase = readTimebase(path)
+        self.loopStats = readLoopStats(path)
+        self._wraps = None
+
+        # A partial frame at the end of the file (e.g. after a crash, or from a
+        # recording still in progress) is ignored
+        count = (os.path.getsize(path) - self.headerSize) // FRAMESIZE
+        if count > 0:
+            self.frames = np.memmap(path, dtype=SESSION_DTYPE, mode='r',
+                                    offset=self.headerSize, shape=(count,))
+        else:
+            self.frames = np.zeros(0, dtype=SESSION_DTYPE)
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def times(self):
+        """Elapsed time of each frame in milliseconds, as recorded (32-bit,
+           see unwrappedTimes())."""
+        return self.frames['time']
+
+    def unwrappedTimes(self, start=0, stop=None):
+        """Returns the unwrapped elapsed times (int64, ms) of the frames
+           start to stop."""
+
+        stop = len(self.frames) if stop is None else min(stop,
+                                                         len(self.frames))
+        times = self.frames['time'][start:stop].astype(np.int64)
+        wraps = self._wrapIndices()
+        times += WRAP_MILLIS * int(np.searchsorted(wraps, start, 'right'))
+        for wrap in wraps[(wraps > start) & (wraps < stop)]:
+            times[wrap - start:] += WRAP_MILLIS
+        return times
+
+    def _wrapIndices(self):
+        """Returns the indices of the frames whose time wrapped round (the
+           first frame after each wrap), finding them on the first call."""
+
+        if self._wraps is not None:
+            return self._wraps
+        times = self.frames['time']
+        wraps = []
+        if len(times):
+            samples = np.append(np.arange(0, len(times), WRAP_SAMPLE_FRAMES),
+                                len(times) - 1)
+            sampled = times[samples].astype(np.int64)
+            for i in np.flatnonzero(np.diff(sampled) < 0):
+                # Times before the wrap are at least the sample's, times after
+                # it are below
+                low, high = int(samples[i]) + 1, int(samples[i+1])
+                while low < high:
+                    middle = (low + high) // 2
+                    if times[middle] < sampled[i]:
+                        high = middle
+                    else:
+                        low = middle + 1
+                wraps.append(low)
+        self._wraps = np.array(wraps, dtype=np.int64)
+        return self._wraps
+
+    def hostTimes(self, start=0, stop=None):
+        """Returns the PC times (Unix seconds) at which the frames start to
+           stop were sent, or None if the session has no timebase log."""
+
+        if not self.timebase:
+            return None
+        return hostTimes(self.timebase, self.unwrappedTimes(start, stop))
+
+    @property
+    def duration(self):
+        """Time between the first and last frame in milliseconds."""
+        if len(self.frames) == 0:
+            return 0
+        count = len(self.frames)
+        return int(self.unwrappedTimes(count - 1)[0] -
+                   self.unwrappedTimes(0, 1)[0])
+
+    def array(self):
+        """Returns the frames as a plain Nx<SAMPLESIZE> uint32 array (a view
+           of the same memory map, not a copy)."""
+        return self.frames.view(FRAME_DTYPE).reshape(-1, SAMPLESIZE)
+
+    def indexRange(self, startMillis=None, stopMillis=None):
+        """Returns the (start, stop) frame indices covering the time range
+           startMillis <= time < stopMillis, in unwrapped times.
+
+           Frame times only increase between wraps, so this is a binary
+           search that reads O(log n) frames. Either end may be None for an
+           open range."""
+
+        start = 0 if startMillis is None else self._search(startMillis)
+        stop = len(self.frames) if stopMillis is None else \
+            self._search(stopMillis)
+        return start, max(start, stop)
+
+    def _search(self, millis):
+        """Returns the index of the first frame at or after unwrapped time
+           <millis>."""
+
+        bounds = np.concatenate(([0], self._wrapIndices(),
+                                 [len(self.frames)]))
+        wrap = int(millis) // WRAP_MILLIS
+        if wrap < 0:
+            return 0
+        if wrap >= len(bounds) - 1:
+            return len(self.frames)
+        first, last = int(bounds[wrap]), int(bounds[wrap + 1])
+        return first + int(np.searchsorted(self.frames['time'][first:last],
+                                           int(millis) % WRAP_MILLIS,
+                                           side='left'))
+
+    def timeSlice(self, startMillis=None, stopMillis=None):
+        """Returns the frames with startMillis <= time < stopMillis as a
+           memory-mapped view."""
+        start, stop = self.indexRange(startMillis, stopMillis)
+        return self.frames[start:stop]
+
+    def configAt(self, timeMillis):
+        """Returns the configuration the frame at <timeMillis> was measured
+           with: the starting configuration with every change applied to the
+           running test before that time. Changes that were not applied to
+           the running test are left out, as the time they took effect is
+           not known."""
+
+        config = self.config
+        for entry in self.changes:
+            if entry['time'] is not None and entry['time'] < timeMillis:
+                config = applyChange(config, entry['change'])
+        return config
+
+    def close(self):
+        """Releases the memory map. It is unmapped once any views returned by
+           timeSlice() or array() are also released."""
+        self.frames = np.zeros(0, dtype=SESSION_DTYPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
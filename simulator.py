@@ -0,0 +1,373 @@
+# Software stand-in for the ShockVibeBox Arduino. It speaks the same serial
+# protocol as Arduino/ShockVibeBox/ShockVibeBox.ino over a pseudo-terminal, so
+# the GUI and SerialReader can be exercised without hardware, and at frame
+# rates far above the 10 frames/s of the real sketch.
+#
+# Pseudo-terminals are only available on Linux (and other POSIX systems).
+#
+# This module must not import Kivy.
+#
+# Usage from the command line:
+#   python simulator.py [--rate HZ] [--replay SESSION_FILE] [--clock-error PPM]
+# then set a 'port' in DEVICES in config.py to the printed /dev/pts/N device.
+
+import argparse
+import os
+import select
+import threading
+import time
+import tty
+
+import numpy as np
+
+from protocol import (ACK_APPLIED, ACK_REJECTED, ANALOG_COUNTER_COLUMNS,
+                      ANALOG_MAX, ANALOG_VALUE_COLUMNS, CONFIG_SIZE,
+                      DISCRETE_COUNTER_COLUMNS, FRAME_DTYPE,
+                      PACKET_HEADER_SIZE, PACKET_OVERHEAD, PROTOCOL_VERSION,
+                      SAMPLESIZE, SYNC, TIME_COLUMN, VERSION_MAGIC,
+                      WAVEFORM_BLOCK_SAMPLES, WAVEFORM_INTERVAL_UNIT,
+                      LoopStats, PacketDecoder, PacketEncoder, applyChange,
+                      unpackCommand, unpackConfig, versionRequest)
+
+# Time in milliseconds reported in the first frame. The real sketch has spent
+# roughly this long in the bootloader and waiting for the handshake.
+BOOT_MILLIS = 1500
+
+# Maximum number of frames generated and written in one go
+MAX_BATCH = 1024
+
+# Time in seconds to wait for a protocol version request after the
+# configuration, as the sketch does
+VERSION_TIMEOUT = 0.1
+
+# Vibration added to the analog levels in waveform capture mode: frequency in
+# Hz, and amplitude as a fraction of each channel's threshold window
+VIBRATION_HZ = 37.0
+VIBRATION_AMPLITUDE = 0.1
+
+# Time in milliseconds between loop statistics packets (protocol v5), and the
+# minimum, typical mean and typical maximum scan time in microseconds reported
+# in them. The maximum is a scan that also sent a packet.
+LOOP_STATS_INTERVAL = 1000
+SCAN_MICROS = (96, 140, 620)
+
+
+class VirtualShockVibeBox(threading.Thread):
+    """Simulated Arduino attached to the master side of a pseudo-terminal.
+
+       Like the sketch, it waits for the configuration handshake (and
+       optional protocol version request), sends an initial frame, and then
+       sends a frame every 1/<rate> seconds. With protocol v2 each frame is
+       sent as a packet, with a keyframe once a second. Protocol v3 waveform
+       capture adds blocks of vibration samples for each enabled analog
+       channel. Frames are generated in batches, so rates of several kHz are
+       possible. A new handshake at any time restarts the simulated test,
+       which mirrors the reset the real board does whenever the PC reopens
+       the port. With protocol v4, command packets change the configuration
+       of the running test and are acknowledged with the time of the last
+       frame sent before the change. Protocol v5 adds loop statistics once
+       a second, with scan times like those of the sketch.
+
+       If <replay> is given (an Nx<SAMPLESIZE> frame array, e.g. from
+       session.SessionFile.array()), those frames are sent in order instead
+       of synthetic data. At the end of the recording it starts again, with
+       times and counters offset so they keep increasing. Otherwise, each enabled
+       discrete channel logs an event with probability <eventProbability>
+       per frame, and each enabled analog channel wanders around the middle
+       of its threshold window with occasional excursions outside it.
+
+       Synthetic frame times run <clockError> ppm fast (or slow if negative)
+       against the PC clock, like the resonator of a real board."""
+
+    def __init__(self, rate=10.0, replay=None, eventProbability=0.001,
+                 seed=None, clockError=0.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.rate = float(rate)
+        self.replay = replay
+        if replay is not None:
+            replay = replay.astype(np.int64)
+            self._lapOffset = replay[-1] - replay[0]
+            self._lapOffset[ANALOG_VALUE_COLUMNS] = 0
+            self._lapOffset[TIME_COLUMN] += max(1, self._lapOffset[TIME_COLUMN] //
+                                                max(1, len(replay) - 1))
+        self.eventProbability = eventProbability
+        self.clockError = clockError
+        self.rng = np.random.RandomState(seed)
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.portName = os.ttyname(self.slave)
+
+        # Configuration from the last handshake, host time (time.time()) at
+        # which the simulated test started, and frames sent since then
+        self.config = None
+        self.version = 1
+        self.waveformIntervalMicros = 0
+        self.startTime = 0.0
+        self.framesSent = 0
+        self.stopFlag = False
+
+        self._received = b''
+        self._configTime = None
+        self._pending = b''
+        self._encoder = None
+        self._commands = None
+        self._lastTime = 0
+        self._frame = np.zeros(SAMPLESIZE, dtype=FRAME_DTYPE)
+        self._inWindow = np.ones(4, dtype=bool)
+        self._waveformNext = 0.0
+        self._waveformTimes = np.zeros(0)
+        self._waveformSamples = np.zeros((0, 4), dtype=np.int64)
+        self._loopStatsNext = 0
+
+    def run(self):
+        while not self.stopFlag:
+            writing = [self.master] if self._pending else []
+            readable, writable, _ = select.select([self.master], writing, [],
+                                                  self._timeout())
+            if readable:
+                self._received += os.read(self.master, 4096)
+            if self.version >= 4 and self._received.startswith(SYNC[:1]):
+                self._command()
+            elif len(self._received) >= CONFIG_SIZE:
+                self._handshake()
+            if writable:
+                count = os.write(self.master, self._pending)
+                self._pending = self._pending[count:]
+            if self.config is not None and not self._pending:
+                self._pending = self._generate()
+
+        os.close(self.master)
+        os.close(self.slave)
+
+    def stop(self):
+        self.stopFlag = True
+
+    def _timeout(self):
+        """Time in seconds until the next frame is due."""
+        if self.config is None or self._pending:
+            return 0.1
+        due = self.startTime + self.framesSent / self.rate
+        return min(0.1, max(0.0, due - time.time()))
+
+    def _handshake(self):
+        """Handles a configuration handshake received from the PC."""
+
+        # Wait briefly for a version request following the configuration. Its
+        # length depends on the version requested.
+        if self._configTime is None:
+            self._configTime = time.time()
+        request = self._received[CONFIG_SIZE:CONFIG_SIZE + len(versionRequest())]
+        expected = len(versionRequest())
+        if len(request) > len(VERSION_MAGIC):
+            expected = len(versionRequest(
+                bytearray(request)[len(VERSION_MAGIC)]))
+            request = request[:expected]
+        if (len(request) < expected and
+                VERSION_MAGIC.startswith(request[:len(VERSION_MAGIC)]) and
+                time.time() - self._configTime < VERSION_TIMEOUT):
+            return None
+        self._configTime = None
+
+        # Configuration handshake: (re)start the simulated test
+        self.config = unpackConfig(self._received[:CONFIG_SIZE])
+        self._received = self._received[CONFIG_SIZE:]
+        self._pending = b''
+        self.version = 1
+        self.waveformIntervalMicros = 0
+        if (request.startswith(VERSION_MAGIC) and
+                len(request) > len(VERSION_MAGIC)):
+            self._received = self._received[len(request):]
+            request = bytearray(request)
+            self.version = min(PROTOCOL_VERSION, request[len(VERSION_MAGIC)])
+            if self.version >= 3 and len(request) > len(VERSION_MAGIC) + 1:
+                self.waveformIntervalMicros = (request[-1] *
+                                               WAVEFORM_INTERVAL_UNIT)
+            if self.version >= 2:
+                self._pending = versionRequest(self.version,
+                                               self.waveformIntervalMicros)
+                self._encoder = PacketEncoder(max(1, int(self.rate)))
+                self._commands = PacketDecoder()
+
+        self._frame[:] = 0
+        self._inWindow = np.ones(4, dtype=bool)
+        self._waveformNext = float(BOOT_MILLIS)
+        self._waveformTimes = np.zeros(0)
+        self._waveformSamples = np.zeros((0, 4), dtype=np.int64)
+        self._loopStatsNext = BOOT_MILLIS + LOOP_STATS_INTERVAL
+        self.startTime = time.time()
+        self.framesSent = 0
+        self._lastTime = BOOT_MILLIS
+
+    def _command(self):
+        """Applies the complete command packets received from the PC. A
+           handshake never starts with a sync byte, as no channel config is
+           that large."""
+
+        while (self._received.startswith(SYNC[:1]) and
+               len(self._received) >= PACKET_HEADER_SIZE):
+            size = (PACKET_OVERHEAD +
+                    bytearray(self._received)[PACKET_HEADER_SIZE - 1])
+            if len(self._received) < size:
+                break
+            self._commands.feed(self._received[:size])
+            self._received = self._received[size:]
+
+        for command in self._commands.takeCommands():
+            try:
+                change = unpackCommand(command.payload)
+            except ValueError:
+                status = ACK_REJECTED
+            else:
+                self.config = applyChange(self.config, change)
+                status = ACK_APPLIED
+            self._pending += self._encoder.encodeAck(command.sequence, status,
+                                                     self._lastTime)
+
+    def _generate(self):
+        """Returns the bytes of all frames due by now."""
+
+        due = int((time.time() - self.startTime) * self.rate) + 1
+        count = min(due - self.framesSent, MAX_BATCH)
+        if count <= 0:
+            return b''
+
+        index = self.framesSent + np.arange(count)
+        if self.replay is not None:
+            laps = (index // len(self.replay)).reshape(-1, 1)
+            frames = (self.replay[index % len(self.replay)].astype(np.int64) +
+                      laps * self._lapOffset)
+        else:
+            frames = self._synthesize(index)
+
+        self.framesSent += count
+        self._lastTime = int(frames[-1, TIME_COLUMN])
+        if self.version < 2:
+            return frames.astype(FRAME_DTYPE).tobytes()
+        packets = self._encoder.encode(frames)
+        if self.version >= 3 and self.waveformIntervalMicros > 0:
+            packets += self._waveform(frames)
+        if self.version >= 5:
+            packets += self._loopStatistics(frames)
+        return packets
+
+    def _loopStatistics(self, frames):
+        """Returns the loop statistics packets due by the time of the last
+           frame, one per LOOP_STATS_INTERVAL ms."""
+
+        packets = []
+        minimum, mean, maximum = SCAN_MICROS
+        while self._loopStatsNext <= frames[-1, TIME_COLUMN]:
+            scanMean = mean + self.rng.randint(0, mean // 8)
+            scanMax = maximum + self.rng.randint(0, maximum)
+            packets.append(self._encoder.encodeLoopStats(LoopStats(
+                self._loopStatsNext, LOOP_STATS_INTERVAL * 1000 // scanMean,
+                minimum, scanMean, scanMax)))
+            self._loopStatsNext += LOOP_STATS_INTERVAL
+        return b''.join(packets)
+
+    def _waveform(self, frames):
+        """Returns the waveform packets for the capture samples due by the
+           time of the last frame.
+
+           Each sample is the level of the latest frame plus a sine wave
+           vibration and noise. A block is sent per enabled analog channel
+           whenever WAVEFORM_BLOCK_SAMPLES samples have built up."""
+
+        interval = self.waveformIntervalMicros / 1000.0
+        count = int((frames[-1, TIME_COLUMN] - self._waveformNext) //
+                    interval) + 1
+        if count > 0:
+            times = self._waveformNext + np.arange(count) * interval
+            self._waveformNext = times[-1] + interval
+            rows = np.searchsorted(frames[:, TIME_COLUMN], times,
+                                   side='right') - 1
+            levels = frames[np.maximum(rows, 0)][:, ANALOG_VALUE_COLUMNS]
+
+            low = np.array(self.config['analogLowThreshold'])
+            high = np.array(self.config['analogHighThreshold'])
+            amplitude = (high - low) * VIBRATION_AMPLITUDE
+            vibration = (np.sin(2*np.pi*VIBRATION_HZ * times / 1000.0)[:, None]
+                         * amplitude +
+                         self.rng.standard_normal((count, 4)) * amplitude / 4)
+            samples = np.clip(levels + vibration, 0, ANALOG_MAX)
+            self._waveformTimes = np.concatenate((self._waveformTimes, times))
+            self._waveformSamples = np.vstack((self._waveformSamples,
+                                               samples.astype(np.int64)))
+
+        packets = []
+        enabled = np.flatnonzero(self.config['analogConfig'])
+        while len(self._waveformTimes) >= WAVEFORM_BLOCK_SAMPLES:
+            for channel in enabled:
+                packets.append(self._encoder.encodeWaveform(channel,
+                    int(self._waveformTimes[0]), self.waveformIntervalMicros,
+                    self._waveformSamples[:WAVEFORM_BLOCK_SAMPLES, channel]))
+            self._waveformTimes = self._waveformTimes[WAVEFORM_BLOCK_SAMPLES:]
+            self._waveformSamples = \
+                self._waveformSamples[WAVEFORM_BLOCK_SAMPLES:]
+        return b''.join(packets)
+
+    def _synthesize(self, index):
+        """Generates synthetic frames for the given frame numbers."""
+
+        count = len(index)
+        frames = np.empty((count, SAMPLESIZE), dtype=np.int64)
+        frames[:] = self._frame
+        frames[:, TIME_COLUMN] = BOOT_MILLIS + (index * 1000.0 / self.rate *
+                                                (1 + self.clockError * 1e-6))
+
+        # Discrete channels: random events
+        enabled = np.array(self.config['discreteConfig']) != 0
+        events = self.rng.random_sample((count, 8)) < self.eventProbability
+        frames[:, DISCRETE_COUNTER_COLUMNS] += np.cumsum(events & enabled,
+                                                         axis=0)
+
+        # Analog channels: noise around the middle of the threshold window.
+        # An event is logged on each transition from inside to outside.
+        low = np.array(self.config['analogLowThreshold'])
+        high = np.array(self.config['analogHighThreshold'])
+        enabled = np.array(self.config['analogConfig']) != 0
+        levels = ((low + high) / 2.0 +
+                  self.rng.standard_normal((count, 4)) * (high - low) / 6.0)
+        levels = np.clip(levels, 0, ANALOG_MAX).astype(np.int64)
+        inWindow = (levels >= low) & (levels <= high)
+        previous = np.vstack((self._inWindow, inWindow[:-1]))
+        events = previous & ~inWindow & enabled
+        frames[:, ANALOG_COUNTER_COLUMNS] += np.cumsum(events, axis=0)
+        frames[:, ANALOG_VALUE_COLUMNS] = levels * enabled
+
+        self._inWindow = inWindow[-1]
+        self._frame[:] = frames[-1]
+        return frames
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Simulated ShockVibeBox on a pseudo-terminal')
+    parser.add_argument('--rate', type=float, default=10.0,
+                        help='frames per second (default 10, like the sketch)')
+    parser.add_argument('--replay', metavar='SESSION_FILE',
+                        help='send the frames of a recorded session')
+    parser.add_argument('--event-probability', type=float, default=0.001,
+                        help='chance of a discrete event per channel per frame')
+    parser.add_argument('--clock-error', type=float, default=0.0,
+                        help='rate error of the simulated clock in ppm')
+    args = parser.parse_args()
+
+    replay = None
+    if args.replay:
+        from session import SessionFile
+        replay = np.array(SessionFile(args.replay).array())
+
+    device = VirtualShockVibeBox(args.rate, replay, args.event_probability,
+                                 clockError=args.clock_error)
+    device.start()
+    print('Virtual ShockVibeBox on {} at {} frames/s'.format(device.portName,
+                                                             args.rate))
+    print('Press Ctrl-C to stop')
+    try:
+        while device.is_alive():
+            device.join(1.0)
+    except KeyboardInterrupt:
+        device.stop()
@@ -0,0 +1,102 @@
+// Minimal stand-in for the Arduino core, so that ShockVibeBox.ino can be
+// compiled for the PC and fed recorded readings (see replay.cpp). Only what
+// the sketch uses is provided. AVR int is 16-bit and long is 32-bit; the
+// sketch is compiled with "unsigned long" replaced by uint32_t so its time
+// arithmetic wraps as it does on the board.
+//
+// Inputs are set through fakeMicros, fakePins (digital levels by pin number)
+// and fakeAnalog (analogRead() values by pin number). Port input registers
+// are 8 pins each, refreshed from fakePins whenever micros() is read (the
+// sketch reads micros() at the start of each scan, before the ports). An ADC
+// conversion samples its pin when it is started and has finished by the next
+// time ADCSRA is checked.
+
+#include <stdint.h>
+#include <stdio.h>
+#include <string.h>
+#include <vector>
+
+typedef uint8_t byte;
+typedef bool boolean;
+
+#define HIGH 1
+#define LOW 0
+#define INPUT 0
+#define OUTPUT 1
+
+extern uint32_t fakeMicros;
+extern int fakePins[64];
+extern int fakeAnalog[16];
+extern uint8_t fakePorts[8];
+
+inline void pinMode(int, int) {}
+inline void digitalWrite(int, int) {}
+inline int digitalRead(int pin) { return fakePins[pin]; }
+inline int analogRead(int pin) { return fakeAnalog[pin]; }
+
+inline int digitalPinToPort(int pin) { return pin / 8; }
+inline uint8_t digitalPinToBitMask(int pin) { return 1 << (pin % 8); }
+inline volatile uint8_t* portInputRegister(int port) { return &fakePorts[port]; }
+
+inline uint32_t micros() {
+  for (int pin = 0; pin < 64; pin++) {
+    if (fakePins[pin]) {
+      fakePorts[pin / 8] |= 1 << (pin % 8);
+    }
+    else {
+      fakePorts[pin / 8] &= ~(1 << (pin % 8));
+    }
+  }
+  return fakeMicros;
+}
+inline uint32_t millis() { return fakeMicros / 1000; }
+
+// ADC registers
+#define ADSC 6
+#define REFS0 6
+#define MUX5 3
+extern uint8_t ADMUX, ADCSRB;
+extern uint16_t ADC;
+struct FakeADCSRA {
+  bool busy = false;
+  uint16_t sample = 0;
+  void operator|=(int bits) {
+    if (bits & (1 << ADSC)) {
+      busy = true;
+      sample = fakeAnalog[ADMUX & 0x07];
+    }
+  }
+  int operator&(int) {
+    if (busy) {
+      busy = false;
+      ADC = sample;
+    }
+    return 0;
+  }
+};
+extern FakeADCSRA ADCSRA;
+
+struct FakeSerial {
+  std::vector<uint8_t> in, out;
+  size_t readPos = 0;
+  void begin(uint32_t) {}
+  operator bool() { return true; }
+  void setTimeout(uint32_t) {}
+  int available() { return in.size() - readPos; }
+  int availableForWrite() { return 63; }
+  int read() { return readPos < in.size() ? in[readPos++] : -1; }
+  size_t readBytes(char* buffer, size_t length) {
+    size_t count = 0;
+    while (count < length && readPos < in.size()) {
+      buffer[count++] = in[readPos++];
+    }
+    return count;
+  }
+  size_t readBytes(byte* buffer, size_t length) { return readBytes((char*)buffer, length); }
+  size_t write(const byte* buffer, size_t length) {
+    out.insert(out.end(), buffer, buffer + length);
+    return length;
+  }
+  size_t write(byte b) { out.push_back(b); return 1; }
+};
+extern FakeSerial Serial;
@@ -0,0 +1,76 @@
+// Replays readings through ShockVibeBox.ino compiled for the PC (see
+// Arduino.h). The sketch is included as sketch.cpp, with "unsigned long"
+// replaced by uint32_t and "(long)" by "(int32_t)".
+//
+// stdin holds the handshake length (<L) and bytes, the number of loop
+// iterations (<L), the readings of setup(), then the readings of each loop
+// iteration. Each reading is the time in microseconds (<L), the 8 discrete
+// levels (B each) and the 4 analog values (<H each; both the current and the
+// voltage pin of a channel read the same value). The 12 event counters are
+// printed at the end.
+
+#include "Arduino.h"
+
+uint32_t fakeMicros = 0;
+int fakePins[64];
+int fakeAnalog[16];
+uint8_t fakePorts[8];
+uint8_t ADMUX, ADCSRB;
+uint16_t ADC;
+FakeADCSRA ADCSRA;
+FakeSerial Serial;
+
+// Prototypes, which the Arduino IDE generates
+boolean checkTimeThresh(uint32_t eventStart, uint32_t eventDuration);
+void startConversion();
+void checkAnalog(int i, uint32_t value);
+void activateTrigger();
+int counterIndex(int i);
+void packAnalog(int pos);
+int buildPacket(byte* buffer, byte type, int payloadLength);
+void sendPacket(byte type, int payloadLength);
+void sendKeyframe();
+void sendSample();
+void sendLoopStats();
+void captureWaveform();
+void sendWaveform();
+void readCommand();
+void applyCommand();
+
+#include "sketch.cpp"
+
+static const int DISCRETE_PINS[] = {22, 26, 30, 34, 38, 42, 46, 50};
+
+static void readReading() {
+  uint8_t levels[8];
+  uint16_t values[4];
+  fread(&fakeMicros, 4, 1, stdin);
+  fread(levels, 1, 8, stdin);
+  fread(values, 2, 4, stdin);
+  for (int i = 0; i < 8; i++) {
+    fakePins[DISCRETE_PINS[i]] = levels[i];
+  }
+  for (int i = 0; i < 4; i++) {
+    fakeAnalog[i*2] = values[i];
+    fakeAnalog[i*2 + 1] = values[i];
+  }
+}
+
+int main() {
+  uint32_t length, iterations;
+  fread(&length, 4, 1, stdin);
+  Serial.in.resize(length);
+  fread(Serial.in.data(), 1, length, stdin);
+  fread(&iterations, 4, 1, stdin);
+  readReading();
+  setup();
+  for (uint32_t i = 0; i < iterations; i++) {
+    readReading();
+    loop();
+  }
+  for (int i = 0; i < 12; i++) {
+    printf("%u ", (unsigned)outputs[counterIndex(i)]);
+  }
+  printf("\n");
+  return 0;
+}
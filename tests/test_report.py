@@ -0,0 +1,164 @@
+# Checks summarizeSession against a frame-by-frame summary of the whole
+# session. Chunks of a few frames make runs outside the threshold window and
+# rate bins span many chunk boundaries.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import report
+from events import CHANNEL_NAMES
+from protocol import (ANALOG_VALUE_COLUMNS, COUNTER_COLUMNS, SAMPLESIZE,
+                      TIME_COLUMN)
+from recorder import writeHeader
+
+CONFIG = {'discreteConfig': [1, 0, 2, 1, 0, 0, 0, 1],
+          'analogConfig': [1, 2, 0, 2],
+          'analogLowThreshold': [400, 450, 0, 300],
+          'analogHighThreshold': [600, 550, 1023, 700],
+          'gateThresholdMicros': 1000,
+          'fixture': 'Test fixture',
+          'startTime': '2026-01-01 00:00:00'}
+
+
+def writeSession(path, rng, count):
+    """Writes a session of <count> random frames: time steps of 1-20 ms,
+       random events with a counter reset halfway and analog levels
+       wandering in and out of the threshold windows. Returns the frames."""
+
+    frames = np.zeros((count, SAMPLESIZE), dtype=np.uint32)
+    frames[:, TIME_COLUMN] = np.cumsum(rng.randint(1, 20, count)) + 100
+    counters = np.cumsum(rng.random_sample((count, len(COUNTER_COLUMNS))) <
+                         0.01, axis=0)
+    counters[count // 2:, 3] -= counters[count // 2, 3]
+    frames[:, COUNTER_COLUMNS] = counters
+    frames[:, ANALOG_VALUE_COLUMNS] = np.clip(
+        500 + np.cumsum(rng.randint(-30, 31, (count, 4)), axis=0) // 3,
+        0, 1023)
+    with open(path, 'wb') as f:
+        writeHeader(f, CONFIG)
+        f.write(frames.tobytes())
+    return frames
+
+
+def referenceChannels(frames, binMillis):
+    """Returns the per channel summary of the enabled channels, worked out
+       one frame at a time."""
+
+    times = frames[:, TIME_COLUMN].astype(np.int64)
+    counters = frames[:, COUNTER_COLUMNS].astype(np.int64)
+    previous = np.concatenate((np.zeros_like(counters[:1]), counters[:-1]))
+    events = np.maximum(counters - previous, 0)
+    bins = times // binMillis - times[0] // binMillis
+
+    channels = {}
+    for channel, channelConfig in enumerate(CONFIG['discreteConfig'] +
+                                            CONFIG['analogConfig']):
+        if channelConfig == 0:
+            continue
+        rows = np.flatnonzero(events[:, channel])
+        channels[CHANNEL_NAMES[channel]] = {
+            'events': int(events[:, channel].sum()),
+            'firstEventMillis': int(times[rows[0]]) if len(rows) else None,
+            'eventsPerBin': np.bincount(bins, events[:, channel],
+                                        bins[-1] + 1).astype(int).tolist()}
+
+    for channel, channelConfig in enumerate(CONFIG['analogConfig']):
+        if channelConfig == 0:
+            continue
+        low = CONFIG['analogLowThreshold'][channel]
+        high = CONFIG['analogHighThreshold'][channel]
+        values = frames[:, ANALOG_VALUE_COLUMNS[channel]].astype(int)
+        count = totalMillis = longestMillis = peak = 0
+        start = None
+        for time, value in zip(times, values):
+            beyond = max(low - value, value - high)
+            if beyond > 0:
+                peak = max(peak, beyond)
+                if start is None:
+                    start = time
+                    count += 1
+            elif start is not None:
+                totalMillis += time - start
+                longestMillis = max(longestMillis, time - start)
+                start = None
+        if start is not None:
+            totalMillis += times[-1] - start
+            longestMillis = max(longestMillis, times[-1] - start)
+        channels[CHANNEL_NAMES[channel + 8]].update({
+            'levelMin': int(values.min()),
+            'levelMax': int(values.max()),
+            'levelMean': values.mean(),
+            'levelStd': values.std(),
+            'excursions': count,
+            'timeOutsideMillis': int(totalMillis),
+            'longestExcursionMillis': int(longestMillis),
+            'peakExcursion': int(peak)})
+    return channels
+
+
+class SummarizeSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.chunkFrames = report.CHUNK_FRAMES
+
+    def tearDown(self):
+        report.CHUNK_FRAMES = self.chunkFrames
+        shutil.rmtree(self.directory)
+
+    def test_chunks(self):
+        rng = np.random.RandomState(1)
+        path = os.path.join(self.directory, 'session.svb')
+        frames = writeSession(path, rng, 20000)
+        reference = referenceChannels(frames, 10000)
+        for chunkFrames in (1, 7, 1000, 1 << 20):
+            report.CHUNK_FRAMES = chunkFrames
+            summary = report.summarizeSession(path, 10)
+            self.assertEqual(summary['frames'], len(frames))
+            self.assertEqual(summary['startMillis'], int(frames[0, 0]))
+            self.assertEqual(summary['stopMillis'], int(frames[-1, 0]))
+            self.assertEqual(sorted(summary['channels']), sorted(reference))
+            for name, expected in reference.items():
+                channel = summary['channels'][name]
+                for key, value in expected.items():
+                    if key in ('levelMean', 'levelStd'):
+                        self.assertAlmostEqual(channel[key], value,
+                                               msg=(chunkFrames, name, key))
+                    else:
+                        self.assertEqual(channel[key], value,
+                                         (chunkFrames, name, key))
+            first = min((channel['firstEventMillis'], name)
+                        for name, channel in reference.items()
+                        if channel['firstEventMillis'] is not None)
+            self.assertEqual((summary['firstFailureMillis'],
+                              summary['firstFailureChannel']), first)
+
+
+class SummaryJobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_errors(self):
+        # Not a session file, a header without the configuration and one
+        # with a malformed configuration
+        headers = [b'not a session', {'fixture': 'Test fixture'},
+                   dict(CONFIG, discreteConfig=None)]
+        for i, header in enumerate(headers):
+            path = os.path.join(self.directory, 'session{}.svb'.format(i))
+            with open(path, 'wb') as f:
+                if isinstance(header, bytes):
+                    f.write(header)
+                else:
+                    writeHeader(f, header)
+            summary = report._summaryJob((path, 10))
+            self.assertEqual(summary['channels'], {})
+            self.assertIn('error', summary)
+            self.assertEqual(summary['reportVersion'], report.REPORT_VERSION)
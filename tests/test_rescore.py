@@ -0,0 +1,226 @@
+# Checks rescore.py against a plain per-reading version of the sketch's state
+# machines, and against the sketch itself compiled for the PC (see
+# sketchhost/) and fed the same random readings. The sketch check is skipped
+# if there is no C++ compiler (g++).
+
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+
+import numpy as np
+
+from protocol import packConfig
+from rescore import (DISCRETE_FALLING, DISCRETE_RISING, HYSTERESIS,
+                     analogCounts, analogEvents, discreteEvents)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SKETCH_PATH = os.path.join(REPO_DIR, 'Arduino', 'ShockVibeBox',
+                           'ShockVibeBox.ino')
+HOST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'sketchhost')
+
+
+def referenceDiscrete(times, levels, edgeConfig, gateMicros):
+    """Event indices of the sketch's discrete state machine, stepped once
+       per reading."""
+
+    state = 0
+    timer = 0
+    events = []
+    for i, (time, level) in enumerate(zip(times, levels)):
+        failing = (level == 0) if edgeConfig == DISCRETE_RISING else \
+            (level != 0)
+        if state == 0:
+            if not failing:
+                state = 1
+        elif state == 1:
+            if failing:
+                timer = time
+                state = 2
+        elif time - timer >= gateMicros:
+            events.append(i)
+            state = 0
+        elif not failing:
+            state = 1
+    return events
+
+
+def referenceAnalog(times, values, low, high, gateMicros,
+                    hysteresis=HYSTERESIS):
+    """Event indices of the sketch's analog state machine, stepped once per
+       reading. The first reading also sets the initial state, as the
+       reading taken in setup() does."""
+
+    state = 1 if low < values[0] < high else 0
+    timer = 0
+    events = []
+    for i, (time, value) in enumerate(zip(times, values)):
+        passing = low + hysteresis < value < high - hysteresis
+        failing = value > high or value < low
+        if state == 0:
+            if passing:
+                state = 1
+        elif state == 1:
+            if failing:
+                timer = time
+                state = 2
+        elif time - timer >= gateMicros:
+            events.append(i)
+            state = 0
+        elif passing:
+            state = 1
+    return events
+
+
+def randomReadings(rng, count):
+    """Returns (times, levels, values): the time in microseconds, 8 discrete
+       levels and 4 analog values of <count> random readings. Levels and
+       values switch between passing and failing in runs of random length,
+       so that dropouts both shorter and longer than typical gate times
+       occur."""
+
+    times = 1000 + np.cumsum(rng.randint(20, 400, count))
+    switches = rng.random_sample((count, 8)) < 0.05
+    levels = (np.cumsum(switches, axis=0) + rng.randint(0, 2, 8)) % 2
+    outside = (np.cumsum(rng.random_sample((count, 4)) < 0.03, axis=0) +
+               rng.randint(0, 2, 4)) % 2
+    inside = rng.randint(300, 700, (count, 4))
+    excursion = np.where(rng.random_sample((count, 4)) < 0.5,
+                         rng.randint(0, 320, (count, 4)),
+                         rng.randint(680, 1024, (count, 4)))
+    values = np.where(outside, excursion, inside)
+    return times, levels, values
+
+
+def randomConfig(rng):
+    """Returns a random test configuration (see protocol.packConfig). Gate
+       times and thresholds often have bytes of 0x80 or more."""
+
+    lows = rng.randint(0, 500, 4)
+    return {'discreteConfig': list(rng.randint(0, 3, 8)),
+            'analogConfig': list(rng.randint(0, 3, 4)),
+            'analogLowThreshold': list(lows),
+            'analogHighThreshold': list(lows + rng.randint(HYSTERESIS * 3,
+                                                           500, 4)),
+            'gateThresholdMicros': int(rng.randint(0, 5000)),
+            'triggerDurationMicros': 1000}
+
+
+class ReferenceTest(unittest.TestCase):
+    """rescore.py against the per-reading state machines."""
+
+    def test_discrete(self):
+        rng = np.random.RandomState(1)
+        gates = [0, 1, 150, 999, 1000, 2500, 20000]
+        for trial in range(20):
+            times, levels, values = randomReadings(rng, 3000)
+            for edge in (DISCRETE_RISING, DISCRETE_FALLING):
+                events = discreteEvents(times, levels[:, 0], edge, gates)
+                for gate, indices in zip(gates, events):
+                    self.assertEqual(list(indices), referenceDiscrete(
+                        times, levels[:, 0], edge, gate))
+
+    def test_analog(self):
+        rng = np.random.RandomState(2)
+        gates = [0, 1, 150, 999, 1000, 2500, 20000]
+        for trial in range(20):
+            times, levels, values = randomReadings(rng, 3000)
+            low = rng.randint(0, 500)
+            high = low + rng.randint(1, 600)
+            if high < HYSTERESIS:
+                continue
+            events = analogEvents(times, values[:, 0], low, high, gates)
+            for gate, indices in zip(gates, events):
+                self.assertEqual(list(indices), referenceAnalog(
+                    times, values[:, 0], low, high, gate))
+
+    def test_analog_counts(self):
+        rng = np.random.RandomState(3)
+        times, levels, values = randomReadings(rng, 3000)
+        lows, highs, gates = [100, 300, 600], [500, 700], [0, 500, 2000]
+        counts = analogCounts(times, values[:, 1], lows, highs, gates)
+        for i, low in enumerate(lows):
+            for j, high in enumerate(highs):
+                for k, gate in enumerate(gates):
+                    expected = -1 if low >= high else len(referenceAnalog(
+                        times, values[:, 1], low, high, gate))
+                    self.assertEqual(counts[i, j, k], expected)
+
+
+@unittest.skipIf(shutil.which('g++') is None, 'no C++ compiler (g++)')
+class SketchTest(unittest.TestCase):
+    """rescore.py against ShockVibeBox.ino compiled for the PC."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.buildDir = tempfile.mkdtemp()
+        with open(SKETCH_PATH) as f:
+            sketch = f.read()
+        sketch = sketch.replace('unsigned long', 'uint32_t').replace(
+            '(long)', '(int32_t)')
+        with open(os.path.join(cls.buildDir, 'sketch.cpp'), 'w') as f:
+            f.write(sketch)
+        cls.replay = os.path.join(cls.buildDir, 'replay')
+        subprocess.check_call(['g++', '-fpermissive', '-w',
+                               '-I' + cls.buildDir, '-I' + HOST_DIR, '-o',
+                               cls.replay,
+                               os.path.join(HOST_DIR, 'replay.cpp')])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.buildDir)
+
+    def runSketch(self, config, times, levels, values):
+        """Returns the 12 event counters of the sketch after setup() took
+           the first reading and loop() each of the others."""
+
+        handshake = packConfig(config)
+        readings = np.zeros(len(times), dtype=[('time', '<u4'),
+                                               ('levels', 'u1', 8),
+                                               ('values', '<u2', 4)])
+        readings['time'] = times
+        readings['levels'] = levels
+        readings['values'] = values
+        data = (struct.pack('<L', len(handshake)) + handshake +
+                struct.pack('<L', len(times) - 1) + readings.tobytes())
+        output = subprocess.check_output([self.replay], input=data)
+        return [int(count) for count in output.split()]
+
+    def test_counts(self):
+        rng = np.random.RandomState(4)
+        for trial in range(40):
+            config = randomConfig(rng)
+            times, levels, values = randomReadings(rng, 20000)
+            counts = self.runSketch(config, times, levels, values)
+            gate = config['gateThresholdMicros']
+
+            # Discrete inputs are read on every loop
+            for channel, edge in enumerate(config['discreteConfig']):
+                expected = 0 if edge == 0 else len(discreteEvents(
+                    times[1:], levels[1:, channel], edge, gate))
+                self.assertEqual(counts[channel], expected,
+                                 (trial, 'D', channel, config))
+
+            # The enabled analog channels take turns at the ADC: loop i
+            # starts a conversion of the next one with that loop's reading,
+            # and loop i + 1 scores it, at its own time. The reading of
+            # setup() sets the initial state.
+            enabled = np.flatnonzero(config['analogConfig'])
+            loops = np.arange(1, len(times) - 1)
+            for turn, channel in enumerate(enabled):
+                scored = loops[(loops - 1) % len(enabled) == turn]
+                channelTimes = np.concatenate((times[:1], times[scored + 1]))
+                channelValues = np.concatenate((values[:1, channel],
+                                                values[scored, channel]))
+                expected = len(analogEvents(
+                    channelTimes, channelValues,
+                    config['analogLowThreshold'][channel],
+                    config['analogHighThreshold'][channel], gate))
+                self.assertEqual(counts[8 + channel], expected,
+                                 (trial, 'A', channel, config))
+            for channel in range(4):
+                if channel not in enabled:
+                    self.assertEqual(counts[8 + channel], 0)
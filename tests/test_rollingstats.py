@@ -0,0 +1,121 @@
+# Checks RollingStats, fed random frames in batches of random size, against
+# the same statistics computed from all frames at once.
+
+import unittest
+
+import numpy as np
+
+from protocol import (ANALOG_VALUE_COLUMNS, COUNTER_COLUMNS, SAMPLESIZE,
+                      TIME_COLUMN)
+from rollingstats import RollingStats
+
+
+def randomFrames(rng, count):
+    """Returns <count> random frames with irregular time steps (some of them
+       zero and some longer than a second), Poisson events and a counter
+       reset (an Arduino restart) partway through."""
+
+    steps = rng.randint(1, 2000, count) * (rng.random_sample(count) < 0.9)
+    frames = np.zeros((count, SAMPLESIZE), dtype=np.uint32)
+    frames[:, TIME_COLUMN] = np.cumsum(steps) + rng.randint(0, 5000)
+    counters = np.cumsum(rng.poisson(0.05, (count, len(COUNTER_COLUMNS))),
+                         axis=0)
+    reset = rng.randint(0, count)
+    counters[reset:] -= counters[reset] - rng.randint(0, 3)
+    frames[:, COUNTER_COLUMNS] = counters
+    frames[:, ANALOG_VALUE_COLUMNS] = rng.randint(0, 1024, (count, 4))
+    return frames
+
+
+def referenceStats(frames, windows, rateTimeConstant):
+    """Returns the statistics of RollingStats.snapshot() computed directly
+       from all frames."""
+
+    times = frames[:, TIME_COLUMN].astype(np.int64)
+    levels = frames[:, ANALOG_VALUE_COLUMNS].astype(np.float64)
+    counters = frames[:, COUNTER_COLUMNS].astype(np.int64)
+    previous = np.concatenate((np.zeros_like(counters[:1]), counters[:-1]))
+    events = np.maximum(counters - previous, 0)
+
+    # Window counts have a resolution of one second
+    seconds = times // 1000
+    windowCounts = np.array([events[seconds > seconds[-1] - window].sum(
+        axis=0) for window in windows])
+
+    tau = rateTimeConstant * 1000.0
+    decayed = np.exp((times - times[-1]) / tau).dot(events)
+    elapsed = max(1000, times[-1] - times[0])
+    rate = decayed * 60000.0 / (tau * (1 - np.exp(-elapsed / tau)))
+
+    return {'timeMillis': times[-1],
+            'levelMin': levels.min(axis=0),
+            'levelMax': levels.max(axis=0),
+            'levelMean': levels.mean(axis=0),
+            'levelStd': levels.std(axis=0),
+            'eventTotals': events.sum(axis=0),
+            'ratePerMinute': rate,
+            'windowCounts': windowCounts}
+
+
+class RollingStatsTest(unittest.TestCase):
+
+    def test_batches(self):
+        rng = np.random.RandomState(1)
+        for trial in range(30):
+            frames = randomFrames(rng, rng.randint(1, 20000))
+            stats = RollingStats()
+            start = 0
+            while start < len(frames):
+                size = rng.randint(1, 300)
+                stats.write(frames[start:start + size])
+                start += size
+            snapshot = stats.snapshot()
+            reference = referenceStats(frames, stats.windows,
+                                       stats.rateTimeConstant)
+            for key in ('timeMillis', 'levelMin', 'levelMax', 'eventTotals',
+                        'windowCounts'):
+                np.testing.assert_array_equal(snapshot[key], reference[key],
+                                              key)
+            for key in ('levelMean', 'levelStd', 'ratePerMinute'):
+                np.testing.assert_allclose(snapshot[key], reference[key],
+                                           err_msg=key)
+
+    def test_wrap(self):
+        # Frame times wrap past 2**32 ms about a minute into the test
+        rng = np.random.RandomState(2)
+        frames = randomFrames(rng, 5000)
+        times = frames[:, TIME_COLUMN].astype(np.int64) + 2**32 - 60000
+        frames[:, TIME_COLUMN] = times % 2**32
+        stats = RollingStats()
+        for start in range(0, len(frames), 100):
+            stats.write(frames[start:start + 100])
+        unwrapped = frames.astype(np.int64)
+        unwrapped[:, TIME_COLUMN] = times
+        snapshot = stats.snapshot()
+        reference = referenceStats(unwrapped, stats.windows,
+                                   stats.rateTimeConstant)
+        self.assertEqual(snapshot['timeMillis'], times[-1])
+        np.testing.assert_array_equal(snapshot['windowCounts'],
+                                      reference['windowCounts'])
+        np.testing.assert_allclose(snapshot['ratePerMinute'],
+                                   reference['ratePerMinute'])
+
+    def test_steady_rate(self):
+        # 3 events a minute for an hour, one every 20 seconds
+        frames = np.zeros((72000, SAMPLESIZE), dtype=np.uint32)
+        frames[:, TIME_COLUMN] = np.arange(len(frames)) * 50
+        frames[:, COUNTER_COLUMNS[0]] = np.arange(len(frames)) // 400
+        stats = RollingStats()
+        for start in range(0, len(frames), 10):
+            stats.write(frames[start:start + 10])
+        snapshot = stats.snapshot()
+        # The smoothed rate decays between events, from 1 / (1 - exp(-1/3))
+        # to exp(-1/3) times that
+        self.assertTrue(2.5 < snapshot['ratePerMinute'][0] < 3.6)
+        self.assertEqual(list(snapshot['windowCounts'][:, 0]), [3, 30, 179])
+
+    def test_empty(self):
+        snapshot = RollingStats().snapshot()
+        self.assertIsNone(snapshot['timeMillis'])
+        self.assertTrue(np.isnan(snapshot['levelMean']).all())
+        self.assertFalse(snapshot['windowCounts'].any())
@@ -0,0 +1,244 @@
+# Timebase of a test. The Arduino stamps each frame with its millis() clock,
+# a 32-bit count that wraps after about 49.7 days and runs at the rate of the
+# board's resonator, which can be off by a few hundred ppm (several seconds a
+# day). devices.CounterStitcher makes the frame times start from zero at the
+# start of the test, and everything here turns them into a timeline that can be
+# lined up with other logs:
+#
+#   - unwrapMillis() and TimeUnwrapper extend the 32-bit frame times to 64-bit
+#     test times. Each step between frames is taken modulo 2**32 and summed,
+#     which needs no special case for the wrap.
+#   - Timebase fits the test time against the PC's monotonic clock as frames
+#     arrive, giving the clock error of the Arduino in ppm and the PC time of
+#     any frame. The fit is logged as checkpoints (see recorder.py), from which
+#     session.SessionFile.hostTimes() gives the PC time of recorded frames.
+#
+# Each read is one point of the fit: the test time of the newest frame and the
+# PC time it was read at. The read always comes some time after the frame was
+# sent, so only the earliest point of each FIT_INTERVAL (the lowest PC time
+# for its test time) is kept, which is the one closest to the actual transfer.
+#
+# This module must not import Kivy.
+
+from collections import deque
+from time import monotonic, time
+
+import numpy as np
+
+# Period of the 32-bit frame times
+WRAP_MILLIS = 1 << 32
+
+# Test time in milliseconds over which the earliest point is kept for the fit,
+# and the number of such points the fit uses (about an hour)
+FIT_INTERVAL = 10000
+FIT_POINTS = 360
+
+# Test time in milliseconds between checkpoints of the fit
+CHECKPOINT_INTERVAL = 60000
+
+
+def unwrapMillis(times, previous=None):
+    """Returns an array of 32-bit frame times as int64 times that keep
+       increasing past each wrap. <previous> is the unwrapped time of the
+       frame before the first, if any. Steps of up to 2**31 ms either way are
+       taken as they are."""
+
+    times = np.asarray(times, dtype=np.int64)
+    if len(times) == 0:
+        return times
+    first = times[:1] if previous is None else previous + _steps(
+        times[:1] - previous)
+    return np.cumsum(np.concatenate((first, _steps(np.diff(times)))))
+
+
+def unwrapTime(frameTime, previous=None):
+    """Returns one 32-bit frame time unwrapped, as unwrapMillis()."""
+
+    if previous is None:
+        return int(frameTime)
+    return previous + int(_steps(int(frameTime) - previous))
+
+
+def hostTimes(checkpoints, millis):
+    """Returns the PC times (Unix seconds) of an array of unwrapped test
+       times, from a list of Timebase checkpoints in time order, or None if
+       there are none. Times between checkpoints are interpolated, and times
+       outside them extrapolated at the clock error of the nearest one."""
+
+    if not checkpoints:
+        return None
+    times = np.array([point['time'] for point in checkpoints], dtype=float)
+    hosts = np.array([point['hostTime'] for point in checkpoints])
+    millis = np.array(millis, dtype=float, ndmin=1)
+    result = np.interp(millis, times, hosts)
+    for end, outside in ((0, millis < times[0]), (-1, millis > times[-1])):
+        rate = 1.0 + (checkpoints[end]['clockError'] or 0.0) * 1e-6
+        result[outside] = (hosts[end] +
+                           (millis[outside] - times[end]) / 1000.0 / rate)
+    return result
+
+
+def _steps(differences):
+    """Returns differences of 32-bit times as signed steps."""
+    half = WRAP_MILLIS // 2
+    return (differences + half) % WRAP_MILLIS - half
+
+
+class TimeUnwrapper(object):
+    """Unwraps successive batches of frame times (see unwrapMillis()).
+       self.last is the newest unwrapped time."""
+
+    def __init__(self):
+        self.last = None
+
+    def unwrap(self, times):
+        """Returns a batch of frame times as an int64 array."""
+
+        unwrapped = unwrapMillis(times, self.last)
+        if len(unwrapped):
+            self.last = int(unwrapped[-1])
+        return unwrapped
+
+    def unwrapTime(self, frameTime):
+        """Returns one frame time unwrapped."""
+
+        self.last = unwrapTime(frameTime, self.last)
+        return self.last
+
+
+class Timebase(object):
+    """Alignment of the test time of one unit with the PC clock.
+
+       update() is called with the newest frame time of each read and the
+       monotonic time of the read. The PC time of a frame is then
+
+           offset + testSeconds * (1 + slope)
+
+       fitted by least squares to the earliest point of each of the last
+       <fitPoints> intervals of <fitInterval> ms. The offset and slope are
+       refitted whenever a point is added or improved.
+
+       resume() starts a new segment of points after the link was down, as
+       the stitched time across the outage is only an estimate. The slope is
+       fitted to every segment at once, each about its own mean, and the
+       offset to the current segment only.
+
+       Checkpoints {'time': test time (ms), 'hostTime': PC time (Unix
+       seconds), 'clockError': ppm} are written to <sinks> at the first fit,
+       every <checkpointInterval> ms of test time, before a resume and on
+       close()."""
+
+    def __init__(self, sinks=(), fitInterval=FIT_INTERVAL,
+                 fitPoints=FIT_POINTS,
+                 checkpointInterval=CHECKPOINT_INTERVAL):
+        self.sinks = sinks
+        self.fitInterval = fitInterval
+        self.checkpointInterval = checkpointInterval
+        self.unwrapper = TimeUnwrapper()
+
+        # Earliest (segment, test time, PC seconds - test seconds) of each
+        # interval
+        self._points = deque(maxlen=fitPoints)
+        self._segment = 0
+        self._offset = None
+        self._slope = 0.0
+        self._fitted = False
+        self._lastCheckpoint = None
+        self._wallOffset = time() - monotonic()
+
+    @property
+    def lastMillis(self):
+        """Test time of the newest frame, or None before the first."""
+        return self.unwrapper.last
+
+    @property
+    def clockError(self):
+        """Rate error of the Arduino's clock in ppm (positive if it runs
+           fast), or None until it has been measured."""
+        if not self._fitted:
+            return None
+        return (1.0 / (1.0 + self._slope) - 1.0) * 1e6
+
+    def update(self, frameTime, monotonicTime):
+        """Adds a point: the stitched 32-bit time of the newest frame and
+           the monotonic time (time.monotonic()) it was read at. Returns the
+           unwrapped test time of the frame."""
+
+        millis = self.unwrapper.unwrapTime(frameTime)
+        residual = monotonicTime - millis / 1000.0
+        point = (self._segment, millis, residual)
+        points = self._points
+        if not points or points[-1][0] != self._segment or \
+                millis // self.fitInterval != \
+                points[-1][1] // self.fitInterval:
+            points.append(point)
+            self._fit()
+        elif residual < points[-1][2]:
+            points[-1] = point
+            self._fit()
+
+        if (self._lastCheckpoint is None or
+                millis - self._lastCheckpoint >= self.checkpointInterval):
+            self._checkpoint(millis)
+        return millis
+
+    def _fit(self):
+        self._wallOffset = time() - monotonic()
+        segments, millis, residuals = np.array(self._points).T
+        seconds = millis / 1000.0
+
+        # Least squares slope of the points about their segment's means,
+        # once there are at least two intervals beyond each segment's first
+        _, groups = np.unique(segments, return_inverse=True)
+        if len(segments) - groups[-1] - 1 >= 2:
+            counts = np.bincount(groups)
+            x = seconds - (np.bincount(groups, seconds) / counts)[groups]
+            y = residuals - (np.bincount(groups, residuals) / counts)[groups]
+            self._slope = x.dot(y) / x.dot(x)
+            self._fitted = True
+        current = segments == self._segment
+        self._offset = float((residuals[current] -
+                              self._slope * seconds[current]).mean())
+
+    def _checkpoint(self, millis):
+        self._lastCheckpoint = millis
+        checkpoint = {'time': millis,
+                      'hostTime': round(float(self.hostTime(millis)), 6),
+                      'clockError': None if self.clockError is None
+                                    else round(float(self.clockError), 3)}
+        for sink in self.sinks:
+            sink.write([checkpoint])
+
+    def monotonicTime(self, millis):
+        """Returns the monotonic time at which the frame at test time
+           <millis> was sent, or None before the first point."""
+
+        if self._offset is None:
+            return None
+        return self._offset + millis / 1000.0 * (1.0 + self._slope)
+
+    def hostTime(self, millis):
+        """Returns the PC time (Unix seconds, as time.time()) at which the
+           frame at test time <millis> was sent, or None before the first
+           point."""
+
+        if self._offset is None:
+            return None
+        return self.monotonicTime(millis) + self._wallOffset
+
+    def resume(self):
+        """Starts a new fit after the link was down."""
+
+        self._finalCheckpoint()
+        self._segment += 1
+        self._offset = None
+        self._lastCheckpoint = None
+
+    def close(self):
+        """Writes a last checkpoint at the newest frame."""
+        self._finalCheckpoint()
+
+    def _finalCheckpoint(self):
+        if self._offset is not None and \
+                self._lastCheckpoint != self.lastMillis:
+            self._checkpoint(self.lastMillis)
@@ -0,0 +1,80 @@
+# Buffer for the analog waveform blocks sent in waveform capture mode (serial
+# protocol v3). The sketch samples the analog channels far faster than the
+# level shown on each AnalogMeter is updated, so the display summarises the
+# recent samples of each channel as min/max/RMS instead of drawing them.
+#
+# This module must not import Kivy.
+
+import threading
+
+import numpy as np
+
+# Number of analog channels
+CHANNELS = 4
+
+
+class WaveformBuffer(object):
+    """Holds the most recent <windowSamples> waveform samples of each analog
+       channel.
+
+       write() is called from the serial reader thread with each list of
+       protocol.WaveformBlocks. stats() and window() can be called from any
+       thread, e.g. the UI thread, and return copies. Writes only copy each
+       block into a per-channel ring; the statistics are only worked out when
+       asked for."""
+
+    def __init__(self, windowSamples=512):
+        self._lock = threading.Lock()
+        self._samples = np.zeros((CHANNELS, windowSamples), dtype=np.uint16)
+        self._positions = np.zeros(CHANNELS, dtype=np.int64)
+        self._filled = np.zeros(CHANNELS, dtype=np.int64)
+
+        # Number of blocks written, and the time (ms) and sample interval of
+        # the latest block on each channel
+        self.blocks = 0
+        self.lastTime = [None]*CHANNELS
+        self.intervalMicros = [0]*CHANNELS
+
+    def write(self, blocks):
+        """Adds a list of WaveformBlocks."""
+
+        size = self._samples.shape[1]
+        with self._lock:
+            for block in blocks:
+                self._append(block.channel, block.samples[-size:])
+                self.lastTime[block.channel] = block.time
+                self.intervalMicros[block.channel] = block.intervalMicros
+            self.blocks += len(blocks)
+
+    def _append(self, channel, samples):
+        size = self._samples.shape[1]
+        indices = (self._positions[channel] + np.arange(len(samples))) % size
+        self._samples[channel, indices] = samples
+        self._positions[channel] = ((self._positions[channel] + len(samples)) %
+                                    size)
+        self._filled[channel] = min(size, self._filled[channel] + len(samples))
+
+    def window(self, channel):
+        """Returns the buffered samples of one channel, oldest first."""
+
+        with self._lock:
+            size = self._samples.shape[1]
+            start = (self._positions[channel] - self._filled[channel]) % size
+            indices = (start + np.arange(self._filled[channel])) % size
+            return self._samples[channel, indices]
+
+    def stats(self):
+        """Returns a <CHANNELS>x3 array with the minimum, maximum and RMS of
+           each channel's buffered samples (NaN for channels without any).
+
+           The RMS is taken about the window mean, so it measures the
+           vibration amplitude rather than the steady level."""
+
+        stats = np.full((CHANNELS, 3), np.nan)
+        for channel in range(CHANNELS):
+            samples = self.window(channel).astype(np.float64)
+            if len(samples) == 0:
+                continue
+            stats[channel] = (samples.min(), samples.max(),
+                              np.sqrt(np.mean((samples - samples.mean())**2)))
+        return stats